@@ -0,0 +1,63 @@
+"""coin-rows
+
+Revision ID: 3f1c2a9d7b64
+Revises: 857b05b905dd
+Create Date: 2026-10-18 10:12:41.204318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3f1c2a9d7b64"
+down_revision = "857b05b905dd"
+branch_labels = None
+depends_on = None
+
+COINS = (5, 10, 20, 50, 100)
+
+
+def upgrade():
+    op.create_table(
+        "vending_machine_coins",
+        sa.Column("vending_id", sa.UUID(), nullable=False),
+        sa.Column("coin", sa.Integer(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.CheckConstraint("count >= 0", name="ck_coin_count_positive"),
+        sa.ForeignKeyConstraint(
+            ["vending_id"], ["vending_machines.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("vending_id", "coin"),
+    )
+    # move the JSON inventory into one row per denomination
+    op.execute(
+        f"""
+        INSERT INTO vending_machine_coins (vending_id, coin, count)
+        SELECT vm.id, c.coin, COALESCE((vm.status ->> c.coin::text)::int, 0)
+        FROM vending_machines vm
+        CROSS JOIN (VALUES {", ".join(f"({c})" for c in COINS)}) AS c(coin)
+        """
+    )
+    op.drop_column("vending_machines", "status")
+
+
+def downgrade():
+    op.add_column(
+        "vending_machines",
+        sa.Column("status", sa.JSON(), nullable=False, server_default="{}"),
+    )
+    op.execute(
+        """
+        UPDATE vending_machines vm
+        SET status = coins.status
+        FROM (
+            SELECT vending_id, json_object_agg(coin, count) AS status
+            FROM vending_machine_coins
+            GROUP BY vending_id
+        ) AS coins
+        WHERE coins.vending_id = vm.id
+        """
+    )
+    op.alter_column("vending_machines", "status", server_default=None)
+    op.drop_table("vending_machine_coins")
@@ -0,0 +1,53 @@
+"""product-listing-indexes
+
+Revision ID: 5b7e93d0c1a2
+Revises: a8d4e61c2f05
+Create Date: 2026-10-18 12:15:37.904112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5b7e93d0c1a2"
+down_revision = "a8d4e61c2f05"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_products_vending_created",
+        "products",
+        ["vending_id", "created_at", "id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_products_seller_created",
+        "products",
+        ["seller_id", "created_at", "id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_products_vending_in_stock",
+        "products",
+        ["vending_id", "created_at", "id"],
+        unique=False,
+        postgresql_where=sa.text("amount_available > 0"),
+    )
+    op.create_index(
+        "ix_products_vending_cost", "products", ["vending_id", "cost"], unique=False
+    )
+    # covered by ix_products_vending_created
+    op.drop_index("ix_products_vending_id", table_name="products")
+
+
+def downgrade():
+    op.create_index(
+        "ix_products_vending_id", "products", ["vending_id"], unique=False
+    )
+    op.drop_index("ix_products_vending_cost", table_name="products")
+    op.drop_index("ix_products_vending_in_stock", table_name="products")
+    op.drop_index("ix_products_seller_created", table_name="products")
+    op.drop_index("ix_products_vending_created", table_name="products")
@@ -0,0 +1,32 @@
+"""row-versions
+
+Revision ID: e41b9c07d5a8
+Revises: c7d2e5f19a34
+Create Date: 2026-10-18 19:05:22.381946
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e41b9c07d5a8"
+down_revision = "c7d2e5f19a34"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users",
+        sa.Column("version", sa.Integer(), server_default="1", nullable=False),
+    )
+    op.add_column(
+        "products",
+        sa.Column("version", sa.Integer(), server_default="1", nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("products", "version")
+    op.drop_column("users", "version")
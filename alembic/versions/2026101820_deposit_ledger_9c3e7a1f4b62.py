@@ -0,0 +1,91 @@
+"""deposit-ledger
+
+Revision ID: 9c3e7a1f4b62
+Revises: e41b9c07d5a8
+Create Date: 2026-10-18 20:11:47.902318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9c3e7a1f4b62"
+down_revision = "e41b9c07d5a8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "ledger_entries",
+        sa.Column("id", sa.BigInteger(), sa.Identity(), nullable=False),
+        sa.Column("user_id", sa.UUID(), nullable=False),
+        sa.Column("vending_id", sa.UUID(), nullable=False),
+        sa.Column("kind", sa.String(length=16), nullable=False),
+        sa.Column("amount", sa.Integer(), nullable=False),
+        sa.Column("debit_seq", sa.Integer(), nullable=True),
+        sa.Column("product_id", sa.UUID(), nullable=True),
+        sa.Column("quantity", sa.Integer(), nullable=True),
+        sa.Column("coins", sa.JSON(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.CheckConstraint(
+            "kind IN ('coin_in', 'sale', 'refund')", name="ck_ledger_entries_kind"
+        ),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_ledger_entries_user_id_id", "ledger_entries", ["user_id", "id"]
+    )
+    op.create_index("ix_ledger_entries_created_at", "ledger_entries", ["created_at"])
+    op.create_index(
+        "uq_ledger_entries_user_debit",
+        "ledger_entries",
+        ["user_id", "debit_seq"],
+        unique=True,
+    )
+    op.create_table(
+        "balance_snapshots",
+        sa.Column("user_id", sa.UUID(), nullable=False),
+        sa.Column("last_entry_id", sa.BigInteger(), nullable=False),
+        sa.Column("deposit", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id", "last_entry_id"),
+    )
+    # current deposits become the first snapshots
+    op.execute(
+        """
+        INSERT INTO balance_snapshots (user_id, last_entry_id, deposit, created_at)
+        SELECT id, 0, deposit, now() AT TIME ZONE 'utc' FROM users WHERE deposit <> 0
+        """
+    )
+    op.drop_column("users", "deposit")
+
+
+def downgrade():
+    op.add_column(
+        "users",
+        sa.Column("deposit", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.execute(
+        """
+        UPDATE users SET deposit = coalesce((
+            SELECT s.deposit FROM balance_snapshots s WHERE s.user_id = users.id
+            ORDER BY s.last_entry_id DESC LIMIT 1
+        ), 0) + coalesce((
+            SELECT sum(e.amount) FROM ledger_entries e
+            WHERE e.user_id = users.id AND e.id > coalesce((
+                SELECT max(s.last_entry_id) FROM balance_snapshots s
+                WHERE s.user_id = users.id
+            ), 0)
+        ), 0)
+        """
+    )
+    op.alter_column("users", "deposit", server_default=None)
+    op.drop_table("balance_snapshots")
+    op.drop_index("uq_ledger_entries_user_debit", table_name="ledger_entries")
+    op.drop_index("ix_ledger_entries_created_at", table_name="ledger_entries")
+    op.drop_index("ix_ledger_entries_user_id_id", table_name="ledger_entries")
+    op.drop_table("ledger_entries")
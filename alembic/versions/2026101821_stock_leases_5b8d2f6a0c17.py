@@ -0,0 +1,53 @@
+"""stock-leases
+
+Revision ID: 5b8d2f6a0c17
+Revises: 9c3e7a1f4b62
+Create Date: 2026-10-18 21:02:36.517094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5b8d2f6a0c17"
+down_revision = "9c3e7a1f4b62"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "stock_leases",
+        sa.Column("id", sa.UUID(), nullable=False),
+        sa.Column("product_id", sa.UUID(), nullable=False),
+        sa.Column("vending_id", sa.UUID(), nullable=False),
+        sa.Column("worker_id", sa.String(length=128), nullable=False),
+        sa.Column("units", sa.Integer(), nullable=False),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.CheckConstraint("units >= 0", name="ck_stock_leases_units_positive"),
+        sa.ForeignKeyConstraint(["product_id"], ["products.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_stock_leases_expires_at", "stock_leases", ["expires_at"])
+    op.create_index("ix_stock_leases_worker_id", "stock_leases", ["worker_id"])
+    op.create_index(op.f("ix_stock_leases_product_id"), "stock_leases", ["product_id"])
+
+
+def downgrade():
+    # unsold units go back to the products before the leases are dropped
+    op.execute(
+        """
+        UPDATE products p SET amount_available = p.amount_available + l.units
+        FROM (
+            SELECT product_id, sum(units) AS units FROM stock_leases
+            GROUP BY product_id
+        ) l
+        WHERE p.id = l.product_id
+        """
+    )
+    op.drop_index(op.f("ix_stock_leases_product_id"), table_name="stock_leases")
+    op.drop_index("ix_stock_leases_worker_id", table_name="stock_leases")
+    op.drop_index("ix_stock_leases_expires_at", table_name="stock_leases")
+    op.drop_table("stock_leases")
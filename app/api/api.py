@@ -1,9 +1,22 @@
 from fastapi import APIRouter
 
-from app.api.endpoints import auth, products, users, vending
+from app.api.endpoints import auth, debug, metrics, products, users, vending
+from app.core.config import settings
 
 api_router = APIRouter()
+api_router.include_router(metrics.router, tags=["metrics"])
 api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
 api_router.include_router(users.router, prefix="/user", tags=["users"])
 api_router.include_router(products.router, prefix="/products", tags=["products"])
 api_router.include_router(vending.router, prefix="/vending", tags=["vending"])
+# the same routes scoped to one machine of the fleet, otherwise the machine
+# comes from the token claim or the configured default
+api_router.include_router(
+    products.router, prefix="/machines/{machine_id}/products", tags=["products"]
+)
+api_router.include_router(
+    vending.router, prefix="/machines/{machine_id}/vending", tags=["vending"]
+)
+
+if settings.DEBUG_ENDPOINTS:
+    api_router.include_router(debug.router, prefix="/debug", tags=["debug"])
@@ -8,15 +8,17 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core import config, security
 from app.db.sql.models import User
-from app.db.sql.session import get_session
-from app.users.models import UserReadFull
+from app.core.session import async_session
+from app.db.sql.session import get_read_session, is_replica
+from app.users.cache import user_cache
+from app.users.models import UserRead, UserReadFull
 
 reusable_oauth2 = OAuth2PasswordBearer(tokenUrl="auth/access-token")
 
 
-async def get_current_user(
-    session: AsyncSession = Depends(get_session), token: str = Depends(reusable_oauth2)
-) -> UserReadFull:
+def get_token_payload(
+    token: str = Depends(reusable_oauth2),
+) -> security.JWTTokenPayload:
     try:
         payload = jwt.decode(
             token, config.settings.SECRET_KEY, algorithms=[security.JWT_ALGORITHM]
@@ -40,10 +42,38 @@ async def get_current_user(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Could not validate credentials, token expired or not yet valid",
         )
+    return token_data
+
 
-    result = await session.execute(select(User).where(User.id == token_data.sub))
-    user = result.scalar_one()
+async def _load_user(session: AsyncSession, user_id: str | int) -> User:
+    query = select(User).where(User.id == user_id)
+    user = (await session.execute(query)).scalar_one_or_none()
+    if user is None and is_replica(session):
+        # registered after the last transaction the replica replayed
+        async with async_session() as primary:
+            user = (await primary.execute(query)).scalar_one_or_none()
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
-    return UserReadFull.model_validate(user)
+    return user
+
+
+async def get_current_user(
+    session: AsyncSession = Depends(get_read_session),
+    token_data: security.JWTTokenPayload = Depends(get_token_payload),
+) -> UserRead:
+    """Identity of the current user (no deposit), served from `user_cache`"""
+    user = user_cache.get(str(token_data.sub))
+    if user is None:
+        user = UserRead.model_validate(await _load_user(session, token_data.sub))
+        user_cache.set(str(token_data.sub), user)
+    return user
+
+
+async def get_current_user_full(
+    session: AsyncSession = Depends(get_read_session),
+    token_data: security.JWTTokenPayload = Depends(get_token_payload),
+) -> UserReadFull:
+    """Current user with the deposit - read from the database, at most
+    `DATABASE_REPLICA_MAX_LAG_SECONDS` behind the primary"""
+    return UserReadFull.model_validate(await _load_user(session, token_data.sub))
@@ -1,3 +1,20 @@
+from uuid import UUID
+
+from fastapi import Depends, HTTPException
+
 from app.db.sql.session import get_session
-from app.api.auth import get_current_user
-from app.vending.service import VendingService, get_vending_service
\ No newline at end of file
+from app.api.auth import get_current_user, get_current_user_full
+from app.users.models import UserRead
+from app.vending.machine import get_vending_machine_id
+from app.vending.service import VendingService, get_vending_service
+
+
+async def check_machine_access(
+    current_user: UserRead = Depends(get_current_user),
+    machine_id: UUID = Depends(get_vending_machine_id),
+):
+    # users only use the machine they belong to
+    if current_user.vending_id != machine_id:
+        raise HTTPException(
+            status_code=403, detail="You do not have access to this vending machine."
+        )
@@ -10,6 +10,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.api import deps
 from app.core import config, security
 from app.db.sql.models import User
+from app.errors import PasswordHashingBusyError
 from app.schemas.requests import RefreshTokenRequest
 from app.schemas.responses import AccessTokenResponse
 
@@ -31,10 +32,14 @@ async def login_access_token(
     if user is None:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    if not security.verify_password(form_data.password, user.password):
+    try:
+        valid = await security.verify_password_async(form_data.password, user.password)
+    except PasswordHashingBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if not valid:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    return security.generate_access_token_response(str(user.id))
+    return security.generate_access_token_response(str(user.id), str(user.vending_id))
 
 
 @router.post("/refresh-token", response_model=AccessTokenResponse)
@@ -76,4 +81,4 @@ async def refresh_token(
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return security.generate_access_token_response(str(user.id))
+    return security.generate_access_token_response(str(user.id), str(user.vending_id))
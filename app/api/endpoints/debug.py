@@ -0,0 +1,59 @@
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.api import deps
+from app.core.config import settings
+from app.core.security import password_hasher
+from app.core.session import pool_stats
+from app.db.sql.locks import lock_waits
+from app.db.sql.replica import replica_monitor
+from app.products.cache import catalog_cache
+from app.users.cache import user_cache
+
+
+def require_debug_token(x_debug_token: Optional[str] = Header(default=None)):
+    # lock waits show the queries of every backend - anyone can register as a
+    # user, so only the operator's token gets in
+    if (
+        not settings.DEBUG_TOKEN
+        or x_debug_token is None
+        or not secrets.compare_digest(x_debug_token, settings.DEBUG_TOKEN)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to perform this action.",
+        )
+
+
+# Operational statistics, only mounted when settings.DEBUG_ENDPOINTS is set
+router = APIRouter(dependencies=[Depends(require_debug_token)])
+
+
+@router.get("/cache")
+async def cache_stats():
+    """Hit/miss counters of the in-process caches of this worker"""
+    return {"users": user_cache.stats(), "catalog": catalog_cache.stats()}
+
+
+@router.get("/password-hashing")
+async def password_hashing_stats():
+    """Load of the password hashing pool of this worker"""
+    return password_hasher.stats()
+
+
+@router.get("/locks")
+async def lock_wait_graph(session: AsyncSession = Depends(deps.get_session)):
+    """Backends waiting on locks in this database and the backends blocking them"""
+    return await lock_waits(session)
+
+
+@router.get("/pool")
+async def connection_pool_stats():
+    """Connections of the database pools of this worker and checkout wait time"""
+    stats = {"primary": pool_stats("primary"), "replica": replica_monitor.stats()}
+    if replica_monitor.session_factory is not None:
+        stats["replica"]["pool"] = pool_stats("replica")
+    return stats
@@ -1,32 +1,130 @@
 # - Implement CRUD for a product model (GET can be called by anyone, while POST, PUT and DELETE can be called only by the seller user who created the product)
 # based on my previous users.py file, I have created a products.py file in the same directory
 
+import csv
+import io
+from typing import AsyncIterator, Literal, Optional
 from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 from starlette import status
 
 from app.api import auth
+from app.api.deps import check_machine_access
+from app.core.config import settings
 from app.db.sql.models import User
-from app.products.repository import ProductRepository, get_product_repository
+from app.products import bulk
+from app.products.cache import catalog_cache
+from app.products.repository import (
+    ProductRepository,
+    get_product_read_repository,
+    get_product_repository,
+)
+from app.vending.machine import (
+    VendingMachine,
+    get_change_index,
+    get_vending_machine_id,
+    get_vending_machine_reader,
+)
 
+from app.products import models as product_models
 from app.schemas.requests import ProductCreate, ProductUpdate
 
 router = APIRouter()
 
 
-from app.products import models as product_models
-
-
 # GET /products - Get all products
-@router.get("/products")
+@router.get("/products", response_model=list[product_models.ProductListing])
 async def get_all_products(
-    product_repo: ProductRepository = Depends(get_product_repository)
+    if_none_match: Optional[str] = Header(default=None),
+    machine_id: UUID = Depends(get_vending_machine_id),
+    product_repo: ProductRepository = Depends(get_product_read_repository),
+    vending_machine: VendingMachine = Depends(get_vending_machine_reader),
+):
+    # coins other workers took in only reach this worker's index when it reads them
+    change_index = get_change_index(machine_id)
+    if change_index.stale(settings.CATALOG_CACHE_TTL_SECONDS):
+        change_index.set((await vending_machine.get_coins()).counts)
+    # pre-serialized catalog - unchanged polls cost neither a query nor serialization
+    entry = catalog_cache.get(machine_id, change_index)
+    if entry is None:
+        version = catalog_cache.version(machine_id)
+        products = await product_repo.get_all_products()
+        entry = catalog_cache.put(machine_id, products, version, change_index)
+
+    headers = {
+        "ETag": entry.etag,
+        "Last-Modified": entry.last_modified,
+        "Cache-Control": "no-cache",
+    }
+    if entry.matches(if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+# GET /page - One page of products, for catalogs too large to list at once
+@router.get("/page", response_model=product_models.ProductPage)
+async def get_products_page(
+    cursor: Optional[str] = None,
+    limit: int = Query(default=50, ge=1, le=200),
+    seller_id: Optional[UUID] = None,
+    in_stock: bool = False,
+    min_cost: Optional[int] = Query(default=None, ge=0),
+    max_cost: Optional[int] = Query(default=None, ge=0),
+    product_repo: ProductRepository = Depends(get_product_read_repository),
+):
+    # products of the routed machine, i.e. filtered by vending_id
+    try:
+        after = product_models.ProductCursor.decode(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filters = product_models.ProductFilter(
+        seller_id=seller_id, in_stock=in_stock, min_cost=min_cost, max_cost=max_cost
+    )
+    return await product_repo.list_products(filters, after, limit)
+
+
+EXPORT_COLUMNS = list(product_models.ProductRead.model_fields)
+_export_adapter = TypeAdapter(product_models.ProductRead)
+
+
+async def _ndjson_rows(batches: AsyncIterator[list[product_models.ProductRead]]):
+    async for batch in batches:
+        yield b"".join(_export_adapter.dump_json(p) + b"\n" for p in batch)
+
+
+async def _csv_rows(batches: AsyncIterator[list[product_models.ProductRead]]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for batch in batches:
+        writer.writerows([getattr(p, c) for c in EXPORT_COLUMNS] for p in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+# GET /export - Every product of the machine, streamed as it is read
+@router.get("/export")
+async def export_products(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    product_repo: ProductRepository = Depends(get_product_read_repository),
 ):
-    products = await product_repo.get_all_products()
-    return products
+    batches = product_repo.stream_products()
+    if format == "csv":
+        body, media_type = _csv_rows(batches), "text/csv"
+    else:
+        body, media_type = _ndjson_rows(batches), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="products.{format}"'},
+    )
 
 
-@router.post("/products")
+@router.post("/products", dependencies=[Depends(check_machine_access)])
 async def create_product(
     product: ProductCreate,
     product_repo: ProductRepository = Depends(get_product_repository),
@@ -41,12 +139,89 @@ async def create_product(
         seller_id=current_user.id,
         **product.model_dump(),
     )
-    print(prod_2)
     created_product = await product_repo.create_product(prod_2)
     return created_product
 
 
-@router.put("/products/{product_id}")
+def _require_seller(current_user: User):
+    if current_user.role != "seller":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to perform this action.",
+        )
+
+
+async def _bulk_rows(request: Request, model):
+    try:
+        return bulk.parse_rows(
+            await request.body(),
+            request.headers.get("content-type"),
+            model,
+            settings.PRODUCT_BULK_MAX_ROWS,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# POST /products/bulk - Create many products from a JSON array or NDJSON
+@router.post(
+    "/products/bulk",
+    response_model=product_models.ProductBulkResult,
+    dependencies=[Depends(check_machine_access)],
+)
+async def create_products(
+    request: Request,
+    product_repo: ProductRepository = Depends(get_product_repository),
+    current_user: User = Depends(auth.get_current_user),
+):
+    _require_seller(current_user)
+    rows, errors = await _bulk_rows(request, product_models.ProductImport)
+    created = await product_repo.create_products(
+        [
+            product_models.ProductCreate(seller_id=current_user.id, **row.model_dump())
+            for _, row in rows
+        ]
+    )
+    return product_models.ProductBulkResult(items=created, errors=errors)
+
+
+# PUT /products/bulk - Update many of the seller's products
+@router.put(
+    "/products/bulk",
+    response_model=product_models.ProductBulkResult,
+    dependencies=[Depends(check_machine_access)],
+)
+async def update_products(
+    request: Request,
+    product_repo: ProductRepository = Depends(get_product_repository),
+    current_user: User = Depends(auth.get_current_user),
+):
+    _require_seller(current_user)
+    rows, errors = await _bulk_rows(request, product_models.ProductBulkUpdate)
+    return await bulk.apply_to_owned(
+        product_repo, current_user.id, rows, errors, product_repo.update_products
+    )
+
+
+# POST /products/restock - Add stock to many of the seller's products
+@router.post(
+    "/products/restock",
+    response_model=product_models.ProductBulkResult,
+    dependencies=[Depends(check_machine_access)],
+)
+async def restock_products(
+    request: Request,
+    product_repo: ProductRepository = Depends(get_product_repository),
+    current_user: User = Depends(auth.get_current_user),
+):
+    _require_seller(current_user)
+    rows, errors = await _bulk_rows(request, product_models.ProductRestock)
+    return await bulk.apply_to_owned(
+        product_repo, current_user.id, rows, errors, product_repo.restock_products
+    )
+
+
+@router.put("/products/{product_id}", dependencies=[Depends(check_machine_access)])
 async def update_product(
     product_id: UUID,
     product: ProductUpdate,
@@ -59,16 +234,18 @@ async def update_product(
             detail="You are not authorized to perform this action.",
         )
     existing_product = await product_repo.get_product_by_id(product_id)
+    if existing_product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
     if existing_product.seller_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to update this product.",
         )
-    updated_product =await product_repo.update_product(product_id, product)
+    updated_product = await product_repo.update_product(product_id, product)
     return updated_product
 
 
-@router.delete("/products/{product_id}")
+@router.delete("/products/{product_id}", dependencies=[Depends(check_machine_access)])
 async def delete_product(
     product_id: UUID,
     product_repo: ProductRepository = Depends(get_product_repository),
@@ -80,6 +257,8 @@ async def delete_product(
             detail="You are not authorized to perform this action.",
         )
     existing_product = await product_repo.get_product_by_id(product_id)
+    if existing_product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
     if existing_product.seller_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
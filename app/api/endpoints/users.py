@@ -3,8 +3,10 @@ from sqlalchemy import delete, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.api import deps
-from app.core.security import get_password_hash
+from app.core.security import get_password_hash_async
 from app.db.sql.models import User
+from app.errors import PasswordHashingBusyError
+from app.users.cache import invalidate_user
 from app.schemas.requests import UserCreateRequest, UserUpdateRequest
 from app.schemas.responses import UserResponse
 
@@ -13,9 +15,9 @@ router = APIRouter()
 
 @router.get("", response_model=UserResponse)
 async def read_current_user(
-    current_user: User = Depends(deps.get_current_user),
+    current_user: User = Depends(deps.get_current_user_full),
 ):
-    """Get current user"""
+    """Get current user - with the deposit, so never from the user cache"""
     return UserResponse.model_validate(current_user)
 
 
@@ -27,6 +29,7 @@ async def delete_current_user(
     """Delete current user"""
     await session.execute(delete(User).where(User.id == current_user.id))
     await session.commit()
+    invalidate_user(current_user.id)
 
 
 @router.patch("", status_code=201)
@@ -42,6 +45,7 @@ async def update_current_user(
         .values(**update_user_request.model_dump())
     )
     await session.commit()
+    invalidate_user(current_user.id)
 
 
 @router.post("", response_model=UserResponse)
@@ -55,12 +59,18 @@ async def register_new_user(
     )
     if result.scalars().first() is not None:
         raise HTTPException(status_code=400, detail="Cannot use this username")
+    try:
+        password = await get_password_hash_async(new_user.password)
+    except PasswordHashingBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     user = User(
         username=new_user.username,
-        password=get_password_hash(new_user.password),
+        password=password,
         role=new_user.role,
     )
     session.add(user)
     await session.commit()
+    # the deposit is computed by the database, load it before serializing
+    await session.refresh(user, ["deposit"])
 
     return UserResponse.model_validate(user)
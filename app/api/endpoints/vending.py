@@ -1,23 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
 from app.api.auth import get_current_user
 from app.db.sql.models import User
 from app.errors import (
+    ConcurrentUpdateError,
+    IdempotencyKeyInUseError,
     InvalidRoleError,
     NotEnoughChangeError,
     NotEnoughMoneyError,
     NotEnoughProductError,
     ProductNotFoundError,
+    TransactionAbortedError,
     UserNotFoundError,
 )
 
-from app.schemas.requests import BuyProductRequest, DepositRequest
+from app.schemas.requests import (
+    BatchDepositRequest,
+    BuyProductRequest,
+    DepositRequest,
+)
 from app.users.models import UserDeposit, UserRead, UserReadFull
 
-from app.api.deps import get_vending_service, VendingService
-from app.vending.models import BuyProduct
+from app.api.deps import check_machine_access, get_vending_service, VendingService
+from app.vending.idempotency import (
+    IdempotencyRepository,
+    fingerprint,
+    get_idempotency_repository,
+    run_idempotent,
+)
+from app.vending.models import BatchDeposit, BuyProduct
+
 
 # Create a FastAPI router for vending machine operations
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(check_machine_access)])
 
 # Define a list of available coin values
 
@@ -27,19 +43,71 @@ router = APIRouter()
 )
 async def deposit_coins(
     request: DepositRequest,
+    http_request: Request,
     current_user: UserRead = Depends(get_current_user),
     vending_service: VendingService = Depends(get_vending_service),
+    idempotency: IdempotencyRepository = Depends(get_idempotency_repository),
+    idempotency_key: Optional[str] = Header(None, max_length=255),
 ):
-    req = UserDeposit(
-        coin=request.coin,
-        user_id=current_user.id,
+    async def deposit():
+        req = UserDeposit(
+            coin=request.coin,
+            user_id=current_user.id,
+        )
+        try:
+            resp = await vending_service.deposit_coins(req)
+        except InvalidRoleError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except (ConcurrentUpdateError, IdempotencyKeyInUseError) as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except TransactionAbortedError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+        return resp
+
+    return await run_idempotent(
+        idempotency,
+        current_user.id,
+        idempotency_key,
+        fingerprint(http_request, request),
+        deposit,
     )
-    try:
-        resp = await vending_service.deposit_coins(req)
-    except InvalidRoleError as e:
-        raise HTTPException(status_code=400, detail=str(e))
 
-    return resp
+
+@router.post(
+    "/deposit/batch",
+)
+async def deposit_coin_batch(
+    request: BatchDepositRequest,
+    http_request: Request,
+    current_user: UserRead = Depends(get_current_user),
+    vending_service: VendingService = Depends(get_vending_service),
+    idempotency: IdempotencyRepository = Depends(get_idempotency_repository),
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+):
+    async def deposit():
+        req = BatchDeposit(
+            coins=request.coins,
+            user_id=current_user.id,
+        )
+        try:
+            resp = await vending_service.deposit_coin_batch(req)
+        except (InvalidRoleError, UserNotFoundError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except IdempotencyKeyInUseError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except TransactionAbortedError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+        return resp
+
+    return await run_idempotent(
+        idempotency,
+        current_user.id,
+        idempotency_key,
+        fingerprint(http_request, request),
+        deposit,
+    )
 
 
 @router.post(
@@ -47,29 +115,45 @@ async def deposit_coins(
 )
 async def buy_product(
     request: BuyProductRequest,
+    http_request: Request,
     current_user: UserRead = Depends(get_current_user),
     vending_service: VendingService = Depends(get_vending_service),
+    idempotency: IdempotencyRepository = Depends(get_idempotency_repository),
+    idempotency_key: Optional[str] = Header(None, max_length=255),
 ):
-    try:
-        req = BuyProduct(
-            product_id=request.product_id,
-            amount=request.amount,
-            user_id=current_user.id,
-        )
-        res = await vending_service.buy_product(req)
-    except (
-        UserNotFoundError,
-        ProductNotFoundError,
-        NotEnoughProductError,
-        NotEnoughMoneyError,
-        NotEnoughChangeError,
-    ) as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    async def buy():
+        try:
+            req = BuyProduct(
+                product_id=request.product_id,
+                amount=request.amount,
+                user_id=current_user.id,
+            )
+            res = await vending_service.buy_product(req)
+        except (
+            UserNotFoundError,
+            ProductNotFoundError,
+            NotEnoughProductError,
+            NotEnoughMoneyError,
+            NotEnoughChangeError,
+        ) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except (ConcurrentUpdateError, IdempotencyKeyInUseError) as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except TransactionAbortedError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="Internal Server Error")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+        return res
 
-    return res
+    return await run_idempotent(
+        idempotency,
+        current_user.id,
+        idempotency_key,
+        fingerprint(http_request, request),
+        buy,
+    )
 
 
 @router.post(
@@ -83,5 +167,9 @@ async def reset_user_deposit(
         await vending_service.reset_user_deposit(current_user.id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except ConcurrentUpdateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except TransactionAbortedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
     return {"message": "success"}
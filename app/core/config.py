@@ -24,9 +24,9 @@ Note, complex types like lists are read as json-encoded strings.
 import tomllib
 from functools import cached_property
 from pathlib import Path
-from typing import Literal
+from typing import Literal, Optional
 
-from pydantic import AnyHttpUrl, PostgresDsn, computed_field
+from pydantic import AnyHttpUrl, PostgresDsn, computed_field, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 PROJECT_DIR = Path(__file__).parent.parent.parent
@@ -44,7 +44,12 @@ class Settings(BaseSettings):
     BACKEND_CORS_ORIGINS: list[AnyHttpUrl] = []
     ALLOWED_HOSTS: list[str] = ["localhost", "127.0.0.1"]
 
-    LOGLEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "DEBUG"
+    LOGLEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "INFO"
+    LOG_FORMAT: Literal["json", "text"] = "json"
+    # records waiting for the logging thread before new ones are dropped
+    LOG_QUEUE_SIZE: int = 10000
+    # fraction of records below WARNING kept per logger, e.g. {"app.vending": 0.1}
+    LOG_SAMPLING: dict[str, float] = {}
     # PROJECT NAME, VERSION AND DESCRIPTION
     PROJECT_NAME: str = PYPROJECT_CONTENT["name"]
     VERSION: str = PYPROJECT_CONTENT["version"]
@@ -57,9 +62,99 @@ class Settings(BaseSettings):
     DATABASE_PORT: int
     DATABASE_DB: str
 
+    # CONNECTION POOL (per worker)
+    # workers * (size + overflow) must stay below Postgres max_connections
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 10
+    DATABASE_POOL_TIMEOUT: float = 30.0
+    DATABASE_POOL_RECYCLE: int = 1800
+    # prepared statements cached per connection by asyncpg, 0 behind pgbouncer
+    DATABASE_STATEMENT_CACHE_SIZE: int = 100
+
+    # READ REPLICA (optional, same user, password and database as the primary)
+    # read-only dependencies use it while its replay lag is within the bound
+    # and fall back to the primary otherwise
+    DATABASE_REPLICA_HOSTNAME: Optional[str] = None
+    DATABASE_REPLICA_PORT: Optional[int] = None
+    DATABASE_REPLICA_MAX_LAG_SECONDS: float = 1.0
+    DATABASE_REPLICA_CHECK_INTERVAL_SECONDS: float = 0.5
+    # testing only - a database that is not in recovery, like the replica
+    # service of docker-compose.yml (a second instance that does not
+    # replicate), counts as a replica without lag instead of an unhealthy one
+    DATABASE_REPLICA_ALLOW_PRIMARY: bool = False
+
     # VENDING MACHINE ID
     VENDING_MACHINE_ID: str
 
+    # VENDING MACHINE COIN STORAGE
+    # "sql" - every coin is written to the database in the request
+    # "memory" - coins are counted in process and flushed in the background,
+    # refused unless a single worker serves the machines
+    VENDING_MACHINE_BACKEND: Literal["sql", "memory"] = "sql"
+    # uvicorn workers - uvicorn reads the same variable as its --workers default
+    WEB_CONCURRENCY: int = 1
+    COIN_FLUSH_INTERVAL_SECONDS: float = 1.0
+    COIN_FLUSH_MAX_PENDING: int = 100
+
+    # change the machine can pay is indexed for remainders up to this amount,
+    # larger ones are only checked when the purchase runs
+    CHANGE_INDEX_MAX_AMOUNT: int = 5000
+
+    # PASSWORD HASHING EXECUTOR
+    # bcrypt runs off the event loop in a dedicated pool - "thread" is enough
+    # as bcrypt releases the GIL, "process" isolates it completely
+    PASSWORD_HASH_EXECUTOR: Literal["thread", "process"] = "thread"
+    PASSWORD_HASH_WORKERS: int = 2
+    # requests waiting for a worker before new ones are rejected
+    PASSWORD_HASH_MAX_QUEUE: int = 64
+
+    # AUTHENTICATED USER CACHE (per worker)
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL_SECONDS: float = 30.0
+
+    # SERIALIZED PRODUCT CATALOG CACHE (per worker)
+    CATALOG_CACHE_TTL_SECONDS: float = 5.0
+
+    # rows accepted by one bulk product import, update or restock
+    PRODUCT_BULK_MAX_ROWS: int = 10000
+
+    # UNITS OF WORK
+    # per-transaction lock_timeout of vending operations, 0 waits forever
+    DATABASE_LOCK_TIMEOUT_MS: int = 5000
+    # attempts of an operation aborted as a deadlock or serialization failure
+    TRANSACTION_MAX_ATTEMPTS: int = 3
+    TRANSACTION_RETRY_BACKOFF_SECONDS: float = 0.01
+
+    # ROW CONCURRENCY
+    # "pessimistic" - rows are locked with SELECT ... FOR UPDATE before writing
+    # "optimistic" - rows are read without locks and written with
+    # UPDATE ... WHERE version = :v, conflicting operations are retried
+    # deposits are kept in the ledger and never locked, in both modes
+    CONCURRENCY_MODE: Literal["pessimistic", "optimistic"] = "pessimistic"
+    OPTIMISTIC_MAX_RETRIES: int = 5
+
+    # DEPOSIT LEDGER
+    # how often entries are rolled into balance snapshots
+    LEDGER_COMPACTION_INTERVAL_SECONDS: float = 60.0
+
+    # STOCK LEASES
+    # 0 disables leasing. Otherwise a worker takes blocks of this many units
+    # of a product out of `amount_available` and sells them without locking
+    # the product row; unsold units go back when the lease expires
+    STOCK_LEASE_SIZE: int = 0
+    STOCK_LEASE_SECONDS: float = 30.0
+    STOCK_LEASE_RETURN_INTERVAL_SECONDS: float = 5.0
+
+    # responses kept for retries sent with the same Idempotency-Key
+    IDEMPOTENCY_KEY_TTL_SECONDS: float = 86400.0
+    IDEMPOTENCY_PURGE_INTERVAL_SECONDS: float = 3600.0
+
+    # /debug endpoints with cache and database statistics, for operators only:
+    # requests must send DEBUG_TOKEN in the X-Debug-Token header, and without
+    # a token every request is refused
+    DEBUG_ENDPOINTS: bool = False
+    DEBUG_TOKEN: Optional[str] = None
+
     @computed_field
     @cached_property
     def DEFAULT_SQLALCHEMY_DATABASE_URI(self) -> str:
@@ -74,6 +169,31 @@ class Settings(BaseSettings):
             )
         )
 
+    @computed_field
+    @cached_property
+    def REPLICA_SQLALCHEMY_DATABASE_URI(self) -> Optional[str]:
+        if self.DATABASE_REPLICA_HOSTNAME is None:
+            return None
+        return str(
+            PostgresDsn.build(
+                scheme="postgresql+asyncpg",
+                username=self.DATABASE_USER,
+                password=self.DATABASE_PASSWORD,
+                host=self.DATABASE_REPLICA_HOSTNAME,
+                port=self.DATABASE_REPLICA_PORT or self.DATABASE_PORT,
+                path=self.DATABASE_DB,
+            )
+        )
+
+    @model_validator(mode="after")
+    def check_coin_backend(self) -> "Settings":
+        # every worker would keep its own coin counts and pay them out twice
+        if self.VENDING_MACHINE_BACKEND == "memory" and self.WEB_CONCURRENCY > 1:
+            raise ValueError(
+                'VENDING_MACHINE_BACKEND="memory" requires WEB_CONCURRENCY=1'
+            )
+        return self
+
     model_config = SettingsConfigDict(
         env_file=f"{PROJECT_DIR}/.env", case_sensitive=True
     )
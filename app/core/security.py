@@ -1,12 +1,16 @@
 """Black-box security shortcuts to generate JWT tokens and password hashing and verifcation."""
 
+import asyncio
 import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
 
 import jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
 from app.core import config
+from app.errors import PasswordHashingBusyError
 from app.schemas.responses import AccessTokenResponse
 
 JWT_ALGORITHM = "HS256"
@@ -24,15 +28,20 @@ class JWTTokenPayload(BaseModel):
     refresh: bool
     issued_at: int
     expires_at: int
+    # machine of the fleet the user belongs to
+    vending_id: str | None = None
 
 
-def create_jwt_token(subject: str | int, exp_secs: int, refresh: bool):
+def create_jwt_token(
+    subject: str | int, exp_secs: int, refresh: bool, vending_id: str | None = None
+):
     """Creates jwt access or refresh token for user.
 
     Args:
         subject: anything unique to user, id or email etc.
         exp_secs: expire time in seconds
         refresh: if True, this is refresh token
+        vending_id: vending machine the user belongs to
     """
 
     issued_at = int(time.time())
@@ -44,6 +53,8 @@ def create_jwt_token(subject: str | int, exp_secs: int, refresh: bool):
         "sub": subject,
         "refresh": refresh,
     }
+    if vending_id is not None:
+        to_encode["vending_id"] = vending_id
     encoded_jwt = jwt.encode(
         to_encode,
         key=config.settings.SECRET_KEY,
@@ -52,13 +63,13 @@ def create_jwt_token(subject: str | int, exp_secs: int, refresh: bool):
     return encoded_jwt, expires_at, issued_at
 
 
-def generate_access_token_response(subject: str | int):
+def generate_access_token_response(subject: str | int, vending_id: str | None = None):
     """Generate tokens and return AccessTokenResponse"""
     access_token, expires_at, issued_at = create_jwt_token(
-        subject, ACCESS_TOKEN_EXPIRE_SECS, refresh=False
+        subject, ACCESS_TOKEN_EXPIRE_SECS, refresh=False, vending_id=vending_id
     )
     refresh_token, refresh_expires_at, refresh_issued_at = create_jwt_token(
-        subject, REFRESH_TOKEN_EXPIRE_SECS, refresh=True
+        subject, REFRESH_TOKEN_EXPIRE_SECS, refresh=True, vending_id=vending_id
     )
     return AccessTokenResponse(
         token_type="Bearer",
@@ -71,6 +82,21 @@ def generate_access_token_response(subject: str | int):
     )
 
 
+def read_vending_claim(token: str) -> str | None:
+    """Vending machine claim of a token, None when missing or not verifiable
+
+    Only picks the machine a request is routed to - authentication still goes
+    through `get_current_user`.
+    """
+    try:
+        payload = jwt.decode(
+            token, config.settings.SECRET_KEY, algorithms=[JWT_ALGORITHM]
+        )
+    except jwt.PyJWTError:
+        return None
+    return payload.get("vending_id")
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifies plain and hashed password matches
 
@@ -87,3 +113,87 @@ def get_password_hash(password: str) -> str:
     It takes about 0.3s for default 12 rounds of SECURITY_BCRYPT_DEFAULT_ROUNDS.
     """
     return PWD_CONTEXT.hash(password)
+
+
+class PasswordHasher:
+    """Runs bcrypt in a dedicated bounded pool so it never blocks the event loop.
+
+    At most `workers` hashes run at a time; up to `max_queue` more wait for a
+    worker and anything beyond that is rejected with `PasswordHashingBusyError`,
+    so a login storm only slows down logins.
+    """
+
+    def __init__(self, kind: str, workers: int, max_queue: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password-hash"
+                )
+            self._semaphore = asyncio.Semaphore(self.workers)
+        return self._executor
+
+    async def run(self, fn: Callable, *args):
+        executor = self._get_executor()
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise PasswordHashingBusyError()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict[str, int | str]:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+password_hasher = PasswordHasher(
+    kind=config.settings.PASSWORD_HASH_EXECUTOR,
+    workers=config.settings.PASSWORD_HASH_WORKERS,
+    max_queue=config.settings.PASSWORD_HASH_MAX_QUEUE,
+)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """`verify_password` on the password hashing pool"""
+    return await password_hasher.run(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """`get_password_hash` on the password hashing pool"""
+    return await password_hasher.run(get_password_hash, password)
@@ -2,14 +2,120 @@
 SQLAlchemy async engine and sessions tools
 
 https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html
+
+Every worker has its own pool, so up to
+`workers * (DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW)` connections are
+opened - keep that below Postgres `max_connections`. With a read replica
+configured, the same number again is opened to the replica.
 """
 
+import time
+
+from sqlalchemy import exc
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from app.core import config
+from app.core import config, metrics
 
 sqlalchemy_database_uri = config.settings.DEFAULT_SQLALCHEMY_DATABASE_URI
+replica_database_uri = config.settings.REPLICA_SQLALCHEMY_DATABASE_URI
+
+POOL_CHECKOUT_SECONDS = metrics.Histogram(
+    "db_pool_checkout_duration_seconds",
+    "Time spent waiting for a connection from the pool",
+    ("database",),
+)
+POOL_CHECKOUT_TIMEOUTS = metrics.Counter(
+    "db_pool_checkout_timeouts",
+    "Checkouts that gave up after DATABASE_POOL_TIMEOUT",
+    ("database",),
+)
+POOL_CONNECTIONS = metrics.Gauge(
+    "db_pool_connections", "Connections of the pool by state", ("database", "state")
+)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool recording how long checkouts take (wait + pre-ping)"""
+
+    database = "primary"
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.labels(self.database).inc()
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.labels(self.database).observe(
+                time.perf_counter() - start
+            )
+
+
+class ReplicaQueuePool(TimedQueuePool):
+    database = "replica"
 
 
-async_engine = create_async_engine(sqlalchemy_database_uri, pool_pre_ping=True)
+def _create_engine(uri: str, poolclass: type[TimedQueuePool]):
+    return create_async_engine(
+        uri,
+        poolclass=poolclass,
+        pool_pre_ping=True,
+        pool_size=config.settings.DATABASE_POOL_SIZE,
+        max_overflow=config.settings.DATABASE_MAX_OVERFLOW,
+        pool_timeout=config.settings.DATABASE_POOL_TIMEOUT,
+        pool_recycle=config.settings.DATABASE_POOL_RECYCLE,
+        connect_args={
+            "prepared_statement_cache_size": (
+                config.settings.DATABASE_STATEMENT_CACHE_SIZE
+            )
+        },
+    )
+
+
+async_engine = _create_engine(sqlalchemy_database_uri, TimedQueuePool)
 async_session = async_sessionmaker(async_engine, expire_on_commit=False)
+
+# None without a replica - reads then go to the primary
+read_engine = (
+    _create_engine(replica_database_uri, ReplicaQueuePool).execution_options(
+        postgresql_readonly=True
+    )
+    if replica_database_uri
+    else None
+)
+async_read_session = (
+    async_sessionmaker(read_engine, expire_on_commit=False) if read_engine else None
+)
+
+ENGINES = {"primary": async_engine, "replica": read_engine}
+
+
+def pool_stats(database: str = "primary") -> dict:
+    """Current state of a connection pool of this worker"""
+    pool = ENGINES[database].pool
+    checkout = POOL_CHECKOUT_SECONDS.labels(database)
+    return {
+        "size": pool.size(),
+        "max_overflow": config.settings.DATABASE_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        # starts at -size and grows past 0 once overflow connections are open
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": checkout.count,
+        "checkout_wait_seconds_total": checkout.sum,
+        "checkout_wait_seconds_avg": checkout.sum / checkout.count
+        if checkout.count
+        else 0.0,
+        "checkout_timeouts": POOL_CHECKOUT_TIMEOUTS.labels(database).value,
+    }
+
+
+for _database, _engine in ENGINES.items():
+    if _engine is None:
+        continue
+    for _state in ("checked_out", "idle", "overflow"):
+        POOL_CONNECTIONS.labels(_database, _state).set_function(
+            lambda database=_database, state=_state: pool_stats(database)[state]
+        )
@@ -0,0 +1,228 @@
+"""
+Deposit ledger.
+
+A deposit is never updated in place: every coin put in, purchase and refund
+appends a `LedgerEntry`, and `User.deposit` is the latest `BalanceSnapshot`
+plus the entries after it. Appending does not wait on other writers:
+
+- credits ("coin_in") are plain inserts
+- debits ("sale", "refund") are inserted only when the balance covers them,
+  numbered with the next `debit_seq` of the user - two debits checked against
+  the same balance collide on the unique (user_id, debit_seq) index, only the
+  first one is inserted and the other operation is retried
+
+The compactor rolls the entries of every user into a new snapshot, so a
+balance never sums more than about two intervals of entries. Ids are taken
+when a row is inserted, not when it commits, so a snapshot must not cover an
+id that may still commit. Each run notes the highest committed id and the
+`pg_snapshot_xmax` of that moment; the next run compacts up to it only once
+`pg_snapshot_xmin` has passed that xmax - every transaction that could hold a
+lower id has then ended. Runs of all workers take one advisory lock, a
+worker that does not get it skips its turn.
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import (
+    BigInteger,
+    ClauseElement,
+    String,
+    and_,
+    cast,
+    func,
+    literal,
+    select,
+    true,
+)
+from sqlalchemy.dialects.postgresql import insert
+
+from app.core import metrics
+from app.core.session import async_session
+from app.db.sql.models import BalanceSnapshot, LedgerEntry, User
+from app.log import get_logger
+from app.vending.models import Change
+
+log = get_logger(__name__)
+
+LEDGER_SNAPSHOTS = metrics.Counter(
+    "ledger_snapshots", "Balance snapshots written by the ledger compactor"
+)
+
+# pg_try_advisory_xact_lock key of the compactor
+COMPACTION_LOCK = 0x6C6564676572
+
+ENTRY_COLUMNS = (
+    "user_id",
+    "vending_id",
+    "kind",
+    "amount",
+    "debit_seq",
+    "product_id",
+    "quantity",
+    "coins",
+    "created_at",
+)
+
+
+def next_debit_seq(user_id):
+    return (
+        func.coalesce(
+            select(func.max(LedgerEntry.debit_seq))
+            .where(LedgerEntry.user_id == user_id)
+            .correlate_except(LedgerEntry)
+            .scalar_subquery(),
+            0,
+        )
+        + 1
+    )
+
+
+def _sql(value, type_):
+    if isinstance(value, ClauseElement) or hasattr(value, "__clause_element__"):
+        return value
+    # parameters in a SELECT list have no type of their own
+    return cast(literal(value, type_), type_)
+
+
+def _append(where, coins: Optional[Change], **values):
+    values["coins"] = {c: n for c, n in coins.nonzero().items()} if coins else None
+    values["created_at"] = datetime.utcnow()
+    columns = LedgerEntry.__table__.c
+    rows = select(
+        *(_sql(values.get(name), columns[name].type) for name in ENTRY_COLUMNS)
+    ).where(where)
+    return insert(LedgerEntry).from_select(ENTRY_COLUMNS, rows)
+
+
+def credit(user_id, vending_id, amount, where=true(), coins: Optional[Change] = None):
+    """Append a "coin_in" entry for each row `where` selects"""
+    return _append(
+        where,
+        coins,
+        user_id=user_id,
+        vending_id=vending_id,
+        kind="coin_in",
+        amount=amount,
+    )
+
+
+def debit(
+    kind: str,
+    user_id,
+    vending_id,
+    amount,
+    balance,
+    debit_seq,
+    where=true(),
+    product_id=None,
+    quantity=None,
+    coins: Optional[Change] = None,
+):
+    """Append a debit of `amount` when `balance` covers it
+
+    Nothing is inserted when another debit of the user took `debit_seq`.
+    """
+    return _append(
+        and_(balance >= amount, where),
+        coins,
+        user_id=user_id,
+        vending_id=vending_id,
+        kind=kind,
+        amount=-amount,
+        debit_seq=debit_seq,
+        product_id=product_id,
+        quantity=quantity,
+    ).on_conflict_do_nothing(
+        index_elements=[LedgerEntry.user_id, LedgerEntry.debit_seq]
+    )
+
+
+def _xid(value):
+    # xid8 has no driver type - read it as a number
+    return cast(cast(value, String), BigInteger)
+
+
+def _horizon_statement():
+    snapshot = func.pg_current_snapshot()
+    return select(
+        func.coalesce(func.max(LedgerEntry.id), 0).label("last_entry_id"),
+        _xid(func.pg_snapshot_xmin(snapshot)).label("snapshot_xmin"),
+        _xid(func.pg_snapshot_xmax(snapshot)).label("snapshot_xmax"),
+    )
+
+
+def _compact_statement(horizon: int):
+    latest = (
+        select(BalanceSnapshot.last_entry_id, BalanceSnapshot.deposit)
+        .where(BalanceSnapshot.user_id == User.id)
+        .order_by(BalanceSnapshot.last_entry_id.desc())
+        .limit(1)
+        .lateral("latest")
+    )
+    rows = (
+        select(
+            User.id,
+            func.max(LedgerEntry.id),
+            func.coalesce(latest.c.deposit, 0) + func.sum(LedgerEntry.amount),
+            literal(datetime.utcnow(), BalanceSnapshot.created_at.type),
+        )
+        .select_from(User)
+        .outerjoin(latest, true())
+        .join(
+            LedgerEntry,
+            and_(
+                LedgerEntry.user_id == User.id,
+                LedgerEntry.id > func.coalesce(latest.c.last_entry_id, 0),
+                LedgerEntry.id <= horizon,
+            ),
+        )
+        .group_by(User.id, latest.c.deposit)
+    )
+    return insert(BalanceSnapshot).from_select(
+        ["user_id", "last_entry_id", "deposit", "created_at"], rows
+    )
+
+
+class LedgerCompactor:
+    def __init__(self):
+        # (last_entry_id, xmax) noted by a previous run, not compacted yet
+        self.pending: Optional[tuple[int, int]] = None
+
+    async def run(self) -> int:
+        """Snapshot the balances up to the horizon noted by the previous run"""
+        written = 0
+        async with async_session() as session:
+            locked = await session.execute(
+                select(func.pg_try_advisory_xact_lock(COMPACTION_LOCK))
+            )
+            if not locked.scalar_one():
+                return 0
+            now = (await session.execute(_horizon_statement())).one()
+            if self.pending is not None and now.snapshot_xmin >= self.pending[1]:
+                q = await session.execute(_compact_statement(self.pending[0]))
+                written = q.rowcount
+                self.pending = None
+            if self.pending is None:
+                self.pending = (now.last_entry_id, now.snapshot_xmax)
+            await session.commit()
+        LEDGER_SNAPSHOTS.inc(written)
+        return written
+
+
+compactor = LedgerCompactor()
+
+
+async def compact_ledger() -> int:
+    return await compactor.run()
+
+
+async def compact_ledger_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            snapshots = await compact_ledger()
+            log.info("Wrote %s balance snapshots", snapshots)
+        except Exception:
+            log.exception("Compacting the ledger failed")
@@ -0,0 +1,103 @@
+"""
+Row-lock instrumentation.
+
+`execute_locked` runs a `SELECT ... FOR UPDATE` (or a statement taking row
+locks) and records how long it took, labeled by table and call site. The
+time includes one round trip, but under contention it is dominated by the
+wait for the row lock, which is what the histogram is for. It also checks
+that a transaction locks its rows in `LOCK_ORDER`, the order that keeps two
+transactions from waiting on each other in a cycle.
+
+`lock_waits` samples `pg_locks`/`pg_stat_activity` for the current wait
+graph - who waits, on which relation/tuple, and which backends block it.
+"""
+
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core import metrics
+
+LOCK_WAIT_SECONDS = metrics.Histogram(
+    "db_row_lock_wait_seconds",
+    "Duration of row-locking statements by table and call site",
+    ("table", "site"),
+)
+
+
+# a user before a product before its stock leases before the coins of a machine
+LOCK_ORDER = ("users", "products", "stock_leases", "vending_machine_coins")
+LOCKED_UP_TO = "locked_up_to"
+
+
+@event.listens_for(Session, "after_begin")
+def _reset_lock_order(session: Session, transaction, connection):
+    session.info.pop(LOCKED_UP_TO, None)
+
+
+def _check_lock_order(session: AsyncSession, table: str, site: str):
+    position = LOCK_ORDER.index(table)
+    # a statement outside a transaction begins a new one, with nothing locked yet
+    locked_up_to = session.info.get(LOCKED_UP_TO) if session.in_transaction() else None
+    assert locked_up_to is None or locked_up_to <= position, (
+        f"{site} locks {table} after {LOCK_ORDER[locked_up_to]}, "
+        f"against LOCK_ORDER {LOCK_ORDER}"
+    )
+    session.info[LOCKED_UP_TO] = position
+
+
+async def execute_locked(session: AsyncSession, statement, table: str, site: str):
+    _check_lock_order(session, table, site)
+    start = time.perf_counter()
+    try:
+        return await session.execute(statement)
+    finally:
+        LOCK_WAIT_SECONDS.labels(table, site).observe(time.perf_counter() - start)
+
+
+LOCK_WAITS_QUERY = text(
+    """
+    SELECT
+        a.pid,
+        a.state,
+        a.wait_event_type,
+        a.wait_event,
+        extract(epoch FROM now() - a.query_start) AS waiting_seconds,
+        pg_blocking_pids(a.pid) AS blocked_by,
+        l.locktype,
+        l.mode,
+        l.relation::regclass::text AS relation,
+        l.page,
+        l.tuple,
+        a.query
+    FROM pg_stat_activity a
+    LEFT JOIN pg_locks l ON l.pid = a.pid AND NOT l.granted
+    WHERE a.datname = current_database()
+      AND (
+        cardinality(pg_blocking_pids(a.pid)) > 0
+        OR a.pid IN (
+            SELECT unnest(pg_blocking_pids(w.pid)) FROM pg_stat_activity w
+        )
+      )
+    ORDER BY waiting_seconds DESC NULLS LAST
+    """
+)
+
+
+async def lock_waits(session: AsyncSession) -> dict:
+    """Current lock wait graph: waiting backends and the backends blocking them"""
+    q = await session.execute(LOCK_WAITS_QUERY)
+    waiting, blocking = [], []
+    for row in q.mappings():
+        entry = dict(row)
+        entry["blocked_by"] = list(entry["blocked_by"] or [])
+        if entry["waiting_seconds"] is not None:
+            entry["waiting_seconds"] = float(entry["waiting_seconds"])
+        (waiting if entry["blocked_by"] else blocking).append(entry)
+    return {
+        "waiting": waiting,
+        "blocking": blocking,
+        "edges": [[w["pid"], pid] for w in waiting for pid in w["blocked_by"]],
+    }
@@ -16,13 +16,23 @@ alembic upgrade head
 import uuid
 from datetime import datetime
 
-from sqlalchemy import JSON, Column, DateTime, ForeignKey, Integer, String
-from sqlalchemy.orm import DeclarativeBase, relationship
-
-
-import uuid
-from sqlalchemy import Column, String, DateTime
+from sqlalchemy import (
+    BigInteger,
+    CheckConstraint,
+    Column,
+    DateTime,
+    ForeignKey,
+    Identity,
+    Index,
+    Integer,
+    JSON,
+    String,
+    func,
+    select,
+    text,
+)
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import DeclarativeBase, column_property, relationship
 
 
 class Base(DeclarativeBase):
@@ -52,21 +62,40 @@ class User(BaseWithTimestamps):
         String(32), primary_key=True, nullable=False, unique=True, index=True
     )
     password = Column(String(128), nullable=False)
-    deposit = Column(Integer, nullable=False, default=0)
+    # `deposit` is derived from the ledger, see the end of this module
     role = Column(String(32), nullable=False)
     vending_id = Column(
         UUID,
         ForeignKey("vending_machines.id"),
         nullable=False,
         default=uuid.UUID("00000000-0000-0000-0000-000000000000"),
+        index=True,
     )
 
+    # bumped by every write, checked by optimistic writes
+    version = Column(Integer, nullable=False, server_default="1")
+
     products = relationship("Product", back_populates="seller")
     vending = relationship("VendingMachine", back_populates="users")
 
+    __mapper_args__ = {"version_id_col": version}
+
 
 class Product(BaseWithTimestamps):
     __tablename__ = "products"
+    __table_args__ = (
+        # keyset pagination per machine, per seller and over what is in stock
+        Index("ix_products_vending_created", "vending_id", "created_at", "id"),
+        Index("ix_products_seller_created", "seller_id", "created_at", "id"),
+        Index(
+            "ix_products_vending_in_stock",
+            "vending_id",
+            "created_at",
+            "id",
+            postgresql_where=text("amount_available > 0"),
+        ),
+        Index("ix_products_vending_cost", "vending_id", "cost"),
+    )
 
     amount_available = Column(Integer, nullable=False)
     cost = Column(Integer, nullable=False)
@@ -84,10 +113,154 @@ class Product(BaseWithTimestamps):
     )
     vending = relationship("VendingMachine", back_populates="products")
 
+    version = Column(Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
 
 class VendingMachine(BaseWithTimestamps):
     __tablename__ = "vending_machines"
-    # json field
-    status = Column(JSON, nullable=False)
     products = relationship("Product", back_populates="vending")
     users = relationship("User", back_populates="vending")
+    coins = relationship("VendingMachineCoin", back_populates="vending")
+
+
+class VendingMachineCoin(Base):
+    # one row per machine and denomination - coins are updated with relative
+    # increments so operations on different coins do not lock each other
+    __tablename__ = "vending_machine_coins"
+    __table_args__ = (CheckConstraint("count >= 0", name="ck_coin_count_positive"),)
+
+    vending_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("vending_machines.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    coin = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    vending = relationship("VendingMachine", back_populates="coins")
+
+
+class IdempotencyKey(Base):
+    # responses of requests sent with an `Idempotency-Key` header, replayed on
+    # retries until `expires_at`; `status_code` is NULL while in progress
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (Index("ix_idempotency_keys_expires_at", "expires_at"),)
+
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class LedgerEntry(Base):
+    # append-only history of deposits: "coin_in" credits, "sale" and "refund"
+    # debits; rows are never updated, so inserting one never waits on another
+    __tablename__ = "ledger_entries"
+    __table_args__ = (
+        Index("ix_ledger_entries_user_id_id", "user_id", "id"),
+        Index("ix_ledger_entries_created_at", "created_at"),
+        # debits of a user are numbered - two debits checked against the same
+        # balance get the same number and only one of them is inserted
+        Index("uq_ledger_entries_user_debit", "user_id", "debit_seq", unique=True),
+        CheckConstraint(
+            "kind IN ('coin_in', 'sale', 'refund')", name="ck_ledger_entries_kind"
+        ),
+    )
+
+    id = Column(BigInteger, Identity(), primary_key=True)
+    user_id = Column(
+        UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+    vending_id = Column(UUID(as_uuid=True), nullable=False)
+    kind = Column(String(16), nullable=False)
+    # change of the deposit, negative for debits
+    amount = Column(Integer, nullable=False)
+    debit_seq = Column(Integer, nullable=True)
+    # what was bought - no foreign key, the history outlives products
+    product_id = Column(UUID(as_uuid=True), nullable=True)
+    quantity = Column(Integer, nullable=True)
+    # coins put in, by denomination
+    coins = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class StockLease(Base):
+    # units of a product taken out of `amount_available` by one worker, sold
+    # without locking the product row and returned when the lease expires
+    __tablename__ = "stock_leases"
+    __table_args__ = (
+        Index("ix_stock_leases_expires_at", "expires_at"),
+        Index("ix_stock_leases_worker_id", "worker_id"),
+        CheckConstraint("units >= 0", name="ck_stock_leases_units_positive"),
+    )
+
+    id = Column(UUID(as_uuid=True), default=uuid.uuid4, primary_key=True)
+    product_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("products.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    vending_id = Column(UUID(as_uuid=True), nullable=False)
+    worker_id = Column(String(128), nullable=False)
+    # still unsold - decremented by every sale from the lease
+    units = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class BalanceSnapshot(Base):
+    # deposit of a user including every ledger entry up to `last_entry_id`,
+    # written by the compactor; the latest one is the starting point
+    __tablename__ = "balance_snapshots"
+
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    last_entry_id = Column(BigInteger, primary_key=True)
+    deposit = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+def _latest_snapshot(user_id, column):
+    return (
+        select(column)
+        .where(BalanceSnapshot.user_id == user_id)
+        .order_by(BalanceSnapshot.last_entry_id.desc())
+        .limit(1)
+        .correlate_except(BalanceSnapshot)
+        .scalar_subquery()
+    )
+
+
+def deposit_balance(user_id):
+    """Latest snapshot of the deposit plus the ledger entries after it"""
+    after = (
+        select(func.sum(LedgerEntry.amount))
+        .where(
+            LedgerEntry.user_id == user_id,
+            LedgerEntry.id
+            > func.coalesce(
+                _latest_snapshot(user_id, BalanceSnapshot.last_entry_id), 0
+            ),
+        )
+        .correlate_except(LedgerEntry)
+        .scalar_subquery()
+    )
+    return func.coalesce(
+        _latest_snapshot(user_id, BalanceSnapshot.deposit), 0
+    ) + func.coalesce(after, 0)
+
+
+User.deposit = column_property(deposit_balance(User.id).label("deposit"))
@@ -0,0 +1,111 @@
+"""
+Read replica routing.
+
+`ReplicaMonitor` measures the replay lag of the replica every
+`DATABASE_REPLICA_CHECK_INTERVAL_SECONDS`. Read-only sessions go to the
+replica while the last check is recent and the lag is within
+`DATABASE_REPLICA_MAX_LAG_SECONDS`; when the replica is behind, unreachable
+or not checked in time they go to the primary until it recovers.
+
+A replica that lost its connection to the primary has replayed everything it
+received and would report no lag - it only counts as caught up while its WAL
+receiver is streaming. A database that is not in recovery (a standalone or
+promoted server) replicates nothing and is not used either, unless
+`DATABASE_REPLICA_ALLOW_PRIMARY` is set for testing against one.
+"""
+
+import asyncio
+import math
+import time
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.session import async_read_session
+from app.log import get_logger
+
+log = get_logger(__name__)
+
+REPLICA_LAG_SECONDS = metrics.Gauge(
+    "db_replica_lag_seconds", "Replay lag of the read replica at the last check"
+)
+READ_SESSIONS = metrics.Counter(
+    "db_read_sessions", "Read-only sessions by the database serving them", ("database",)
+)
+
+LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN CASE WHEN :allow_primary THEN 0 END
+        WHEN NOT EXISTS (
+            SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'
+        ) THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+
+class ReplicaMonitor:
+    def __init__(
+        self,
+        session_factory: Optional[async_sessionmaker],
+        max_lag: float,
+        interval: float,
+        allow_primary: bool = False,
+    ):
+        self.session_factory = session_factory
+        self.max_lag = max_lag
+        self.interval = interval
+        self.allow_primary = allow_primary
+        # unknown until the first successful check
+        self.lag = math.inf
+        self.checked_at: Optional[float] = None
+
+    def usable(self) -> bool:
+        if self.session_factory is None or self.checked_at is None:
+            return False
+        # a check that is overdue counts as failed
+        if time.monotonic() - self.checked_at > 3 * self.interval:
+            return False
+        return self.lag <= self.max_lag
+
+    async def check(self):
+        try:
+            async with self.session_factory() as session:
+                q = await session.execute(
+                    LAG_QUERY, {"allow_primary": self.allow_primary}
+                )
+                lag = q.scalar_one()
+        except Exception:
+            log.warning("Read replica lag check failed", exc_info=True)
+            self.lag = math.inf
+        else:
+            self.lag = math.inf if lag is None else float(lag)
+        self.checked_at = time.monotonic()
+        REPLICA_LAG_SECONDS.set(self.lag if self.lag != math.inf else -1)
+
+    async def run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "configured": self.session_factory is not None,
+            "usable": self.usable(),
+            "lag_seconds": None if self.lag == math.inf else self.lag,
+            "max_lag_seconds": self.max_lag,
+        }
+
+
+replica_monitor = ReplicaMonitor(
+    async_read_session,
+    max_lag=settings.DATABASE_REPLICA_MAX_LAG_SECONDS,
+    interval=settings.DATABASE_REPLICA_CHECK_INTERVAL_SECONDS,
+    allow_primary=settings.DATABASE_REPLICA_ALLOW_PRIMARY,
+)
@@ -3,6 +3,7 @@ from collections.abc import AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.session import async_session
+from app.db.sql.replica import READ_SESSIONS, replica_monitor
 
 
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
@@ -15,3 +16,18 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
             raise e
         finally:
             await db_session.close()
+
+
+async def get_read_session() -> AsyncGenerator[AsyncSession, None]:
+    """Session for dependencies that only read - the replica while it is fresh"""
+    if replica_monitor.usable():
+        database, factory = "replica", replica_monitor.session_factory
+    else:
+        database, factory = "primary", async_session
+    READ_SESSIONS.labels(database).inc()
+    async with factory(info={"database": database}) as db_session:
+        yield db_session
+
+
+def is_replica(session: AsyncSession) -> bool:
+    return session.info.get("database") == "replica"
@@ -0,0 +1,100 @@
+"""
+Unit-of-work runner.
+
+Rows are always locked in `LOCK_ORDER` (enforced by `execute_locked`) - a user
+before a product before its stock leases before the coins of a machine - so two
+operations can wait on each other but never in a cycle. (Deposits live in the append-only ledger, vending operations do not
+lock users.) When Postgres still aborts a transaction as a deadlock (40P01) or a
+serialization failure (40001) the whole unit of work is rolled back and run
+again after a jittered exponential backoff.
+
+Every transaction of a unit of work gets `SET LOCAL lock_timeout`, so a
+stuck row lock fails the request instead of piling up connections behind it.
+Running out of attempts or hitting the lock timeout raises
+`TransactionAbortedError`.
+"""
+
+import asyncio
+import random
+from typing import Awaitable, Callable, TypeVar
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core import metrics
+from app.errors import TransactionAbortedError
+
+DEADLOCK_DETECTED = "40P01"
+SERIALIZATION_FAILURE = "40001"
+LOCK_NOT_AVAILABLE = "55P03"
+RETRYABLE = frozenset({DEADLOCK_DETECTED, SERIALIZATION_FAILURE})
+
+TRANSACTION_RETRIES = metrics.Counter(
+    "db_transaction_retries",
+    "Units of work re-run after a deadlock or serialization failure",
+    ("operation", "sqlstate"),
+)
+
+T = TypeVar("T")
+
+
+def sqlstate(error: DBAPIError):
+    return getattr(error.orig, "sqlstate", None)
+
+
+def _lock_timeout_statement(lock_timeout_ms: int):
+    return text(f"SET LOCAL lock_timeout = {int(lock_timeout_ms)}")
+
+
+@event.listens_for(Session, "after_begin")
+def _set_lock_timeout(session: Session, transaction, connection):
+    lock_timeout_ms = session.info.get("lock_timeout_ms")
+    if lock_timeout_ms:
+        connection.execute(_lock_timeout_statement(lock_timeout_ms))
+
+
+class TransactionRunner:
+    def __init__(
+        self,
+        session: AsyncSession,
+        lock_timeout_ms: int = 0,
+        max_attempts: int = 3,
+        backoff_seconds: float = 0.01,
+    ):
+        self.session = session
+        self.lock_timeout_ms = lock_timeout_ms
+        # the unit of work runs at least once, whatever the setting
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff_seconds = backoff_seconds
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter - retries of colliding transactions spread out
+        return random.uniform(0, self.backoff_seconds * 2**attempt)
+
+    async def run(self, operation: str, work: Callable[[], Awaitable[T]]) -> T:
+        self.session.info["lock_timeout_ms"] = self.lock_timeout_ms
+        try:
+            if self.lock_timeout_ms and self.session.in_transaction():
+                # begun before the unit of work (e.g. loading the current user)
+                await self.session.execute(
+                    _lock_timeout_statement(self.lock_timeout_ms)
+                )
+            for attempt in range(self.max_attempts):
+                try:
+                    return await work()
+                except DBAPIError as e:
+                    code = sqlstate(e)
+                    if code == LOCK_NOT_AVAILABLE:
+                        await self.session.rollback()
+                        raise TransactionAbortedError() from e
+                    if code not in RETRYABLE:
+                        raise
+                    await self.session.rollback()
+                    if attempt + 1 == self.max_attempts:
+                        raise TransactionAbortedError() from e
+                    TRANSACTION_RETRIES.labels(operation, code).inc()
+                    await asyncio.sleep(self._backoff(attempt))
+        finally:
+            self.session.info.pop("lock_timeout_ms", None)
@@ -48,8 +48,35 @@ class InvalidCostError(Exception):
         super().__init__(message)
         
         
+class PasswordHashingBusyError(Exception):
+    """Raised when too many password hashes are already waiting for a worker"""
+
+    def __init__(self, message="Too many login attempts, try again later"):
+        super().__init__(message)
+
+
 class InvalidRoleError(Exception):
     """Raised when when used is not valid"""
 
     def __init__(self, message="Invalid role"):
-        super().__init__(message)
\ No newline at end of file
+        super().__init__(message)
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a row changed between reading and writing it (optimistic mode)"""
+
+    def __init__(self, message="The resource was changed concurrently, try again"):
+        super().__init__(message)
+
+
+class TransactionAbortedError(Exception):
+    """Raised when a transaction kept deadlocking or waited too long for a lock"""
+
+    def __init__(self, message="Too much contention, try again later"):
+        super().__init__(message)
+
+
+class IdempotencyKeyInUseError(Exception):
+    """Raised when another request took the Idempotency-Key while this one retried"""
+
+    def __init__(self, message="The Idempotency-Key is in use by another request"):
+        super().__init__(message)
@@ -1,12 +1,126 @@
-from logging import getLogger
+"""
+Logging pipeline.
+
+Records are put on a bounded queue by the calling code and formatted and
+written by a `QueueListener` thread, so logging never blocks the event loop:
+
+- formatting is lazy - pass values as arguments (`log.info("x %s", x)`) or as
+  `extra` fields, the message is only built on the listener thread
+- output is one JSON object per line (`LOG_FORMAT=text` for local reading)
+- `LOG_SAMPLING` keeps only a fraction of the records below WARNING of a
+  logger, e.g. `{"app.vending.service": 0.01}`
+- when the queue is full records are dropped and counted, never waited on
+"""
+
+import atexit
+import json
 import logging
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
+from app.core import metrics
 from app.core.config import settings
 
-
-logging.basicConfig(
-    level=settings.LOGLEVEL,  # Set the desired log level (INFO, DEBUG, ERROR, etc.)
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+LOG_RECORDS_DROPPED = metrics.Counter(
+    "log_records_dropped", "Log records dropped because the log queue was full"
 )
 
-log = getLogger(__name__)
+# attributes every LogRecord has, anything else came in through `extra`
+RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | {"message", "asctime", "taskName"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the records below WARNING, per logger name prefix"""
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: dict[str, float] = {}
+
+    def rate(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1.0
+            # the most specific configured logger wins
+            prefix = name
+            while prefix:
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+                prefix = prefix.rpartition(".")[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # leave msg % args to the listener thread; tracebacks reference frames
+        # that may change, so they are rendered now (rare)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def configure_logging() -> QueueListener:
+    stream = logging.StreamHandler()
+    if settings.LOG_FORMAT == "json":
+        stream.setFormatter(JSONFormatter())
+    else:
+        stream.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+    handler = NonBlockingQueueHandler(queue.Queue(settings.LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter(settings.LOG_SAMPLING))
+
+    root = logging.getLogger("app")
+    root.setLevel(settings.LOGLEVEL)
+    root.addHandler(handler)
+    root.propagate = False
+
+    listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+listener = configure_logging()
+log = get_logger("app")
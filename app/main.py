@@ -1,4 +1,6 @@
 """Main FastAPI app instance declaration."""
+import asyncio
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.exceptions import RequestValidationError
@@ -7,9 +9,49 @@ from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.responses import JSONResponse
 
 from app.api.api import api_router
-from app.core import config
+from app.core import config, security
+from app.core.metrics import MetricsMiddleware
+from app.db.sql import ledger
+from app.db.sql.replica import replica_monitor
+from app.vending import idempotency, leases, machine
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    purge = asyncio.create_task(
+        idempotency.purge_expired_keys_periodically(
+            config.settings.IDEMPOTENCY_PURGE_INTERVAL_SECONDS
+        )
+    )
+    compact = asyncio.create_task(
+        ledger.compact_ledger_periodically(
+            config.settings.LEDGER_COMPACTION_INTERVAL_SECONDS
+        )
+    )
+    tasks = [purge, compact]
+    if replica_monitor.session_factory is not None:
+        tasks.append(asyncio.create_task(replica_monitor.run()))
+    if config.settings.STOCK_LEASE_SIZE:
+        tasks.append(
+            asyncio.create_task(
+                leases.return_expired_leases_periodically(
+                    config.settings.STOCK_LEASE_RETURN_INTERVAL_SECONDS
+                )
+            )
+        )
+    yield
+    for task in tasks:
+        task.cancel()
+    if config.settings.STOCK_LEASE_SIZE:
+        # unsold units of this worker go back to the products
+        await leases.stock_leases.close()
+    # write back coins still held by in-memory vending machines
+    await machine.close_ledgers()
+    security.password_hasher.shutdown()
+
 
 app = FastAPI(
+    lifespan=lifespan,
     title=config.settings.PROJECT_NAME,
     version=config.settings.VERSION,
     description=config.settings.DESCRIPTION,
@@ -43,3 +85,6 @@ async def catch_exceptions(request: Request, call_next):
 
 # Guards against HTTP Host Header attacks
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=config.settings.ALLOWED_HOSTS)
+
+# Outermost, so every request is timed by route
+app.add_middleware(MetricsMiddleware)
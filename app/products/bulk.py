@@ -0,0 +1,97 @@
+"""
+Bulk product import, update and restock.
+
+Rows come as a JSON array or as NDJSON - one object per line, sent with
+`Content-Type: application/x-ndjson`. Every row is validated on its own:
+invalid rows are reported with their position and the valid ones are applied
+together, in one transaction. Updates and restocks look up the seller of all
+their products in one query first; rows for products that are missing, of
+another seller or repeated in the request are reported too.
+"""
+
+import json
+from typing import Awaitable, Callable, Optional, TypeVar
+import uuid
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from app.products.models import ProductBulkResult, ProductRead, ProductRowError
+from app.products.repository import ProductRepository
+
+NDJSON = "application/x-ndjson"
+
+T = TypeVar("T", bound=BaseModel)
+
+
+def _describe(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc']) or 'row'}: {e['msg']}"
+        for e in error.errors()
+    )
+
+
+def parse_rows(
+    body: bytes, content_type: Optional[str], model: type[T], max_rows: int
+) -> tuple[list[tuple[int, T]], list[ProductRowError]]:
+    """Valid rows with their position, and an error for every other row
+
+    Raises `ValueError` when the body as a whole cannot be read.
+    """
+    adapter = TypeAdapter(model)
+    if content_type and content_type.split(";")[0].strip() == NDJSON:
+        records = [line for line in body.splitlines() if line.strip()]
+        validate = adapter.validate_json
+    else:
+        try:
+            records = json.loads(body)
+        except ValueError:
+            records = None
+        if not isinstance(records, list):
+            raise ValueError(f"Send a JSON array or {NDJSON} rows")
+        validate = adapter.validate_python
+    if len(records) > max_rows:
+        raise ValueError(f"At most {max_rows} rows per request")
+
+    rows, errors = [], []
+    for row, record in enumerate(records, 1):
+        try:
+            rows.append((row, validate(record)))
+        except ValidationError as e:
+            errors.append(ProductRowError(row=row, detail=_describe(e)))
+    return rows, errors
+
+
+async def apply_to_owned(
+    repository: ProductRepository,
+    seller_id: uuid.UUID,
+    rows: list[tuple[int, T]],
+    errors: list[ProductRowError],
+    apply: Callable[[uuid.UUID, list[T]], Awaitable[list[ProductRead]]],
+) -> ProductBulkResult:
+    """Apply the rows for products of `seller_id`, report the others"""
+    sellers = await repository.get_product_sellers([item.id for _, item in rows])
+    accepted, seen = [], set()
+    for row, item in rows:
+        if item.id in seen:
+            detail = "Product appears more than once in this request"
+        elif item.id not in sellers:
+            detail = "Product not found"
+        elif sellers[item.id] != seller_id:
+            detail = "You are not authorized to update this product."
+        else:
+            detail = None
+            accepted.append((row, item))
+        seen.add(item.id)
+        if detail is not None:
+            errors.append(ProductRowError(row=row, detail=detail))
+
+    items = await apply(seller_id, [item for _, item in accepted]) if accepted else []
+    # deleted since the lookup
+    applied = {product.id for product in items}
+    errors.extend(
+        ProductRowError(row=row, detail="Product not found")
+        for row, item in accepted
+        if item.id not in applied
+    )
+    errors.sort(key=lambda e: e.row)
+    return ProductBulkResult(items=items, errors=errors)
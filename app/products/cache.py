@@ -0,0 +1,114 @@
+"""
+Read-through cache of the serialized product catalog of each machine.
+
+Kiosks poll the catalog constantly, so the listing is kept as ready-to-send
+JSON bytes with an ETag. Every write to products of a machine bumps its
+version and drops the entry; an entry built from a read that raced with a
+write is never stored. Other workers only learn about writes through
+`CATALOG_CACHE_TTL_SECONDS`, which bounds how stale their catalog gets.
+Listings read from the replica may additionally be up to
+`DATABASE_REPLICA_MAX_LAG_SECONDS` behind.
+
+Products are flagged `exact_change_only` from the change index of the
+machine. An entry remembers the part of the index its flags came from and is
+re-serialized - without a query - once the coins change that part.
+"""
+
+import hashlib
+import time
+import uuid
+from dataclasses import dataclass
+from email.utils import formatdate
+from typing import Optional
+
+from pydantic import TypeAdapter
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.products.models import ProductListing, ProductRead
+from app.vending.change import ChangeIndex
+
+_products_adapter = TypeAdapter(list[ProductListing])
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    body: bytes
+    etag: str
+    last_modified: str
+    products: tuple[ProductRead, ...] = ()
+    # `ChangeIndex.window()` the flags were computed from
+    change_window: Optional[int] = None
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or self.etag in tags
+
+
+class CatalogCache:
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._versions: dict[uuid.UUID, int] = {}
+
+    def version(self, machine_id: uuid.UUID) -> int:
+        return self._versions.get(machine_id, 0)
+
+    def get(
+        self, machine_id: uuid.UUID, change_index: Optional[ChangeIndex] = None
+    ) -> Optional[CatalogEntry]:
+        entry = self._entries.get(machine_id)
+        if (
+            entry is not None
+            and change_index is not None
+            and entry.change_window != change_index.window()
+        ):
+            # same products, so the entry keeps its expiry
+            entry = self._serialize(entry.products, change_index)
+            self._entries.replace(machine_id, entry)
+        return entry
+
+    def put(
+        self,
+        machine_id: uuid.UUID,
+        products: list[ProductRead],
+        version: int,
+        change_index: Optional[ChangeIndex] = None,
+    ) -> CatalogEntry:
+        """Serialize `products` read at `version` - cached only if still current"""
+        entry = self._serialize(products, change_index)
+        if self.version(machine_id) == version:
+            self._entries.set(machine_id, entry)
+        return entry
+
+    def _serialize(
+        self, products: list[ProductRead], change_index: Optional[ChangeIndex]
+    ) -> CatalogEntry:
+        body = _products_adapter.dump_json(
+            [
+                ProductListing(
+                    **product.model_dump(),
+                    exact_change_only=change_index is not None
+                    and change_index.exact_change_only(product.cost),
+                )
+                for product in products
+            ]
+        )
+        return CatalogEntry(
+            body=body,
+            etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+            last_modified=formatdate(time.time(), usegmt=True),
+            products=tuple(products),
+            change_window=change_index.window() if change_index else None,
+        )
+
+    def invalidate(self, machine_id: uuid.UUID):
+        self._versions[machine_id] = self.version(machine_id) + 1
+        self._entries.invalidate(machine_id)
+
+    def stats(self) -> dict[str, int]:
+        return self._entries.stats()
+
+
+catalog_cache = CatalogCache(ttl=settings.CATALOG_CACHE_TTL_SECONDS)
@@ -1,8 +1,10 @@
+import base64
+import binascii
 from datetime import datetime
 from typing import Optional
 from uuid import UUID
 
-from pydantic import BaseModel, ConfigDict, validator
+from pydantic import BaseModel, ConfigDict, Field, validator
 
 
 class ProductCreate(BaseModel):
@@ -10,6 +12,8 @@ class ProductCreate(BaseModel):
     cost: int
     product_name: str
     seller_id: UUID
+    # set from the vending machine the product is created in
+    vending_id: Optional[UUID] = None
 
     @validator("cost")
     def validate_cost(cls, v):
@@ -28,3 +32,68 @@ class ProductRead(ProductCreate):
     model_config = ConfigDict(from_attributes=True)
 
     id: UUID
+
+
+class ProductListing(ProductRead):
+    # some overpayment with coins leaves change the machine cannot pay back
+    exact_change_only: bool = False
+
+
+class ProductImport(BaseModel):
+    # one row of a bulk import - checked row by row, before the database
+    amount_available: int = Field(ge=0)
+    cost: int = Field(gt=0, multiple_of=5)
+    product_name: str = Field(min_length=1, max_length=64)
+
+
+class ProductBulkUpdate(BaseModel):
+    id: UUID
+    # None keeps the current value
+    amount_available: Optional[int] = Field(default=None, ge=0)
+    cost: Optional[int] = Field(default=None, gt=0, multiple_of=5)
+    product_name: Optional[str] = Field(default=None, min_length=1, max_length=64)
+
+
+class ProductRestock(BaseModel):
+    id: UUID
+    # added to amount_available
+    amount: int = Field(gt=0)
+
+
+class ProductRowError(BaseModel):
+    # 1-based position of the row in the request
+    row: int
+    detail: str
+
+
+class ProductBulkResult(BaseModel):
+    items: list[ProductRead]
+    errors: list[ProductRowError]
+
+
+class ProductFilter(BaseModel):
+    seller_id: Optional[UUID] = None
+    in_stock: bool = False
+    min_cost: Optional[int] = None
+    max_cost: Optional[int] = None
+
+
+class ProductCursor(BaseModel):
+    # position after the last product of a page, ordered by (created_at, id)
+    created_at: datetime
+    id: UUID
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(self.model_dump_json().encode()).decode()
+
+    @classmethod
+    def decode(cls, cursor: str) -> "ProductCursor":
+        try:
+            return cls.model_validate_json(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, binascii.Error):
+            raise ValueError("Invalid cursor")
+
+
+class ProductPage(BaseModel):
+    items: list[ProductRead]
+    next_cursor: Optional[str] = None
@@ -1,14 +1,50 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+import uuid
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from sqlalchemy import select
+from sqlalchemy import (
+    Integer,
+    String,
+    cast,
+    column,
+    delete,
+    func,
+    insert,
+    select,
+    tuple_,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm.exc import StaleDataError
 
-from app.db.sql.models import Product
-from app.db.sql.session import get_session
-from app.errors import NotEnoughProductError, ProductNotFoundError
-from app.products.models import ProductCreate, ProductRead, ProductUpdate
+from app.core.config import settings
+from app.db.sql.locks import execute_locked
+from app.db.sql.models import Product, StockLease
+from app.db.sql.session import get_read_session, get_session
+from app.errors import (
+    ConcurrentUpdateError,
+    NotEnoughProductError,
+    ProductNotFoundError,
+)
+from app.products.cache import catalog_cache
+from app.products.models import (
+    ProductBulkUpdate,
+    ProductCreate,
+    ProductCursor,
+    ProductFilter,
+    ProductPage,
+    ProductRead,
+    ProductRestock,
+    ProductUpdate,
+)
+from app.vending.machine import get_vending_machine_id
+
+# rows per UPDATE ... FROM (VALUES ...) - stays well below the bind parameter limit
+BULK_CHUNK_SIZE = 1000
 
 
 class ProductRepository(ABC):
@@ -16,6 +52,16 @@ class ProductRepository(ABC):
     async def get_all_products(self) -> List[ProductRead]:
         pass
 
+    @abstractmethod
+    async def list_products(
+        self, filters: ProductFilter, cursor: Optional[ProductCursor], limit: int
+    ) -> ProductPage:
+        pass
+
+    @abstractmethod
+    def stream_products(self, batch_size: int) -> AsyncIterator[List[ProductRead]]:
+        pass
+
     @abstractmethod
     async def get_product_by_id(self, product_id: int) -> Optional[ProductRead]:
         pass
@@ -34,6 +80,28 @@ class ProductRepository(ABC):
     ) -> Optional[ProductRead]:
         pass
 
+    @abstractmethod
+    async def get_product_sellers(
+        self, product_ids: List[uuid.UUID]
+    ) -> Dict[uuid.UUID, uuid.UUID]:
+        pass
+
+    @abstractmethod
+    async def create_products(self, products: List[ProductCreate]) -> List[ProductRead]:
+        pass
+
+    @abstractmethod
+    async def update_products(
+        self, seller_id: uuid.UUID, updates: List[ProductBulkUpdate]
+    ) -> List[ProductRead]:
+        pass
+
+    @abstractmethod
+    async def restock_products(
+        self, seller_id: uuid.UUID, restocks: List[ProductRestock]
+    ) -> List[ProductRead]:
+        pass
+
     @abstractmethod
     async def delete_product(self, product_id: int) -> Optional[ProductRead]:
         pass
@@ -44,59 +112,251 @@ class ProductRepository(ABC):
 
 
 class SQLProductRepository:
-    def __init__(self, session: AsyncSession):
+    """Products of one vending machine - every query is scoped by `vending_id`"""
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        machine_id: uuid.UUID = uuid.UUID("00000000-0000-0000-0000-000000000000"),
+        optimistic: bool = False,
+    ):
         self.db_session = session or get_session()
+        self.machine_id = machine_id
+        # read without row locks, the ORM writes only if `version` did not change
+        self.optimistic = optimistic
+
+    def _select(self, **filters):
+        return select(Product).filter_by(vending_id=self.machine_id, **filters)
+
+    async def _read_for_write(self, product_id, site: str):
+        stmt = self._select(id=product_id)
+        if self.optimistic:
+            return await self.db_session.execute(stmt)
+        return await execute_locked(
+            self.db_session, stmt.with_for_update(), "products", site
+        )
+
+    async def _commit_write(self, voids_leases: List[uuid.UUID] = ()):
+        try:
+            # the product row is written before its leases, as everywhere else
+            await self.db_session.flush()
+            await self._void_leases(voids_leases)
+            await self.db_session.commit()
+        except StaleDataError:
+            await self.db_session.rollback()
+            raise ConcurrentUpdateError()
+
+    async def _void_leases(self, product_ids: List[uuid.UUID]):
+        # a new absolute amount is the whole stock - leased units included
+        if product_ids:
+            await self.db_session.execute(
+                delete(StockLease).where(StockLease.product_id.in_(product_ids))
+            )
 
     async def get_all_products(self) -> List[ProductRead]:
-        products = await self.db_session.execute(select(Product))
+        products = await self.db_session.execute(self._select())
         return [
             ProductRead.model_validate(product) for product in products.scalars().all()
         ]
 
-    async def get_product_by_id(self, product_id: int) -> Optional[ProductRead]:
-        product = await self.db_session.execute(
-            select(Product).filter_by(id=product_id)
+    async def list_products(
+        self, filters: ProductFilter, cursor: Optional[ProductCursor], limit: int
+    ) -> ProductPage:
+        """One page ordered by (created_at, id), continuing after `cursor`"""
+        q = self._select()
+        if filters.seller_id is not None:
+            q = q.where(Product.seller_id == filters.seller_id)
+        if filters.in_stock:
+            q = q.where(Product.amount_available > 0)
+        if filters.min_cost is not None:
+            q = q.where(Product.cost >= filters.min_cost)
+        if filters.max_cost is not None:
+            q = q.where(Product.cost <= filters.max_cost)
+        if cursor is not None:
+            q = q.where(
+                tuple_(Product.created_at, Product.id) > (cursor.created_at, cursor.id)
+            )
+        # one extra row tells whether there is a next page
+        q = q.order_by(Product.created_at, Product.id).limit(limit + 1)
+        products = (await self.db_session.execute(q)).scalars().all()
+
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            last = products[-1]
+            next_cursor = ProductCursor(created_at=last.created_at, id=last.id).encode()
+        return ProductPage(
+            items=[ProductRead.model_validate(product) for product in products],
+            next_cursor=next_cursor,
+        )
+
+    async def stream_products(
+        self, batch_size: int = 500
+    ) -> AsyncIterator[List[ProductRead]]:
+        """All products in batches, read through a server-side cursor"""
+        # plain columns - no ORM objects piling up in the session
+        columns = [getattr(Product, name) for name in ProductRead.model_fields]
+        result = await self.db_session.stream(
+            select(*columns)
+            .where(Product.vending_id == self.machine_id)
+            .order_by(Product.created_at, Product.id)
+            .execution_options(yield_per=batch_size)
         )
+        async for rows in result.partitions():
+            yield [ProductRead.model_validate(row) for row in rows]
+
+    async def get_product_by_id(self, product_id: int) -> Optional[ProductRead]:
+        product = await self.db_session.execute(self._select(id=product_id))
         product = product.scalar_one_or_none()
         if product:
             return ProductRead.model_validate(product)
         return None
 
     async def create_product(self, product_create: ProductCreate) -> ProductRead:
-        new_product = Product(**product_create.model_dump())
+        new_product = Product(
+            **product_create.model_dump(exclude={"vending_id"}),
+            vending_id=self.machine_id,
+        )
         self.db_session.add(new_product)
         await self.db_session.commit()
+        catalog_cache.invalidate(self.machine_id)
         return ProductRead.model_validate(new_product)
 
     async def update_product(
         self, product_id: int, product_update: ProductUpdate
     ) -> Optional[ProductRead]:
-        existing_product = await self.db_session.execute(
-            select(Product).filter_by(id=product_id).with_for_update()
+        existing_product = await self._read_for_write(
+            product_id, "products.update_product"
         )
         existing_product = existing_product.scalar_one_or_none()
         if existing_product:
             for key, value in product_update.model_dump().items():
                 setattr(existing_product, key, value)
-            await self.db_session.commit()
+            voided = [] if product_update.amount_available is None else [product_id]
+            await self._commit_write(voids_leases=voided)
+            catalog_cache.invalidate(self.machine_id)
             return ProductRead.model_validate(existing_product)
         return None
 
-    async def delete_product(self, product_id: int) -> Optional[ProductRead]:
-        existing_product = await self.db_session.execute(
-            select(Product).filter_by(id=product_id)
+    async def get_product_sellers(
+        self, product_ids: List[uuid.UUID]
+    ) -> Dict[uuid.UUID, uuid.UUID]:
+        """Seller of each product that exists in this machine, in one query"""
+        if not product_ids:
+            return {}
+        q = await self.db_session.execute(
+            select(Product.id, Product.seller_id).where(
+                Product.vending_id == self.machine_id, Product.id.in_(product_ids)
+            )
+        )
+        return dict(q.all())
+
+    async def create_products(self, products: List[ProductCreate]) -> List[ProductRead]:
+        """Insert all products - multi-row INSERTs, one commit"""
+        if not products:
+            return []
+        columns = [getattr(Product, name) for name in ProductRead.model_fields]
+        q = await self.db_session.execute(
+            insert(Product).returning(*columns, sort_by_parameter_order=True),
+            [
+                {**p.model_dump(exclude={"vending_id"}), "vending_id": self.machine_id}
+                for p in products
+            ],
+        )
+        created = [ProductRead.model_validate(row) for row in q.all()]
+        await self.db_session.commit()
+        catalog_cache.invalidate(self.machine_id)
+        return created
+
+    async def update_products(
+        self, seller_id: uuid.UUID, updates: List[ProductBulkUpdate]
+    ) -> List[ProductRead]:
+        def assignments(v):
+            # NULL keeps the current value
+            return {
+                name: func.coalesce(cast(v.c[name], type_), getattr(Product, name))
+                for name, type_ in (
+                    ("amount_available", Integer),
+                    ("cost", Integer),
+                    ("product_name", String),
+                )
+            }
+
+        return await self._update_from_values(
+            seller_id,
+            [(u.id, u.amount_available, u.cost, u.product_name) for u in updates],
+            [
+                column("amount_available", Integer),
+                column("cost", Integer),
+                column("product_name", String),
+            ],
+            assignments,
+            voids_leases={u.id for u in updates if u.amount_available is not None},
+        )
+
+    async def restock_products(
+        self, seller_id: uuid.UUID, restocks: List[ProductRestock]
+    ) -> List[ProductRead]:
+        return await self._update_from_values(
+            seller_id,
+            [(r.id, r.amount) for r in restocks],
+            [column("amount", Integer)],
+            lambda v: {
+                "amount_available": Product.amount_available + cast(v.c.amount, Integer)
+            },
         )
+
+    async def _update_from_values(
+        self,
+        seller_id: uuid.UUID,
+        rows: list[tuple],
+        value_columns: list,
+        assignments: Callable,
+        voids_leases: Set[uuid.UUID] = frozenset(),
+    ) -> List[ProductRead]:
+        """UPDATE ... FROM (VALUES ...) the seller's products, all in one commit
+
+        `rows` start with the product id followed by `value_columns`. Stock
+        leases of the updated products in `voids_leases` are voided.
+        """
+        columns = [getattr(Product, name) for name in ProductRead.model_fields]
+        now = datetime.utcnow()
+        updated = []
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            v = values(column("id", UUID(as_uuid=True)), *value_columns, name="v").data(
+                rows[start : start + BULK_CHUNK_SIZE]
+            )
+            q = await self.db_session.execute(
+                update(Product)
+                .where(
+                    Product.id == v.c.id,
+                    Product.vending_id == self.machine_id,
+                    Product.seller_id == seller_id,
+                )
+                .values(**assignments(v), version=Product.version + 1, updated_at=now)
+                .returning(*columns)
+                .execution_options(synchronize_session=False)
+            )
+            updated.extend(ProductRead.model_validate(row) for row in q.all())
+        await self._void_leases([p.id for p in updated if p.id in voids_leases])
+        await self.db_session.commit()
+        catalog_cache.invalidate(self.machine_id)
+        return updated
+
+    async def delete_product(self, product_id: int) -> Optional[ProductRead]:
+        existing_product = await self.db_session.execute(self._select(id=product_id))
         existing_product = existing_product.scalar_one_or_none()
         if existing_product:
             await self.db_session.delete(existing_product)
-            await self.db_session.commit()
+            await self._commit_write()
+            catalog_cache.invalidate(self.machine_id)
             return ProductRead.model_validate(existing_product)
 
         return None
 
     async def get_product_for_update(self, product_id: int) -> Optional[ProductRead]:
-        product = await self.db_session.execute(
-            select(Product).filter_by(id=product_id).with_for_update()
+        product = await self._read_for_write(
+            product_id, "products.get_product_for_update"
         )
         product = product.scalar_one_or_none()
         if product:
@@ -104,19 +364,31 @@ class SQLProductRepository:
         return None
 
     async def buy_product(self, product_id: int, amount: int) -> Optional[ProductRead]:
-        product = await self.db_session.execute(
-            select(Product).filter_by(id=product_id).with_for_update()
-        )
+        product = await self._read_for_write(product_id, "products.buy_product")
         product = product.scalar_one_or_none()
         if product:
             product.amount_available -= amount
             if product.amount_available < 0:
                 await self.db_session.rollback()
                 return NotEnoughProductError()
-            await self.db_session.commit()
+            await self._commit_write()
+            catalog_cache.invalidate(self.machine_id)
             return ProductRead.model_validate(product)
         raise ProductNotFoundError()
 
 
-async def get_product_repository(session=Depends(get_session)) -> ProductRepository:
-    return SQLProductRepository(session=session)
+async def get_product_repository(
+    session=Depends(get_session), machine_id=Depends(get_vending_machine_id)
+) -> ProductRepository:
+    return SQLProductRepository(
+        session=session,
+        machine_id=machine_id,
+        optimistic=settings.CONCURRENCY_MODE == "optimistic",
+    )
+
+
+async def get_product_read_repository(
+    session=Depends(get_read_session), machine_id=Depends(get_vending_machine_id)
+) -> ProductRepository:
+    """Repository for listing only - possibly on the read replica"""
+    return SQLProductRepository(session=session, machine_id=machine_id)
@@ -2,7 +2,7 @@ from enum import Enum
 from typing import Optional
 from uuid import UUID
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, Field, validator
 
 from app.users.models import AVAILABLE_COINS
 
@@ -67,6 +67,17 @@ class DepositRequest(BaseModel):
             raise ValueError("Invalid coin amount")
 
 
+class BatchDepositRequest(BaseModel):
+    coins: list[int] = Field(min_length=1, max_length=1000)
+
+    @validator("coins", each_item=True)
+    def validate_coins(coin):
+        if coin in AVAILABLE_COINS:
+            return coin
+        else:
+            raise ValueError("Invalid coin amount")
+
+
 class BuyProductRequest(BaseModel):
     product_id: UUID
     amount: int
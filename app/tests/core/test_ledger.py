@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from app.db.sql import ledger
+from app.db.sql.models import User
+
+
+def compile(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_deposit_is_the_latest_snapshot_plus_later_entries():
+    sql = compile(select(User.deposit))
+    assert "FROM balance_snapshots" in sql
+    assert "ORDER BY balance_snapshots.last_entry_id DESC" in sql
+    assert "sum(ledger_entries.amount)" in sql
+    assert "ledger_entries.id > coalesce((SELECT balance_snapshots.last_entry_id" in sql
+
+
+def test_debit_is_only_appended_when_covered_and_its_number_is_free():
+    statement = ledger.debit(
+        "refund",
+        User.id,
+        User.vending_id,
+        30,
+        balance=User.deposit,
+        debit_seq=ledger.next_debit_seq(User.id),
+        where=User.id == User.id,
+    )
+    compiled = statement.compile(dialect=postgresql.dialect())
+    sql = str(compiled)
+    assert sql.startswith("INSERT INTO ledger_entries")
+    assert "max(ledger_entries.debit_seq)" in sql
+    assert sql.endswith("ON CONFLICT (user_id, debit_seq) DO NOTHING")
+    # entered as -30, only where the balance is >= 30
+    assert {-30, 30} <= set(compiled.params.values())
+
+
+def test_credit_has_no_debit_number():
+    sql = compile(ledger.credit(User.id, User.vending_id, 5))
+    assert "ON CONFLICT" not in sql
+    assert "debit_seq" not in sql.split("SELECT", 1)[1].split("FROM")[0]
+
+
+def compactor_session(monkeypatch, locked=True, xmin=100, xmax=110):
+    session = AsyncMock()
+    results = {
+        "pg_try_advisory_xact_lock": MagicMock(
+            scalar_one=MagicMock(return_value=locked)
+        ),
+        "pg_current_snapshot": MagicMock(
+            one=MagicMock(
+                return_value=SimpleNamespace(
+                    last_entry_id=42, snapshot_xmin=xmin, snapshot_xmax=xmax
+                )
+            )
+        ),
+        "INSERT INTO balance_snapshots": MagicMock(rowcount=3),
+    }
+
+    async def execute(statement):
+        sql = compile(statement)
+        return next(result for key, result in results.items() if key in sql)
+
+    session.execute.side_effect = execute
+    context = MagicMock()
+    context.__aenter__ = AsyncMock(return_value=session)
+    context.__aexit__ = AsyncMock(return_value=False)
+    monkeypatch.setattr(ledger, "async_session", lambda: context)
+    return session
+
+
+async def test_compaction_waits_for_transactions_that_may_hold_lower_ids(
+    monkeypatch,
+):
+    compactor = ledger.LedgerCompactor()
+    before = ledger.LEDGER_SNAPSHOTS.labels().value
+
+    compactor_session(monkeypatch, xmin=100, xmax=110)
+    assert await compactor.run() == 0
+    assert compactor.pending == (42, 110)
+
+    # a transaction running at the first run is still open
+    compactor_session(monkeypatch, xmin=105, xmax=120)
+    assert await compactor.run() == 0
+    assert compactor.pending == (42, 110)
+
+    session = compactor_session(monkeypatch, xmin=110, xmax=130)
+    assert await compactor.run() == 3
+    snapshot = compile(session.execute.await_args_list[2].args[0])
+    assert "ledger_entries.id <= %(id_1)s" in snapshot
+    assert compactor.pending == (42, 130)
+    assert ledger.LEDGER_SNAPSHOTS.labels().value == before + 3
+
+
+async def test_compaction_skips_its_turn_while_another_worker_runs(monkeypatch):
+    compactor = ledger.LedgerCompactor()
+    session = compactor_session(monkeypatch, locked=False)
+    assert await compactor.run() == 0
+    assert compactor.pending is None
+    session.commit.assert_not_awaited()
@@ -0,0 +1,45 @@
+import json
+import logging
+import queue
+
+from app.log import (
+    LOG_RECORDS_DROPPED,
+    JSONFormatter,
+    NonBlockingQueueHandler,
+    SamplingFilter,
+)
+
+
+def make_record(name="app.vending.service", level=logging.INFO, **extra):
+    record = logging.LogRecord(name, level, __file__, 1, "Bought %s", ("cola",), None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_renders_message_and_extra_fields():
+    entry = json.loads(JSONFormatter().format(make_record(user_id=7)))
+
+    assert entry["message"] == "Bought cola"
+    assert entry["logger"] == "app.vending.service"
+    assert entry["level"] == "INFO"
+    assert entry["user_id"] == 7
+
+
+def test_sampling_filter_uses_most_specific_logger_and_keeps_warnings():
+    sampling = SamplingFilter({"app": 1.0, "app.vending": 0.0})
+
+    assert not sampling.filter(make_record("app.vending.service"))
+    assert sampling.filter(make_record("app.vending.service", logging.WARNING))
+    assert sampling.filter(make_record("app.products"))
+
+
+def test_queue_handler_defers_formatting_and_drops_when_full():
+    handler = NonBlockingQueueHandler(queue.Queue(1))
+    dropped = LOG_RECORDS_DROPPED.labels().value
+
+    handler.handle(make_record())
+    handler.handle(make_record())
+
+    record = handler.queue.get_nowait()
+    assert record.args == ("cola",)
+    assert LOG_RECORDS_DROPPED.labels().value == dropped + 1
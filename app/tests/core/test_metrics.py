@@ -0,0 +1,74 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.core.metrics import Counter, Histogram, REGISTRY, render
+from app.core.session import pool_stats
+from app.db.sql import locks
+from app.db.sql.locks import LOCK_WAIT_SECONDS, execute_locked
+
+
+def test_histogram_and_counter_render_prometheus_text():
+    histogram = Histogram(
+        "test_stage_seconds", "Stage latency", ("stage",), buckets=(0.1, 1.0)
+    )
+    counter = Counter("test_errors", "Errors", ("error",))
+    try:
+        histogram.labels("lock").observe(0.05)
+        histogram.labels("lock").observe(0.5)
+        histogram.labels("lock").observe(5)
+        counter.labels("NotEnoughChangeError").inc()
+
+        assert list(histogram.render()) == [
+            "# HELP test_stage_seconds Stage latency",
+            "# TYPE test_stage_seconds histogram",
+            'test_stage_seconds_bucket{stage="lock",le="0.1"} 1',
+            'test_stage_seconds_bucket{stage="lock",le="1.0"} 2',
+            'test_stage_seconds_bucket{stage="lock",le="+Inf"} 3',
+            'test_stage_seconds_sum{stage="lock"} 5.55',
+            'test_stage_seconds_count{stage="lock"} 3',
+        ]
+        assert list(counter.render())[-1] == (
+            'test_errors_total{error="NotEnoughChangeError"} 1.0'
+        )
+    finally:
+        REGISTRY.remove(histogram)
+        REGISTRY.remove(counter)
+
+
+def locking_session():
+    session = AsyncMock(info={})
+    session.in_transaction = MagicMock(return_value=True)
+    return session
+
+
+async def test_execute_locked_records_duration_by_table_and_site():
+    session = locking_session()
+    session.execute.side_effect = TimeoutError()
+    before = LOCK_WAIT_SECONDS.labels("users", "test.site").count
+
+    with pytest.raises(TimeoutError):
+        await execute_locked(session, "SELECT 1", "users", "test.site")
+
+    assert LOCK_WAIT_SECONDS.labels("users", "test.site").count == before + 1
+
+
+async def test_execute_locked_refuses_locks_against_lock_order():
+    session = locking_session()
+    await execute_locked(session, "SELECT 1", "products", "test.site")
+    await execute_locked(session, "SELECT 1", "products", "test.site")
+    await execute_locked(session, "SELECT 1", "vending_machine_coins", "test.site")
+
+    with pytest.raises(AssertionError, match="test.site locks products after"):
+        await execute_locked(session, "SELECT 1", "products", "test.site")
+
+    # the next transaction starts over
+    locks._reset_lock_order(session, None, None)
+    await execute_locked(session, "SELECT 1", "products", "test.site")
+
+
+def test_pool_stats_reports_connections_and_gauges():
+    stats = pool_stats()
+    assert stats["checked_out"] == 0
+    assert stats["overflow"] == 0
+    assert 'db_pool_connections{database="primary",state="idle"}' in render()
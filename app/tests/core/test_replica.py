@@ -0,0 +1,122 @@
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.dialects import postgresql
+
+from app.api import auth
+from app.db.sql import session as sql_session
+from app.db.sql.replica import LAG_QUERY, ReplicaMonitor
+
+
+class FakeSessionFactory:
+    """Stands in for an `async_sessionmaker`, returning `lag` from every query"""
+
+    def __init__(self, lag=0.0, error=None):
+        self.lag = lag
+        self.error = error
+        self.queries = []
+        self.params = []
+
+    def __call__(self, **kwargs):
+        factory = self
+
+        class Session:
+            info = kwargs.get("info", {})
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def execute(self, query, params=None):
+                factory.queries.append(query)
+                factory.params.append(params)
+                if factory.error:
+                    raise factory.error
+                result = MagicMock()
+                result.scalar_one.return_value = factory.lag
+                return result
+
+        return Session()
+
+
+async def test_replica_is_usable_only_after_a_check_within_the_lag_bound():
+    factory = FakeSessionFactory(lag=0.2)
+    monitor = ReplicaMonitor(factory, max_lag=1.0, interval=0.5)
+    assert not monitor.usable()
+
+    await monitor.check()
+    assert factory.queries == [LAG_QUERY]
+    assert monitor.usable()
+    assert monitor.stats()["lag_seconds"] == 0.2
+
+    factory.lag = 5.0
+    await monitor.check()
+    assert not monitor.usable()
+
+
+@pytest.mark.parametrize("lag, error", [(None, None), (0.0, OSError("refused"))])
+async def test_disconnected_or_unreachable_replica_is_not_used(lag, error):
+    monitor = ReplicaMonitor(FakeSessionFactory(lag, error), max_lag=1.0, interval=0.5)
+    await monitor.check()
+    assert not monitor.usable()
+    assert monitor.stats()["lag_seconds"] is None
+
+
+@pytest.mark.parametrize("allow_primary", [False, True])
+async def test_server_not_in_recovery_has_no_lag_only_when_allowed(allow_primary):
+    factory = FakeSessionFactory()
+    monitor = ReplicaMonitor(
+        factory, max_lag=1.0, interval=0.5, allow_primary=allow_primary
+    )
+    await monitor.check()
+
+    sql = str(LAG_QUERY.compile(dialect=postgresql.dialect()))
+    assert "WHEN NOT pg_is_in_recovery() THEN CASE WHEN %(allow_primary)s" in sql
+    assert factory.params == [{"allow_primary": allow_primary}]
+
+
+async def test_overdue_check_counts_as_failed():
+    monitor = ReplicaMonitor(FakeSessionFactory(0.0), max_lag=1.0, interval=0.5)
+    await monitor.check()
+    monitor.checked_at = time.monotonic() - 2
+    assert not monitor.usable()
+
+
+def test_no_replica_is_never_usable():
+    monitor = ReplicaMonitor(None, max_lag=1.0, interval=0.5)
+    assert not monitor.usable()
+    assert not monitor.stats()["configured"]
+
+
+async def test_read_session_falls_back_to_the_primary(monkeypatch):
+    replica, primary = FakeSessionFactory(), FakeSessionFactory()
+    monitor = ReplicaMonitor(replica, max_lag=1.0, interval=0.5)
+    monkeypatch.setattr(sql_session, "replica_monitor", monitor)
+    monkeypatch.setattr(sql_session, "async_session", primary)
+
+    async for session in sql_session.get_read_session():
+        assert not sql_session.is_replica(session)
+
+    await monitor.check()
+    async for session in sql_session.get_read_session():
+        assert sql_session.is_replica(session)
+
+
+async def test_user_missing_on_the_replica_is_looked_up_on_the_primary(monkeypatch):
+    user = MagicMock()
+    replica = AsyncMock(info={"database": "replica"})
+    replica.execute.return_value.scalar_one_or_none = MagicMock(return_value=None)
+    primary = AsyncMock()
+    primary.__aenter__.return_value = primary
+    primary.execute.return_value.scalar_one_or_none = MagicMock(return_value=user)
+    monkeypatch.setattr(auth, "async_session", lambda: primary)
+
+    assert await auth._load_user(replica, "user-id") is user
+
+    primary.execute.return_value.scalar_one_or_none.return_value = None
+    with pytest.raises(HTTPException):
+        await auth._load_user(replica, "user-id")
@@ -0,0 +1,29 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.core.security import PasswordHasher
+from app.errors import PasswordHashingBusyError
+
+
+async def test_password_hasher_runs_off_loop_and_rejects_when_queue_full():
+    hasher = PasswordHasher(kind="thread", workers=1, max_queue=1)
+    release = threading.Event()
+
+    running = asyncio.ensure_future(hasher.run(release.wait))
+    await asyncio.sleep(0.05)
+    waiting = asyncio.ensure_future(hasher.run(lambda: "done"))
+    await asyncio.sleep(0.05)
+    assert hasher.stats()["running"] == 1
+    assert hasher.stats()["waiting"] == 1
+
+    with pytest.raises(PasswordHashingBusyError):
+        await hasher.run(lambda: "rejected")
+
+    release.set()
+    assert await running is True
+    assert await waiting == "done"
+    assert hasher.stats()["completed"] == 2
+    assert hasher.stats()["rejected"] == 1
+    hasher.shutdown()
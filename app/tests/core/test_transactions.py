@@ -0,0 +1,87 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy.exc import DBAPIError
+
+from app.db.sql.transactions import (
+    DEADLOCK_DETECTED,
+    LOCK_NOT_AVAILABLE,
+    TRANSACTION_RETRIES,
+    TransactionRunner,
+)
+from app.errors import TransactionAbortedError
+
+
+class PGError(Exception):
+    def __init__(self, sqlstate: str):
+        super().__init__(sqlstate)
+        self.sqlstate = sqlstate
+
+
+def db_error(sqlstate: str) -> DBAPIError:
+    return DBAPIError("UPDATE ...", {}, PGError(sqlstate))
+
+
+def make_runner(**kwargs):
+    session = AsyncMock()
+    session.info = {}
+    session.in_transaction = MagicMock(return_value=False)
+    return TransactionRunner(session, backoff_seconds=0, **kwargs), session
+
+
+async def test_deadlocked_unit_of_work_is_rolled_back_and_run_again():
+    runner, session = make_runner(lock_timeout_ms=100)
+    before = TRANSACTION_RETRIES.labels("test", DEADLOCK_DETECTED).value
+    seen = []
+
+    async def work():
+        seen.append(session.info.get("lock_timeout_ms"))
+        if len(seen) == 1:
+            raise db_error(DEADLOCK_DETECTED)
+        return "done"
+
+    assert await runner.run("test", work) == "done"
+    assert seen == [100, 100]
+    session.rollback.assert_awaited_once()
+    assert TRANSACTION_RETRIES.labels("test", DEADLOCK_DETECTED).value == before + 1
+    assert "lock_timeout_ms" not in session.info
+
+
+async def test_gives_up_after_max_attempts():
+    runner, session = make_runner(max_attempts=3)
+    work = AsyncMock(side_effect=db_error(DEADLOCK_DETECTED))
+    with pytest.raises(TransactionAbortedError):
+        await runner.run("test", work)
+    assert work.await_count == 3
+    assert session.rollback.await_count == 3
+
+
+async def test_lock_timeout_is_not_retried():
+    runner, session = make_runner(lock_timeout_ms=100)
+    work = AsyncMock(side_effect=db_error(LOCK_NOT_AVAILABLE))
+    with pytest.raises(TransactionAbortedError):
+        await runner.run("test", work)
+    work.assert_awaited_once()
+    session.rollback.assert_awaited_once()
+
+
+async def test_other_errors_pass_through():
+    runner, session = make_runner()
+    work = AsyncMock(side_effect=db_error("23505"))
+    with pytest.raises(DBAPIError):
+        await runner.run("test", work)
+    work.assert_awaited_once()
+    session.rollback.assert_not_awaited()
+
+
+async def test_lock_timeout_is_set_on_an_open_transaction():
+    runner, session = make_runner(lock_timeout_ms=250)
+    session.in_transaction.return_value = True
+    await runner.run("test", AsyncMock(return_value=None))
+    statement = session.execute.await_args.args[0]
+    assert str(statement) == "SET LOCAL lock_timeout = 250"
+
+
+async def test_unit_of_work_runs_at_least_once():
+    runner, _ = make_runner(max_attempts=0)
+    assert await runner.run("test", AsyncMock(return_value="done")) == "done"
@@ -0,0 +1,33 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.endpoints import debug
+from app.core.config import settings
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(debug.router, prefix="/debug")
+    return TestClient(app)
+
+
+@pytest.mark.parametrize(
+    "configured, sent, status_code",
+    [
+        (None, None, 403),
+        (None, "", 403),
+        ("operator-token", None, 403),
+        ("operator-token", "guess", 403),
+        ("operator-token", "operator-token", 200),
+    ],
+)
+def test_debug_endpoints_need_the_debug_token(
+    client, monkeypatch, configured, sent, status_code
+):
+    monkeypatch.setattr(settings, "DEBUG_TOKEN", configured)
+    headers = {} if sent is None else {"X-Debug-Token": sent}
+
+    response = client.get("/debug/password-hashing", headers=headers)
+    assert response.status_code == status_code
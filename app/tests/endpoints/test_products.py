@@ -0,0 +1,303 @@
+import uuid
+from datetime import datetime
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.api.auth import get_current_user
+from app.main import app
+from app.products.cache import catalog_cache
+from app.products.models import (
+    ProductBulkUpdate,
+    ProductCreate,
+    ProductCursor,
+    ProductFilter,
+    ProductPage,
+    ProductRead,
+)
+from app.products.repository import (
+    get_product_read_repository,
+    get_product_repository,
+)
+from app.users.models import UserRead
+from app.vending.machine import get_change_index, get_vending_machine_reader
+from app.vending.models import Change
+
+MACHINE_ID = uuid.UUID("00000000-0000-0000-0000-000000000000")
+SELLER_ID = uuid.UUID("11111111-0000-0000-0000-000000000000")
+# every overpayment of a product up to the largest coin can be paid back
+ENOUGH_COINS = Change(root={5: 1, 10: 2, 20: 4, 50: 1, 100: 0})
+
+
+@pytest.fixture
+def product_repo_mock():
+    repo = AsyncMock()
+    repo.get_all_products.return_value = [
+        ProductRead(
+            id=uuid.UUID("33333333-0000-0000-0000-000000000000"),
+            amount_available=3,
+            cost=40,
+            product_name="cola",
+            seller_id=uuid.UUID("11111111-0000-0000-0000-000000000000"),
+            vending_id=MACHINE_ID,
+        )
+    ]
+    app.dependency_overrides[get_product_repository] = lambda: repo
+    app.dependency_overrides[get_product_read_repository] = lambda: repo
+    machine = AsyncMock()
+    machine.get_coins.return_value = ENOUGH_COINS
+    app.dependency_overrides[get_vending_machine_reader] = lambda: machine
+    get_change_index(MACHINE_ID).set(ENOUGH_COINS.counts)
+    catalog_cache.invalidate(MACHINE_ID)
+    yield repo
+    app.dependency_overrides = {}
+    catalog_cache.invalidate(MACHINE_ID)
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+def test_get_all_products_is_served_from_cache(client, product_repo_mock):
+    first = client.get("http://localhost/products/products")
+    second = client.get("http://localhost/products/products")
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == [
+        {
+            "id": "33333333-0000-0000-0000-000000000000",
+            "amount_available": 3,
+            "cost": 40,
+            "product_name": "cola",
+            "seller_id": "11111111-0000-0000-0000-000000000000",
+            "vending_id": "00000000-0000-0000-0000-000000000000",
+            "exact_change_only": False,
+        }
+    ]
+    assert first.headers["etag"] == second.headers["etag"]
+    assert "last-modified" in first.headers
+    product_repo_mock.get_all_products.assert_awaited_once()
+
+
+def test_get_all_products_returns_304_for_matching_etag(client, product_repo_mock):
+    etag = client.get("http://localhost/products/products").headers["etag"]
+    response = client.get(
+        "http://localhost/products/products", headers={"If-None-Match": etag}
+    )
+
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+def test_get_all_products_reloads_after_invalidation(client, product_repo_mock):
+    client.get("http://localhost/products/products")
+    catalog_cache.invalidate(MACHINE_ID)
+    client.get("http://localhost/products/products")
+
+    assert product_repo_mock.get_all_products.await_count == 2
+
+
+def test_get_all_products_flags_exact_change_only_when_coins_run_out(
+    client, product_repo_mock
+):
+    first = client.get("http://localhost/products/products")
+    # a 50 paying for the cola leaves 10 - no 5 or 10 left to pay it back
+    get_change_index(MACHINE_ID).set(
+        Change(root={5: 0, 10: 0, 20: 4, 50: 1, 100: 0}).counts
+    )
+    second = client.get("http://localhost/products/products")
+
+    assert first.json()[0]["exact_change_only"] is False
+    assert second.json()[0]["exact_change_only"] is True
+    assert first.headers["etag"] != second.headers["etag"]
+    # same products, only serialized again
+    product_repo_mock.get_all_products.assert_awaited_once()
+
+
+def test_get_products_page_passes_filters_and_cursor(client, product_repo_mock):
+    cursor = ProductCursor(
+        created_at=datetime(2024, 1, 30, 12, 0),
+        id=uuid.UUID("44444444-0000-0000-0000-000000000000"),
+    )
+    product_repo_mock.list_products.return_value = ProductPage(items=[])
+    response = client.get(
+        "http://localhost/products/page",
+        params={
+            "cursor": cursor.encode(),
+            "limit": 10,
+            "in_stock": True,
+            "min_cost": 5,
+            "max_cost": 50,
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {"items": [], "next_cursor": None}
+    filters, after, limit = product_repo_mock.list_products.call_args.args
+    assert filters == ProductFilter(in_stock=True, min_cost=5, max_cost=50)
+    assert after == cursor
+    assert limit == 10
+
+
+@pytest.mark.parametrize("params", [{"cursor": "not-a-cursor"}, {"limit": 0}])
+def test_get_products_page_rejects_invalid_params(client, product_repo_mock, params):
+    response = client.get("http://localhost/products/page", params=params)
+    assert response.status_code in (400, 422)
+    product_repo_mock.list_products.assert_not_awaited()
+
+
+@pytest.mark.parametrize(
+    "format, expected",
+    [
+        (
+            "ndjson",
+            '{"amount_available":3,"cost":40,"product_name":"cola",'
+            '"seller_id":"11111111-0000-0000-0000-000000000000",'
+            '"vending_id":"00000000-0000-0000-0000-000000000000",'
+            '"id":"33333333-0000-0000-0000-000000000000"}\n',
+        ),
+        (
+            "csv",
+            "amount_available,cost,product_name,seller_id,vending_id,id\r\n"
+            "3,40,cola,11111111-0000-0000-0000-000000000000,"
+            "00000000-0000-0000-0000-000000000000,"
+            "33333333-0000-0000-0000-000000000000\r\n",
+        ),
+    ],
+)
+def test_export_products_streams_rows(client, product_repo_mock, format, expected):
+    products = product_repo_mock.get_all_products.return_value
+
+    async def stream_products():
+        yield products
+
+    product_repo_mock.stream_products = stream_products
+    response = client.get("http://localhost/products/export", params={"format": format})
+
+    assert response.status_code == 200
+    assert response.text == expected
+
+
+@pytest.fixture
+def seller():
+    app.dependency_overrides[get_current_user] = lambda: UserRead(
+        id=SELLER_ID, username="testseller", role="seller"
+    )
+
+
+def test_bulk_create_reads_ndjson_and_reports_invalid_rows(
+    client, product_repo_mock, seller
+):
+    product_repo_mock.create_products.side_effect = lambda products: [
+        ProductRead(**p.model_dump(), id=uuid.uuid4()) for p in products
+    ]
+    body = (
+        '{"amount_available": 3, "cost": 40, "product_name": "cola"}\n'
+        '{"amount_available": 3, "cost": 42, "product_name": "chips"}\n'
+        "\n"
+        '{"amount_available": 0, "cost": 5, "product_name": "gum"}\n'
+    )
+    response = client.post(
+        "http://localhost/products/products/bulk",
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+    assert response.status_code == 200
+    result = response.json()
+    assert [p["product_name"] for p in result["items"]] == ["cola", "gum"]
+    assert [e["row"] for e in result["errors"]] == [2]
+    assert result["errors"][0]["detail"].startswith("cost:")
+    (products,) = product_repo_mock.create_products.call_args.args
+    assert products[0] == ProductCreate(
+        amount_available=3, cost=40, product_name="cola", seller_id=SELLER_ID
+    )
+
+
+def test_bulk_update_applies_only_the_sellers_products(
+    client, product_repo_mock, seller
+):
+    own, other, missing = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    product_repo_mock.get_product_sellers.return_value = {
+        own: SELLER_ID,
+        other: uuid.uuid4(),
+    }
+    product_repo_mock.update_products.return_value = [
+        ProductRead(
+            id=own,
+            amount_available=1,
+            cost=10,
+            product_name="cola",
+            seller_id=SELLER_ID,
+            vending_id=MACHINE_ID,
+        )
+    ]
+    response = client.put(
+        "http://localhost/products/products/bulk",
+        json=[
+            {"id": str(own), "cost": 10},
+            {"id": str(other), "cost": 10},
+            {"id": str(missing), "cost": 10},
+            {"id": str(own), "cost": 15},
+        ],
+    )
+
+    assert response.status_code == 200
+    assert [p["id"] for p in response.json()["items"]] == [str(own)]
+    assert [(e["row"], e["detail"]) for e in response.json()["errors"]] == [
+        (2, "You are not authorized to update this product."),
+        (3, "Product not found"),
+        (4, "Product appears more than once in this request"),
+    ]
+    product_repo_mock.get_product_sellers.assert_awaited_once_with(
+        [own, other, missing, own]
+    )
+    product_repo_mock.update_products.assert_awaited_once_with(
+        SELLER_ID, [ProductBulkUpdate(id=own, cost=10)]
+    )
+
+
+def test_bulk_restock_rejects_a_body_that_is_not_an_array(
+    client, product_repo_mock, seller
+):
+    response = client.post(
+        "http://localhost/products/products/restock", json={"id": str(uuid.uuid4())}
+    )
+
+    assert response.status_code == 400
+    product_repo_mock.restock_products.assert_not_awaited()
+
+
+def test_bulk_endpoints_are_for_sellers_only(client, product_repo_mock):
+    app.dependency_overrides[get_current_user] = lambda: UserRead(
+        id=uuid.uuid4(), username="testbuyer", role="buyer"
+    )
+    response = client.post("http://localhost/products/products/bulk", json=[])
+
+    assert response.status_code == 403
+    product_repo_mock.create_products.assert_not_awaited()
+
+
+@pytest.mark.parametrize(
+    "method, path",
+    [
+        ("post", "/products"),
+        ("post", "/products/bulk"),
+        ("put", "/products/bulk"),
+        ("post", "/products/restock"),
+        ("put", f"/products/{uuid.uuid4()}"),
+        ("delete", f"/products/{uuid.uuid4()}"),
+    ],
+)
+def test_product_writes_are_refused_on_another_machine(
+    client, product_repo_mock, seller, method, path
+):
+    other_machine = uuid.uuid4()
+    response = client.request(
+        method, f"http://localhost/machines/{other_machine}/products{path}", json=[]
+    )
+
+    assert response.status_code == 403
+    assert product_repo_mock.method_calls == []
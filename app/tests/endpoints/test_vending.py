@@ -14,6 +14,7 @@ from app.errors import (
 )
 
 from app.users.models import UserReadFull
+from app.vending.idempotency import StoredResponse, get_idempotency_repository
 from app.vending.service import VendingService, get_vending_service
 
 
@@ -49,6 +50,7 @@ def vending_service_mock():
         user_repository=None,
         product_repository=None,
         vending_machine=None,
+        vending_repository=None,
     )
 
     return s
@@ -146,3 +148,152 @@ def test_deposit_coins_returns_400_when_error_raised(
     assert response.json() == {"detail": error["msg"]}
 
     assert response.status_code == error["code"]
+
+
+def test_deposit_coin_batch_returns_200_with_total_deposit(
+    api_client, test_buyer_1, vending_service_mock
+):
+    vending_service_mock.deposit_coin_batch = AsyncMock(
+        return_value=UserReadFull(
+            id=uuid.UUID("00000000-0000-0000-0000-000000000000"),
+            username="testbuyer",
+            role="buyer",
+            deposit=45,
+        )
+    )
+    app.dependency_overrides[get_vending_service] = lambda: vending_service_mock
+    app.dependency_overrides[get_current_user] = lambda: test_buyer_1
+    response = api_client.post(
+        "http://localhost/vending/deposit/batch",
+        json={"coins": [5, 20, 20]},
+    )
+    assert response.status_code == 200
+    assert response.json()["deposit"] == 45
+    req = vending_service_mock.deposit_coin_batch.call_args.args[0]
+    assert req.as_change().root == {5: 1, 10: 0, 20: 2, 50: 0, 100: 0}
+
+
+@pytest.mark.parametrize("coins", [[], [5, 3], [200]])
+def test_deposit_coin_batch_returns_422_when_coins_invalid(
+    api_client, test_buyer_1, coins
+):
+    app.dependency_overrides[get_current_user] = lambda: test_buyer_1
+    response = api_client.post(
+        "http://localhost/vending/deposit/batch",
+        json={"coins": coins},
+    )
+    assert response.status_code == 422
+
+
+def test_machine_scoped_route_rejects_buyer_of_another_machine(
+    api_client, test_buyer_1, vending_service_mock
+):
+    vending_service_mock.deposit_coins = AsyncMock()
+    app.dependency_overrides[get_vending_service] = lambda: vending_service_mock
+    app.dependency_overrides[get_current_user] = lambda: test_buyer_1
+    response = api_client.post(
+        "http://localhost/machines/22222222-0000-0000-0000-000000000000/vending/deposit",
+        json={"coin": 5},
+    )
+    assert response.status_code == 403
+    vending_service_mock.deposit_coins.assert_not_awaited()
+
+
+def test_machine_scoped_route_accepts_buyer_of_that_machine(
+    api_client, test_buyer_1, vending_service_mock
+):
+    vending_service_mock.deposit_coins = AsyncMock(return_value=test_buyer_1)
+    app.dependency_overrides[get_vending_service] = lambda: vending_service_mock
+    app.dependency_overrides[get_current_user] = lambda: test_buyer_1
+    response = api_client.post(
+        "http://localhost/machines/00000000-0000-0000-0000-000000000000/vending/deposit",
+        json={"coin": 5},
+    )
+    assert response.status_code == 200
+
+
+def test_metrics_endpoint_reports_routes_and_vending_errors(
+    api_client, test_seller_1, vending_service_mock
+):
+    vending_service_mock.deposit_coins = AsyncMock(side_effect=InvalidRoleError())
+    app.dependency_overrides[get_vending_service] = lambda: vending_service_mock
+    app.dependency_overrides[get_current_user] = lambda: test_seller_1
+    api_client.post("http://localhost/vending/deposit", json={"coin": 5})
+
+    response = api_client.get("http://localhost/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert (
+        'http_request_duration_seconds_count{method="POST",route="/vending/deposit",status="400"}'
+        in response.text
+    )
+
+
+class InMemoryIdempotencyRepository:
+    def __init__(self):
+        self.keys = {}
+
+    async def claim(self, user_id, key, fingerprint):
+        if (user_id, key) in self.keys:
+            return self.keys[(user_id, key)]
+        self.keys[(user_id, key)] = StoredResponse(fingerprint=fingerprint)
+        return None
+
+    async def save(self, user_id, key, fingerprint, status_code, body):
+        self.keys[(user_id, key)] = StoredResponse(
+            fingerprint=fingerprint, status_code=status_code, response=body
+        )
+
+
+def test_deposit_with_idempotency_key_is_replayed_without_the_service(
+    api_client, test_buyer_1, vending_service_mock
+):
+    vending_service_mock.deposit_coins = AsyncMock(
+        return_value=UserReadFull(
+            id=test_buyer_1.id, username="testbuyer", role="buyer", deposit=5
+        )
+    )
+    idempotency = InMemoryIdempotencyRepository()
+    app.dependency_overrides[get_vending_service] = lambda: vending_service_mock
+    app.dependency_overrides[get_current_user] = lambda: test_buyer_1
+    app.dependency_overrides[get_idempotency_repository] = lambda: idempotency
+    headers = {"Idempotency-Key": "retry-1"}
+
+    first = api_client.post(
+        "http://localhost/vending/deposit", json={"coin": 5}, headers=headers
+    )
+    retry = api_client.post(
+        "http://localhost/vending/deposit", json={"coin": 5}, headers=headers
+    )
+    other = api_client.post(
+        "http://localhost/vending/deposit", json={"coin": 10}, headers=headers
+    )
+
+    assert retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert other.status_code == 422
+    vending_service_mock.deposit_coins.assert_awaited_once()
+
+
+def test_failed_buy_with_idempotency_key_replays_the_error(
+    api_client, test_buyer_1, vending_service_mock
+):
+    vending_service_mock.buy_product = AsyncMock(side_effect=NotEnoughMoneyError())
+    idempotency = InMemoryIdempotencyRepository()
+    app.dependency_overrides[get_vending_service] = lambda: vending_service_mock
+    app.dependency_overrides[get_current_user] = lambda: test_buyer_1
+    app.dependency_overrides[get_idempotency_repository] = lambda: idempotency
+    body = {"product_id": str(uuid.uuid4()), "amount": 1}
+
+    first, retry = [
+        api_client.post(
+            "http://localhost/vending/buy", json=body, headers={"Idempotency-Key": "b"}
+        )
+        for _ in range(2)
+    ]
+
+    assert first.status_code == retry.status_code == 400
+    assert retry.json() == {"detail": "Not enough funds to purchase product"}
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    vending_service_mock.buy_product.assert_awaited_once()
@@ -0,0 +1,121 @@
+import itertools
+import random
+
+import pytest
+from pydantic import ValidationError
+
+from app.errors import NotEnoughChangeError
+from app.vending.change import COINS, ChangeIndex, ChangeSolver, get_solver
+from app.vending.machine import calculate_change
+from app.vending.models import BuyProductSummary, Change, PurchaseState
+
+
+def brute_force(counts, amount):
+    best = None
+    for plan in itertools.product(*(range(c + 1) for c in counts)):
+        if sum(p * coin for p, coin in zip(plan, COINS)) == amount:
+            if best is None or sum(plan) < sum(best):
+                best = plan
+    return best
+
+
+async def test_calculate_change_pays_when_greedy_would_fail():
+    # 60 owed with one 50 and three 20s - greedy takes the 50 and gets stuck
+    coins = Change(root={5: 0, 10: 0, 20: 3, 50: 1, 100: 0})
+    change = await calculate_change(coins, 60)
+    assert change.root == {5: 0, 10: 0, 20: 3, 50: 0, 100: 0}
+
+
+async def test_calculate_change_raises_when_impossible():
+    coins = Change(root={5: 0, 10: 0, 20: 3, 50: 1, 100: 0})
+    with pytest.raises(NotEnoughChangeError):
+        await calculate_change(coins, 30)
+
+
+@pytest.mark.parametrize("amount", [-5, 3, 1000])
+def test_solver_rejects_unpayable_amounts(amount):
+    assert ChangeSolver((1, 1, 1, 1, 1)).solve(amount) is None
+
+
+def test_solver_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(50):
+        counts = tuple(rng.randint(0, 3) for _ in COINS)
+        solver = ChangeSolver(counts)
+        for amount in range(0, 300, 5):
+            plan = solver.solve(amount)
+            expected = brute_force(counts, amount)
+            if expected is None:
+                assert plan is None
+            else:
+                assert sum(p * c for p, c in zip(plan, COINS)) == amount
+                assert all(p <= c for p, c in zip(plan, counts))
+                assert sum(plan) == sum(expected)
+
+
+def test_change_index_follows_coin_changes():
+    rng = random.Random(0)
+    index = ChangeIndex(1000)
+    assert index.can_pay(10) is None
+    for _ in range(50):
+        counts = tuple(rng.randint(0, 5) for _ in COINS)
+        index.set(counts)
+        solver = ChangeSolver(counts)
+        assert all(
+            index.can_pay(amount) == solver.can_pay(amount)
+            for amount in range(0, 1001, 5)
+        )
+    assert index.can_pay(1005) is None
+
+
+def test_change_index_add_coins():
+    index = ChangeIndex(500)
+    index.add((1, 0, 0, 0, 0))
+    assert not index.known
+    index.set((0, 0, 0, 1, 0))
+    assert not index.can_pay(5)
+    index.add((1, 0, 0, 0, 0))
+    assert index.can_pay(55)
+
+
+def test_change_index_exact_change_only():
+    index = ChangeIndex(500)
+    # unknown - nothing is flagged
+    assert not index.exact_change_only(40)
+    index.set((0, 0, 3, 1, 0))
+    # a 50 paying for 40 leaves 10
+    assert index.exact_change_only(40)
+    # paying 5 with one coin leaves 0, 5, 15, 45 or 95
+    index.set((1, 2, 1, 1, 0))
+    assert not index.exact_change_only(5)
+    index.set((1, 0, 0, 1, 0))
+    assert index.exact_change_only(5)
+
+
+def test_solver_is_reused_for_same_inventory():
+    assert get_solver((1, 2, 3, 4, 5)) is get_solver((1, 2, 3, 4, 5))
+
+
+def test_change_vector_arithmetic_and_comparison():
+    coins = Change(root={5: 2, 10: 1, 20: 0, 50: 1, 100: 0})
+    paid = Change.of(5) + Change.of(50)
+
+    assert (coins - paid).root == {5: 1, 10: 1, 20: 0, 50: 0, 100: 0}
+    assert paid <= coins
+    assert not Change.of(100) <= coins
+    assert coins.total() == 70
+    assert paid.nonzero() == {5: 1, 50: 1}
+
+
+def test_change_keeps_json_shape_and_validation():
+    summary = BuyProductSummary(
+        total_spent=5, product_name="cola", change=Change.of(20, 3)
+    )
+    assert summary.model_dump_json() == (
+        '{"total_spent":5,"product_name":"cola",'
+        '"change":{"5":0,"10":0,"20":3,"50":0,"100":0}}'
+    )
+    state = PurchaseState(coins={"5": 1, "10": 0, "20": 0, "50": 0, "100": 2})
+    assert state.coins == Change.from_items([(5, 1), (100, 2)])
+    with pytest.raises(ValidationError):
+        PurchaseState(coins={5: 1})
@@ -0,0 +1,113 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.dialects import postgresql
+
+from app.errors import IdempotencyKeyInUseError
+from app.vending import idempotency
+from app.vending.idempotency import (
+    CLAIM,
+    CLAIM_LOST,
+    SQLIdempotencyRepository,
+    run_idempotent,
+)
+
+
+def claim_result(claimed):
+    result = MagicMock()
+    result.one.return_value = SimpleNamespace(
+        claimed=claimed, fingerprint=None, status_code=None, response=None
+    )
+    return result
+
+
+async def claimed_session():
+    session = AsyncMock(info={})
+    session.execute.return_value = claim_result(1)
+    repository = SQLIdempotencyRepository(session)
+    assert await repository.claim(uuid.uuid4(), "key", "fingerprint") is None
+    return session, repository
+
+
+async def test_claim_is_taken_again_by_the_transaction_after_a_rollback():
+    session, _ = await claimed_session()
+    connection = MagicMock()
+    connection.execute.return_value = claim_result(1)
+
+    idempotency._reclaim(session, None, connection)
+    connection.execute.assert_called_once_with(session.info[CLAIM])
+    idempotency._check_claim(session)
+
+    idempotency._claim_committed(session)
+    idempotency._reclaim(session, None, connection)
+    connection.execute.assert_called_once()
+
+
+async def test_commit_is_refused_when_a_duplicate_took_the_key_meanwhile():
+    session, repository = await claimed_session()
+    connection = MagicMock()
+    connection.execute.return_value = claim_result(0)
+
+    idempotency._reclaim(session, None, connection)
+    with pytest.raises(IdempotencyKeyInUseError):
+        idempotency._check_claim(session)
+
+    # storing the response of a failed operation does not claim again
+    await repository.save(uuid.uuid4(), "key", "fingerprint", 400, {})
+    assert CLAIM not in session.info and CLAIM_LOST not in session.info
+
+
+def test_claim_inserts_only_under_the_advisory_lock_of_the_key():
+    repository = SQLIdempotencyRepository(AsyncMock(info={}))
+    statement = repository._claim_statement(uuid.uuid4(), "key", "fingerprint")
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+
+    insert = sql[sql.index("INSERT") : sql.index("ON CONFLICT")]
+    assert "WHERE pg_try_advisory_xact_lock(" in insert
+
+
+async def test_concurrent_duplicate_is_refused_while_the_first_request_runs():
+    # the advisory lock of the key, held until the first transaction ends
+    holder = []
+
+    def request_session():
+        session = AsyncMock(info={})
+
+        async def execute(statement):
+            if not holder or holder[0] is session:
+                holder[:] = [session]
+                return claim_result(1)
+            # no lock, no insert - and the first claim is not committed yet
+            return claim_result(0)
+
+        session.execute.side_effect = execute
+        return session
+
+    user_id = uuid.uuid4()
+    first, duplicate = request_session(), request_session()
+    running, finish = asyncio.Event(), asyncio.Event()
+
+    async def buy():
+        running.set()
+        await finish.wait()
+        return {"total_spent": 40}
+
+    async def send(session, call):
+        return await run_idempotent(
+            SQLIdempotencyRepository(session), user_id, "key", "fingerprint", call
+        )
+
+    first_request = asyncio.create_task(send(first, buy))
+    await running.wait()
+    with pytest.raises(HTTPException) as e:
+        await asyncio.wait_for(send(duplicate, AsyncMock()), timeout=1)
+    assert e.value.status_code == 409
+    duplicate.commit.assert_not_awaited()
+
+    finish.set()
+    assert await first_request == {"total_spent": 40}
+    first.commit.assert_awaited_once()
@@ -0,0 +1,142 @@
+import time
+import uuid
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+from sqlalchemy.dialects import postgresql
+
+from app.vending.change import ChangeIndex
+from app.vending.leases import Lease, StockLeases
+from app.vending.models import BuyProduct
+from app.vending.repository import SQLVendingRepository
+
+MACHINE_ID = uuid.UUID("00000000-0000-0000-0000-000000000000")
+PRODUCT_ID = uuid.uuid4()
+
+
+def make_leases(size=10, granted=True):
+    leases = StockLeases(size=size, duration=30, worker_id="test")
+
+    async def grant(machine_id, product_id):
+        if not granted:
+            return None
+        return Lease(uuid.uuid4(), product_id, size, time.monotonic() + 27)
+
+    leases._grant = AsyncMock(side_effect=grant)
+    return leases
+
+
+async def test_one_grant_per_block_of_sales():
+    leases = make_leases(size=3)
+    sold = [await leases.reserve(MACHINE_ID, PRODUCT_ID, 1) for _ in range(7)]
+
+    assert leases._grant.await_count == 3
+    assert sold[0] is sold[1] is sold[2]
+    assert sold[3] is not sold[0]
+    assert sold[6].units == 2
+
+
+async def test_purchases_larger_than_the_lease_lock_the_product():
+    leases = make_leases(size=3)
+    assert await leases.reserve(MACHINE_ID, PRODUCT_ID, 4) is None
+    lease = await leases.reserve(MACHINE_ID, PRODUCT_ID, 2)
+    # one unit left - not enough, and not worth a new block
+    assert await leases.reserve(MACHINE_ID, PRODUCT_ID, 2) is None
+    assert lease.units == 1
+    leases._grant.assert_awaited_once()
+
+
+async def test_denied_grant_is_not_asked_again_right_away():
+    leases = make_leases(granted=False)
+    assert await leases.reserve(MACHINE_ID, PRODUCT_ID, 1) is None
+    assert await leases.reserve(MACHINE_ID, PRODUCT_ID, 1) is None
+    leases._grant.assert_awaited_once()
+
+
+async def test_expired_lease_is_replaced():
+    leases = make_leases()
+    first = await leases.reserve(MACHINE_ID, PRODUCT_ID, 1)
+    first.usable_until = time.monotonic() - 1
+    assert await leases.reserve(MACHINE_ID, PRODUCT_ID, 1) is not first
+
+
+async def test_released_units_only_return_to_the_lease_in_use():
+    leases = make_leases()
+    lease = await leases.reserve(MACHINE_ID, PRODUCT_ID, 4)
+    leases.release(lease, 4)
+    assert lease.units == 10
+
+    leases.forget(lease)
+    leases.release(lease, 1)
+    assert lease.units == 10
+    assert await leases.reserve(MACHINE_ID, PRODUCT_ID, 1) is not lease
+
+
+def make_repository(leases, leased):
+    session = AsyncMock(info={})
+    session.in_transaction = MagicMock(return_value=True)
+    row = SimpleNamespace(
+        role="buyer",
+        deposit=100,
+        product_name="cola",
+        cost=40,
+        amount_available=5,
+        leased=leased,
+        coins=None,
+        sold=1 if leased is not None else 0,
+        charged=1 if leased is not None else 0,
+    )
+    session.execute.return_value = MagicMock(one=MagicMock(return_value=row))
+    return SQLVendingRepository(session, MACHINE_ID, leases=leases), session
+
+
+request = BuyProduct(product_id=PRODUCT_ID, amount=2, user_id=uuid.uuid4())
+
+
+async def test_leased_sale_decrements_the_lease_not_the_product():
+    leases = make_leases()
+    repository, session = make_repository(leases, leased=10)
+    state = await repository.buy_product(request)
+
+    assert state.applied
+    assert state.amount_available == 15
+    sql = str(session.execute.await_args.args[0].compile(dialect=postgresql.dialect()))
+    assert "UPDATE stock_leases" in sql
+    assert "UPDATE products" not in sql
+    # only the lease row is locked
+    assert sql.count("FOR UPDATE") == 1
+
+    await repository.commit()
+    assert leases._leases[PRODUCT_ID].units == 8
+
+
+async def test_rolled_back_sale_gives_the_units_back():
+    leases = make_leases()
+    repository, _ = make_repository(leases, leased=10)
+    await repository.buy_product(request)
+    await repository.rollback()
+    assert leases._leases[PRODUCT_ID].units == 10
+
+
+async def test_sale_from_a_returned_lease_is_not_applied_and_forgets_it():
+    leases = make_leases()
+    repository, _ = make_repository(leases, leased=None)
+    state = await repository.buy_product(request)
+
+    assert not state.applied
+    assert PRODUCT_ID not in leases._leases
+
+
+def test_purchase_without_a_known_change_index_reads_the_product_once():
+    repository = SQLVendingRepository(
+        AsyncMock(), MACHINE_ID, change_index=ChangeIndex(1000)
+    )
+    sql = str(repository._buy_statement(request).compile(dialect=postgresql.dialect()))
+    assert sql.count("FROM products") == 1
+    assert "product AS" not in sql
+
+    repository.change_index.set((1, 1, 1, 1, 1))
+    sql = str(repository._buy_statement(request).compile(dialect=postgresql.dialect()))
+    # the unlocked copy reports the product when the change check filters it
+    assert sql.count("FROM products") == 2
+    assert "get_bit" in sql
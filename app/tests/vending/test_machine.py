@@ -0,0 +1,100 @@
+import uuid
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.errors import NotEnoughChangeError
+from app.vending.machine import CoinLedger, InMemoryVendingMachine
+from app.vending.models import Change
+
+
+@pytest.fixture
+def ledger():
+    ledger = CoinLedger(uuid.uuid4(), flush_interval=3600, max_pending=3)
+    ledger._read = AsyncMock(
+        return_value=Change(root={5: 1, 10: 1, 20: 1, 50: 1, 100: 1})
+    )
+    stored = [ledger._read.return_value]
+
+    async def write(delta):
+        stored[0] += delta
+        return stored[0]
+
+    ledger._write = AsyncMock(side_effect=write)
+    ledger.stored = stored
+    yield ledger
+
+
+async def test_in_memory_machine_recovers_from_last_flushed_state(ledger):
+    vending_machine = InMemoryVendingMachine(ledger)
+    current = await vending_machine.add_coin(20)
+
+    assert current.root == {5: 1, 10: 1, 20: 2, 50: 1, 100: 1}
+    ledger._read.assert_awaited_once()
+    ledger._write.assert_not_awaited()
+    await ledger.close()
+
+
+async def test_in_memory_machine_leaves_coins_untouched_on_failed_removal(ledger):
+    vending_machine = InMemoryVendingMachine(ledger)
+    with pytest.raises(NotEnoughChangeError):
+        await vending_machine.remove_coins(
+            Change(root={5: 1, 10: 0, 20: 2, 50: 0, 100: 0})
+        )
+    coins = await vending_machine.get_coins()
+    assert coins.root == {5: 1, 10: 1, 20: 1, 50: 1, 100: 1}
+    await ledger.close()
+
+
+async def test_in_memory_machine_flushes_when_too_many_changes_pending(ledger):
+    vending_machine = InMemoryVendingMachine(ledger)
+    for _ in range(3):
+        await vending_machine.add_coin(5)
+        await vending_machine.commit()
+
+    ledger._write.assert_awaited_once_with(
+        Change(root={5: 3, 10: 0, 20: 0, 50: 0, 100: 0})
+    )
+    assert ledger.pending == 0
+    await ledger.close()
+    ledger._write.assert_awaited_once()
+
+
+async def test_in_memory_machine_flushes_deltas_on_top_of_other_writes(ledger):
+    vending_machine = InMemoryVendingMachine(ledger)
+    await vending_machine.add_coin(5)
+    await vending_machine.commit()
+    # written to the database by someone else meanwhile
+    ledger.stored[0] += Change(root={5: 0, 10: 2, 20: 0, 50: 0, 100: 0})
+
+    await ledger.flush()
+    assert ledger.stored[0].root == {5: 2, 10: 3, 20: 1, 50: 1, 100: 1}
+    assert (await vending_machine.get_coins()) == ledger.stored[0]
+    await ledger.close()
+
+
+async def test_in_memory_machine_flush_never_takes_missing_coins(ledger):
+    vending_machine = InMemoryVendingMachine(ledger)
+    await vending_machine.remove_coins(Change(root={5: 1, 10: 0, 20: 0, 50: 0, 100: 0}))
+    await vending_machine.commit()
+    ledger._write.side_effect = NotEnoughChangeError()
+
+    with pytest.raises(NotEnoughChangeError):
+        await ledger.flush()
+    assert ledger.pending == 1
+
+
+async def test_in_memory_machine_counts_coins_only_once_committed(ledger):
+    vending_machine = InMemoryVendingMachine(ledger)
+    await vending_machine.add_coin(50)
+    await vending_machine.remove_coins(Change(root={5: 1, 10: 0, 20: 0, 50: 0, 100: 0}))
+    # the deposit is not committed, its coin cannot be paid out yet
+    assert (await ledger.get_coins()).root == {5: 0, 10: 1, 20: 1, 50: 1, 100: 1}
+
+    await vending_machine.rollback()
+    assert (await ledger.get_coins()).root == {5: 1, 10: 1, 20: 1, 50: 1, 100: 1}
+
+    await vending_machine.add_coin(50)
+    await vending_machine.commit()
+    assert (await ledger.get_coins()).root == {5: 1, 10: 1, 20: 1, 50: 2, 100: 1}
+    await ledger.close()
@@ -0,0 +1,174 @@
+import uuid
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.core.config import settings
+from app.errors import (
+    ConcurrentUpdateError,
+    NotEnoughChangeError,
+    NotEnoughMoneyError,
+    NotEnoughProductError,
+    ProductNotFoundError,
+    UserNotFoundError,
+)
+from app.vending.models import BuyProduct, Change, Deposit, PurchaseState
+from app.vending.service import VendingService
+
+
+def make_service(state: PurchaseState):
+    vending_repository = AsyncMock()
+    vending_repository.buy_product.return_value = state
+    service = VendingService(
+        user_repository=None,
+        product_repository=None,
+        vending_machine=AsyncMock(),
+        vending_repository=vending_repository,
+    )
+    return service, vending_repository
+
+
+def make_state(**kwargs):
+    values = dict(
+        role="buyer",
+        deposit=100,
+        product_name="cola",
+        cost=40,
+        amount_available=3,
+        coins=Change(root={5: 0, 10: 0, 20: 3, 50: 1, 100: 0}),
+        applied=True,
+    )
+    values.update(kwargs)
+    return PurchaseState(**values)
+
+
+request = BuyProduct(product_id=uuid.uuid4(), user_id=uuid.uuid4(), amount=1)
+
+
+async def test_buy_product_commits_once_and_returns_change():
+    service, vending_repository = make_service(make_state())
+    summary = await service.buy_product(request)
+
+    assert summary.total_spent == 40
+    assert summary.product_name == "cola"
+    assert summary.change.root == {5: 0, 10: 0, 20: 3, 50: 0, 100: 0}
+    vending_repository.commit.assert_awaited_once()
+    vending_repository.rollback.assert_not_awaited()
+
+
+@pytest.mark.parametrize(
+    "state, error",
+    [
+        ({"role": None, "deposit": None}, UserNotFoundError),
+        (
+            {"product_name": None, "cost": None, "amount_available": None},
+            ProductNotFoundError,
+        ),
+        ({"amount_available": 0, "applied": False}, NotEnoughProductError),
+        ({"deposit": 35, "applied": False}, NotEnoughMoneyError),
+        ({"deposit": 70}, NotEnoughChangeError),
+    ],
+)
+async def test_buy_product_rolls_back_on_error(state, error):
+    service, vending_repository = make_service(make_state(**state))
+    with pytest.raises(error):
+        await service.buy_product(request)
+    vending_repository.rollback.assert_awaited_once()
+    vending_repository.commit.assert_not_awaited()
+
+
+async def test_buy_product_retries_when_an_optimistic_write_lost():
+    service, vending_repository = make_service(None)
+    vending_repository.buy_product.side_effect = [
+        make_state(applied=False),
+        make_state(),
+    ]
+    summary = await service.buy_product(request)
+
+    assert summary.total_spent == 40
+    assert vending_repository.buy_product.await_count == 2
+    vending_repository.rollback.assert_awaited_once()
+    vending_repository.commit.assert_awaited_once()
+
+
+async def test_buy_product_rejected_by_the_change_index():
+    service, vending_repository = make_service(make_state(deposit=70, applied=False))
+    with pytest.raises(NotEnoughChangeError):
+        await service.buy_product(request)
+    vending_repository.buy_product.assert_awaited_once()
+    vending_repository.rollback.assert_awaited_once()
+
+
+async def test_buy_product_retries_when_the_change_index_was_behind():
+    service, vending_repository = make_service(None)
+    vending_repository.buy_product.side_effect = [
+        make_state(applied=False),
+        make_state(),
+    ]
+    summary = await service.buy_product(request)
+
+    assert summary.total_spent == 40
+    assert vending_repository.buy_product.await_count == 2
+    vending_repository.commit.assert_awaited_once()
+
+
+async def test_buy_product_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(settings, "OPTIMISTIC_MAX_RETRIES", 2)
+    service, vending_repository = make_service(make_state(applied=False))
+    with pytest.raises(ConcurrentUpdateError):
+        await service.buy_product(request)
+    assert vending_repository.buy_product.await_count == 3
+
+
+def make_reset_service(deposit: int, coins: Change):
+    user_repository = AsyncMock()
+    user_repository.get_full.return_value = AsyncMock(role="buyer", deposit=deposit)
+    vending_machine = AsyncMock()
+    vending_machine.get_coins.return_value = coins
+    vending_repository = AsyncMock()
+    service = VendingService(
+        user_repository=user_repository,
+        product_repository=None,
+        vending_machine=vending_machine,
+        vending_repository=vending_repository,
+    )
+    return service, user_repository, vending_machine, vending_repository
+
+
+async def test_reset_user_deposit_is_one_transaction():
+    service, users, machine, vending_repository = make_reset_service(
+        60, Change(root={5: 0, 10: 1, 20: 0, 50: 1, 100: 0})
+    )
+    user_id = uuid.uuid4()
+    await service.reset_user_deposit(user_id)
+
+    change = Change.from_counts((0, 1, 0, 1, 0))
+    users.reset_deposit.assert_awaited_once_with(
+        user_id, expected=60, commit=False, change=change
+    )
+    machine.remove_coins.assert_awaited_once_with(change)
+    vending_repository.commit.assert_awaited_once()
+    vending_repository.rollback.assert_not_awaited()
+
+
+async def test_reset_user_deposit_rolls_back_the_deposit_without_change():
+    service, users, machine, vending_repository = make_reset_service(
+        60, Change(root={5: 0, 10: 1, 20: 0, 50: 1, 100: 0})
+    )
+    machine.remove_coins.side_effect = NotEnoughChangeError()
+    with pytest.raises(NotEnoughChangeError):
+        await service.reset_user_deposit(uuid.uuid4())
+    vending_repository.rollback.assert_awaited_once()
+    vending_repository.commit.assert_not_awaited()
+
+
+async def test_deposit_coins_is_one_transaction():
+    service, users, machine, vending_repository = make_reset_service(
+        0, Change(root={5: 0, 10: 0, 20: 0, 50: 0, 100: 0})
+    )
+    deposit = Deposit(coin=50, user_id=uuid.uuid4())
+    await service.deposit_coins(deposit)
+
+    users.deposit_coins.assert_awaited_once_with(deposit, commit=False)
+    machine.add_coin.assert_awaited_once_with(50)
+    vending_repository.commit.assert_awaited_once()
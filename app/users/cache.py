@@ -0,0 +1,14 @@
+from uuid import UUID
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+
+# identity of authenticated users (`UserRead` - no deposit) by user id
+user_cache = TTLCache(
+    maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS
+)
+
+
+def invalidate_user(user_id: UUID | str):
+    """Drop a cached user - call whenever username, role or existence changes"""
+    user_cache.invalidate(str(user_id))
@@ -2,10 +2,11 @@ from enum import Enum
 from typing import Optional
 from uuid import UUID
 
-from pydantic import BaseModel, ConfigDict, validator
+from pydantic import BaseModel, ConfigDict, Field, validator
 
 
 AVAILABLE_COINS = [5, 10, 20, 50, 100]
+DEFAULT_VENDING_ID = UUID("00000000-0000-0000-0000-000000000000")
 
 class UserRole(str, Enum):
     seller = "seller"
@@ -18,6 +19,8 @@ class UserRead(BaseModel):
     id: UUID
     username: str
     role: UserRole
+    # machine the user belongs to - used for access checks, not returned
+    vending_id: UUID = Field(default=DEFAULT_VENDING_ID, exclude=True)
 
 
 class UserReadFull(UserRead):
@@ -35,7 +38,6 @@ class BuyerRead(BaseModel):
 class UserUpdate(BaseModel):
     password: Optional[str]
     role: Optional[UserRole]
-    deposit: Optional[int]
 
 
 class UserCreate(BaseModel):
@@ -5,9 +5,12 @@ from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from sqlalchemy import delete, select, update
+from app.db.sql import ledger
 from app.db.sql.models import User
 from app.db.sql.session import get_session
-from app.errors import NotEnoughMoneyError
+from app.errors import ConcurrentUpdateError
+from app.users.cache import invalidate_user
+from app.vending.models import Change
 
 from app.users.models import (
     BuyerRead,
@@ -29,11 +32,7 @@ class UserRepository(ABC):
         pass
 
     @abstractmethod
-    async def get_for_update(self, id: UUID) -> Optional[UserReadFull]:
-        pass
-
-    @abstractmethod
-    async def decrease_deposit(self, id: UUID) -> Optional[UserRead]:
+    async def get_full(self, id: UUID) -> Optional[UserReadFull]:
         pass
 
     @abstractmethod
@@ -47,15 +46,29 @@ class UserRepository(ABC):
         pass
 
     @abstractmethod
-    async def deposit_coins(self, request: UserDeposit) -> BuyerRead:
+    async def deposit_coins(
+        self, request: UserDeposit, commit: bool = True
+    ) -> BuyerRead:
         pass
 
     @abstractmethod
-    async def reset_deposit(self, user_id: UUID):
+    async def reset_deposit(
+        self,
+        user_id: UUID,
+        expected: Optional[int] = None,
+        commit: bool = True,
+        change: Optional[Change] = None,
+    ):
         pass
 
 
 class SQLUserRepository:
+    """Users and their deposit.
+
+    The deposit is kept in the ledger (`app.db.sql.ledger`): deposits and
+    resets append entries and never lock or write the user row.
+    """
+
     def __init__(self, session: AsyncSession):
         self.session = session
 
@@ -63,6 +76,7 @@ class SQLUserRepository:
         """Delete current user"""
         await self.session.execute(delete(User).where(User.id == id))
         await self.session.commit()
+        invalidate_user(id)
 
     async def update_current_user(
         self, current_user: User, update_request: UserUpdate
@@ -71,9 +85,14 @@ class SQLUserRepository:
         await self.session.execute(
             update(User)
             .where(User.id == current_user.id)
-            .values(**update_request.model_dump(exclude_unset=True))
+            .values(
+                **update_request.model_dump(exclude_unset=True),
+                version=User.version + 1,
+            )
         )
         await self.session.commit()
+        # role may have changed
+        invalidate_user(current_user.id)
         usr = await self.session.execute(select(User).where(User.id == current_user.id))
         return UserRead.model_validate(usr)
 
@@ -96,28 +115,59 @@ class SQLUserRepository:
         await self.session.refresh(user)
         return UserRead.model_validate(user)
 
-    async def deposit_coins(self, request: UserDeposit) -> BuyerRead:
-        """Deposit coins - make sure to use the correct coin values and lock the table for that"""
-
+    async def deposit_coins(
+        self, request: UserDeposit, commit: bool = True
+    ) -> BuyerRead:
+        """Deposit coins - appended to the ledger, nothing to lock"""
         q = await self.session.execute(
-            select(User).where(User.id == request.user_id).with_for_update()
-        )
-        user = q.scalar_one_or_none()
-        if user:
-            await self.session.execute(
-                update(User)
-                .where(User.id == request.user_id)
-                .values(deposit=User.deposit + request.coin)
+            ledger.credit(
+                User.id,
+                User.vending_id,
+                request.coin,
+                where=User.id == request.user_id,
+                coins=Change.of(request.coin),
             )
-        else:
+        )
+        if q.rowcount == 0:
             raise ValueError("User not found")
-        await self.session.commit()
-        await self.session.refresh(user)
-        return BuyerRead.model_validate(user)
-
-    async def reset_deposit(self, id: UUID):
-        await self.session.execute(update(User).where(User.id == id).values(deposit=0))
-        await self.session.commit()
+        if commit:
+            await self.session.commit()
+        # the user loaded before the credit is still in the identity map
+        user = await self.session.execute(
+            select(User)
+            .where(User.id == request.user_id)
+            .execution_options(populate_existing=True)
+        )
+        return BuyerRead.model_validate(user.scalar_one())
+
+    async def reset_deposit(
+        self,
+        id: UUID,
+        expected: Optional[int] = None,
+        commit: bool = True,
+        change: Optional[Change] = None,
+    ):
+        """Refund `expected` (the whole deposit by default) as paid out in `change`
+
+        Raises `ConcurrentUpdateError` when another debit of the user came first.
+        """
+        q = await self.session.execute(
+            ledger.debit(
+                "refund",
+                User.id,
+                User.vending_id,
+                User.deposit if expected is None else expected,
+                balance=User.deposit,
+                debit_seq=ledger.next_debit_seq(User.id),
+                where=User.id == id,
+                coins=change,
+            )
+        )
+        if q.rowcount == 0:
+            await self.session.rollback()
+            raise ConcurrentUpdateError()
+        if commit:
+            await self.session.commit()
         return {"message": "Vending machine reset successfully"}
 
     async def get(self, id: UUID) -> Optional[UserRead]:
@@ -125,32 +175,11 @@ class SQLUserRepository:
         user = await self.session.execute(select(User).where(User.id == id))
         return UserRead.model_validate(user.scalar_one())
 
-    async def get_for_update(self, id: UUID) -> Optional[UserReadFull]:
-        """Get user by id for update"""
-        user = await self.session.execute(
-            select(User).where(User.id == id).with_for_update()
-        )
+    async def get_full(self, id: UUID) -> Optional[UserReadFull]:
+        """Get user by id with the deposit"""
+        user = await self.session.execute(select(User).where(User.id == id))
         return UserReadFull.model_validate(user.scalar_one())
 
-    async def decrease_deposit(self, id: UUID, amount: int) -> Optional[UserRead]:
-        """Update user deposit"""
-        q = await self.session.execute(
-            select(User).where(User.id == id).with_for_update()
-        )
-        user = q.scalar_one_or_none()
-        if user:
-            if user.deposit < amount:
-                raise NotEnoughMoneyError()
-
-            await self.session.execute(
-                update(User).where(User.id == id).values(deposit=User.deposit - amount)
-            )
-        else:
-            raise ValueError("User not found")
-        await self.session.commit()
-        await self.session.refresh(user)
-        return BuyerRead.model_validate(user)
-
 
 async def get_user_repository(session=Depends(get_session)) -> UserRepository:
     return SQLUserRepository(session=session)
@@ -0,0 +1,216 @@
+"""
+Bounded change-making.
+
+The machine holds a limited number of every coin, so the classic greedy
+"largest coin first" loop is not enough - e.g. 60 owed with one 50 and
+three 20s in the machine is payable (3 x 20) but greedy takes the 50 and
+gets stuck. `ChangeSolver` runs a dynamic program over amounts (in units of
+the gcd of `AVAILABLE_COINS`) that returns a minimum-coin plan or proves
+that none exists.
+
+Tables are built per inventory and kept in a small LRU so repeated calls for
+the same coins in the machine (buy attempts, resets) do not recompute them.
+
+`ChangeIndex` only answers whether an amount can be paid out, for every
+amount up to a bound, and follows the coins of one machine as they change -
+cheap enough to consult before a purchase takes any lock, and for every
+product of a listing.
+"""
+
+import time
+from collections import deque
+from functools import lru_cache, reduce
+from math import gcd
+from typing import Optional, Sequence
+
+from app.users.models import AVAILABLE_COINS
+
+COINS: tuple[int, ...] = tuple(sorted(AVAILABLE_COINS))
+UNIT: int = reduce(gcd, COINS)
+INF = float("inf")
+
+# how many distinct inventories keep their tables around
+SOLVER_CACHE_SIZE = 128
+
+
+class ChangeSolver:
+    """Minimum-coin change for one fixed coin inventory.
+
+    `counts` are the number of coins available per denomination, in the
+    order of `COINS`. Tables are grown lazily up to the largest amount asked
+    for, never beyond the total value of the inventory.
+    """
+
+    def __init__(self, counts: Sequence[int]):
+        if len(counts) != len(COINS):
+            raise ValueError("Inventory must have a count for every coin")
+        self.counts: tuple[int, ...] = tuple(counts)
+        self.total_units: int = sum(
+            (coin // UNIT) * count for coin, count in zip(COINS, self.counts)
+        )
+        self.limit: int = -1
+        # best[a] - minimum number of coins for `a` units using every coin
+        self.best: list[float] = []
+        # taken[i][a] - how many of COINS[i] the optimal plan for `a` units
+        # uses, considering only the first i + 1 denominations
+        self.taken: list[list[int]] = []
+
+    def _build(self, limit: int) -> None:
+        prev: list[float] = [0.0] + [INF] * limit
+        taken: list[list[int]] = []
+        for coin, count in zip(COINS, self.counts):
+            step = coin // UNIT
+            cur: list[float] = [INF] * (limit + 1)
+            used = [0] * (limit + 1)
+            # dp[a] = min over j <= count of prev[a - j * step] + j;
+            # per residue class this is a sliding window minimum
+            for residue in range(min(step, limit + 1)):
+                window: deque[tuple[int, float]] = deque()
+                for q, a in enumerate(range(residue, limit + 1, step)):
+                    value = prev[a] - q
+                    while window and window[-1][1] >= value:
+                        window.pop()
+                    window.append((q, value))
+                    while window[0][0] < q - count:
+                        window.popleft()
+                    best_q, best_value = window[0]
+                    cur[a] = best_value + q
+                    used[a] = q - best_q
+            taken.append(used)
+            prev = cur
+        self.best = prev
+        self.taken = taken
+        self.limit = limit
+
+    def _ensure(self, units: int) -> None:
+        if units <= self.limit:
+            return
+        # grow geometrically so a series of rising amounts stays cheap
+        self._build(min(self.total_units, max(units, 2 * self.limit, 1)))
+
+    def can_pay(self, amount: int) -> bool:
+        """Whether `amount` can be paid out exactly from this inventory."""
+        if amount < 0 or amount % UNIT:
+            return False
+        units = amount // UNIT
+        if units > self.total_units:
+            return False
+        self._ensure(units)
+        return self.best[units] != INF
+
+    def solve(self, amount: int) -> Optional[tuple[int, ...]]:
+        """Minimum-coin plan for `amount` (counts in the order of `COINS`)
+
+        Returns None when the amount cannot be paid out.
+        """
+        if not self.can_pay(amount):
+            return None
+        units = amount // UNIT
+        plan = [0] * len(COINS)
+        for i in reversed(range(len(COINS))):
+            plan[i] = self.taken[i][units]
+            units -= plan[i] * (COINS[i] // UNIT)
+        return tuple(plan)
+
+
+@lru_cache(maxsize=SOLVER_CACHE_SIZE)
+def get_solver(counts: tuple[int, ...]) -> ChangeSolver:
+    """Shared solver for an inventory, reused across calls"""
+    return ChangeSolver(counts)
+
+
+def _with_coins(payable: int, step: int, count: int, mask: int) -> int:
+    """Amounts payable once `count` coins of `step` units are added"""
+    # 1, 2, 4, ... coins and the rest - every count up to `count` is a sum of them
+    size = mask.bit_length()
+    chunk = 1
+    while count and chunk * step < size:
+        taken = min(chunk, count)
+        payable |= (payable << (taken * step)) & mask
+        count -= taken
+        chunk *= 2
+    return payable
+
+
+@lru_cache(maxsize=1024)
+def _overshoot_mask(cost: int) -> int:
+    # paying with coins, the last coin brings the deposit to at least `cost`,
+    # so the deposit exceeds it by less than that coin
+    mask = 0
+    for coin in COINS:
+        for amount in range(max(0, coin - cost), coin, UNIT):
+            mask |= 1 << (amount // UNIT)
+    return mask
+
+
+class ChangeIndex:
+    """Which amounts up to `max_amount` the coins of a machine can pay out
+
+    A bitset over amounts (in units of `UNIT`) built one denomination at a
+    time; the intermediate bitsets are kept, so a change of coins recomputes
+    only the denominations from the first changed one on. Unknown until the
+    coins are first `set`.
+    """
+
+    def __init__(self, max_amount: int):
+        self.size = max(max_amount, max(COINS)) // UNIT + 1
+        self._mask = (1 << self.size) - 1
+        self.counts: Optional[tuple[int, ...]] = None
+        # _prefix[i] - payable with the first i denominations
+        self._prefix: list[int] = [1]
+        self.updated_at: Optional[float] = None
+
+    @property
+    def known(self) -> bool:
+        return self.counts is not None
+
+    @property
+    def payable(self) -> int:
+        return self._prefix[-1]
+
+    def set(self, counts: Sequence[int]) -> None:
+        counts = tuple(counts)
+        if counts != self.counts:
+            start = 0
+            if self.counts is not None:
+                while self.counts[start] == counts[start]:
+                    start += 1
+            prefix = self._prefix[: start + 1]
+            for coin, count in zip(COINS[start:], counts[start:]):
+                prefix.append(_with_coins(prefix[-1], coin // UNIT, count, self._mask))
+            self._prefix = prefix
+            self.counts = counts
+        self.updated_at = time.monotonic()
+
+    def add(self, counts: Sequence[int]) -> None:
+        """Coins put into the machine - ignored while the index is unknown"""
+        if self.counts is not None:
+            self.set(map(int.__add__, self.counts, counts))
+
+    def stale(self, max_age: float) -> bool:
+        return self.updated_at is None or time.monotonic() - self.updated_at > max_age
+
+    def can_pay(self, amount: int) -> Optional[bool]:
+        """Whether `amount` can be paid out - `None` when not indexed"""
+        if self.counts is None or amount // UNIT >= self.size:
+            return None
+        if amount < 0 or amount % UNIT:
+            return False
+        return bool(self.payable >> (amount // UNIT) & 1)
+
+    def payable_bytes(self) -> bytes:
+        """The bitset, bit `n` of byte `n // 8` for `n` units - as `get_bit` reads bytea"""
+        return self.payable.to_bytes((self.size + 7) // 8, "little")
+
+    def window(self) -> Optional[int]:
+        """Payable amounts below the largest coin - all the listing flags depend on"""
+        if self.counts is None:
+            return None
+        return self.payable & ((1 << (max(COINS) // UNIT)) - 1)
+
+    def exact_change_only(self, cost: int) -> bool:
+        """Some deposit a buyer can reach paying `cost` with coins leaves change
+        the machine cannot pay - `False` while unknown"""
+        if self.counts is None:
+            return False
+        return bool(_overshoot_mask(cost) & ~self.payable)
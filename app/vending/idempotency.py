@@ -0,0 +1,287 @@
+"""
+`Idempotency-Key` support for vending requests.
+
+The first request with a key claims it in the same transaction as the
+operation, so the claim is committed together with the charge/deposit. Its
+response is then stored and a retry with the same key gets it back from one
+primary-key lookup - no service logic, no row locks on users or products.
+
+- same key, different request body -> 422
+- same key while the first request is still running (or it died after
+  committing) -> 409 until the key expires, never a second charge
+- 5xx and 409 responses are not stored, the claim is rolled back with the
+  request
+
+The claim also takes a transaction-level advisory lock on the key and only
+inserts the row when it got the lock. A duplicate sent while the first
+request runs fails to get the lock and gets 409 right away. It never waits
+on the unique index for the first request's transaction to end.
+
+A unit of work that is rolled back and retried (deadlock, lost optimistic
+write) loses the claim and the lock with it. Until the claim is committed,
+every new transaction of the session claims the key again, and the commit is
+refused when a duplicate request took it in between.
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+from datetime import datetime, timedelta
+import hashlib
+from typing import Any, Awaitable, Callable, Optional
+import uuid
+
+from fastapi import Depends, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import delete, event, func, literal, literal_column, null, select, true
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.session import async_session
+from app.db.sql.models import IdempotencyKey
+from app.db.sql.session import get_session
+from app.errors import IdempotencyKeyInUseError
+from app.log import get_logger
+
+log = get_logger(__name__)
+
+IDEMPOTENT_REPLAYS = metrics.Counter(
+    "idempotent_replays",
+    "Requests answered from a stored Idempotency-Key response",
+)
+
+
+PRIMARY_KEY = ("user_id", "key")
+
+# session.info keys - the claim not committed yet, and whether a retry lost it
+CLAIM = "idempotency_claim"
+CLAIM_LOST = "idempotency_claim_lost"
+
+
+class StoredResponse(BaseModel):
+    fingerprint: str
+    # None while the first request is in progress
+    status_code: Optional[int] = None
+    response: Any = None
+
+
+class IdempotencyRepository(ABC):
+    @abstractmethod
+    async def claim(
+        self, user_id: uuid.UUID, key: str, fingerprint: str
+    ) -> Optional[StoredResponse]:
+        pass
+
+    @abstractmethod
+    async def save(
+        self, user_id: uuid.UUID, key: str, fingerprint: str, status_code: int, body
+    ):
+        pass
+
+
+def claim_lock(user_id: uuid.UUID, key: str) -> int:
+    """pg_try_advisory_xact_lock key of an idempotency key"""
+    digest = hashlib.sha256(f"{user_id}:{key}".encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+class SQLIdempotencyRepository:
+    def __init__(self, session: AsyncSession, ttl: float = 86400.0):
+        self.session = session
+        self.ttl = timedelta(seconds=ttl)
+
+    def _claim_statement(self, user_id: uuid.UUID, key: str, fingerprint: str):
+        now = datetime.utcnow()
+        values = dict(
+            user_id=user_id,
+            key=key,
+            fingerprint=fingerprint,
+            created_at=now,
+            expires_at=now + self.ttl,
+        )
+        columns = IdempotencyKey.__table__.c
+        # no row to insert without the lock - the insert of a duplicate would
+        # wait on the unique index until the running request's transaction ends
+        row = select(*(literal(v, columns[k].type) for k, v in values.items())).where(
+            func.pg_try_advisory_xact_lock(claim_lock(user_id, key))
+        )
+        stmt = insert(IdempotencyKey).from_select(list(values), row)
+        claimed = (
+            stmt.on_conflict_do_update(
+                index_elements=[IdempotencyKey.user_id, IdempotencyKey.key],
+                set_={
+                    **{k: stmt.excluded[k] for k in values if k not in PRIMARY_KEY},
+                    "status_code": null(),
+                    "response": null(),
+                },
+                # an expired key is free to be used again
+                where=IdempotencyKey.expires_at <= now,
+            )
+            .returning(IdempotencyKey.key)
+            .cte("claimed")
+        )
+        # the existing row as seen before the insert, when the key is taken
+        existing = (
+            select(
+                IdempotencyKey.fingerprint,
+                IdempotencyKey.status_code,
+                IdempotencyKey.response,
+            )
+            .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+            .subquery("existing")
+        )
+        base = select(literal_column("1").label("one")).subquery("base")
+        return select(
+            select(func.count())
+            .select_from(claimed)
+            .scalar_subquery()
+            .label("claimed"),
+            existing.c.fingerprint,
+            existing.c.status_code,
+            existing.c.response,
+        ).select_from(base.outerjoin(existing, true()))
+
+    async def claim(
+        self, user_id: uuid.UUID, key: str, fingerprint: str
+    ) -> Optional[StoredResponse]:
+        """Take the key for this request - returns what is stored when it is taken
+
+        The claim is not committed here, it commits with the operation.
+        """
+        statement = self._claim_statement(user_id, key, fingerprint)
+        q = await self.session.execute(statement)
+        row = q.one()
+        if row.claimed:
+            self.session.info[CLAIM] = statement
+            return None
+        if row.fingerprint is None:
+            # taken by a request still running, or one that committed after
+            # this statement started
+            return StoredResponse(fingerprint=fingerprint)
+        return StoredResponse(
+            fingerprint=row.fingerprint,
+            status_code=row.status_code,
+            response=row.response,
+        )
+
+    async def save(
+        self, user_id: uuid.UUID, key: str, fingerprint: str, status_code: int, body
+    ):
+        # the claim is gone when the operation rolled back, write it again
+        self.session.info.pop(CLAIM, None)
+        self.session.info.pop(CLAIM_LOST, None)
+        now = datetime.utcnow()
+        stmt = insert(IdempotencyKey).values(
+            user_id=user_id,
+            key=key,
+            fingerprint=fingerprint,
+            status_code=status_code,
+            response=body,
+            created_at=now,
+            expires_at=now + self.ttl,
+        )
+        await self.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[IdempotencyKey.user_id, IdempotencyKey.key],
+                set_={"status_code": status_code, "response": body},
+            )
+        )
+        await self.session.commit()
+
+
+@event.listens_for(Session, "after_begin")
+def _reclaim(session: Session, transaction, connection):
+    statement = session.info.get(CLAIM)
+    if statement is not None:
+        session.info[CLAIM_LOST] = not connection.execute(statement).one().claimed
+
+
+@event.listens_for(Session, "before_commit")
+def _check_claim(session: Session):
+    if session.info.get(CLAIM_LOST):
+        raise IdempotencyKeyInUseError()
+
+
+@event.listens_for(Session, "after_commit")
+def _claim_committed(session: Session):
+    session.info.pop(CLAIM, None)
+    session.info.pop(CLAIM_LOST, None)
+
+
+async def get_idempotency_repository(
+    session: AsyncSession = Depends(get_session),
+) -> IdempotencyRepository:
+    return SQLIdempotencyRepository(session, ttl=settings.IDEMPOTENCY_KEY_TTL_SECONDS)
+
+
+def fingerprint(request: Request, payload: Optional[BaseModel]) -> str:
+    body = payload.model_dump_json() if payload is not None else ""
+    return hashlib.sha256(
+        f"{request.method} {request.url.path} {body}".encode()
+    ).hexdigest()
+
+
+async def run_idempotent(
+    repository: IdempotencyRepository,
+    user_id: uuid.UUID,
+    key: Optional[str],
+    fingerprint: str,
+    call: Callable[[], Awaitable[Any]],
+):
+    """Run `call` once per key - repeated requests get the stored response"""
+    if key is None:
+        return await call()
+
+    stored = await repository.claim(user_id, key, fingerprint)
+    if stored is not None:
+        if stored.fingerprint != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was already used for a different request.",
+            )
+        if stored.status_code is None:
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this Idempotency-Key is still in progress.",
+            )
+        IDEMPOTENT_REPLAYS.inc()
+        return JSONResponse(
+            stored.response,
+            status_code=stored.status_code,
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    try:
+        result = await call()
+    except HTTPException as e:
+        # business errors are answers too, a retry must not turn them around;
+        # conflicts are transient, a retry should run again
+        if e.status_code < 500 and e.status_code != 409:
+            await repository.save(
+                user_id, key, fingerprint, e.status_code, {"detail": e.detail}
+            )
+        raise
+    await repository.save(user_id, key, fingerprint, 200, jsonable_encoder(result))
+    return result
+
+
+async def purge_expired_keys() -> int:
+    async with async_session() as session:
+        q = await session.execute(
+            delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow())
+        )
+        await session.commit()
+        return q.rowcount
+
+
+async def purge_expired_keys_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await purge_expired_keys()
+        except Exception:
+            log.exception("Purging expired idempotency keys failed")
@@ -0,0 +1,234 @@
+"""
+Per-worker stock leases.
+
+Every purchase of a product locks its `products` row, so a best seller
+serializes all workers on one row. With `STOCK_LEASE_SIZE` set, a worker
+instead moves a block of units from `amount_available` into a `StockLease`
+row of its own - one product row lock per block - and sells from it:
+
+- units are reserved in process under a per-product asyncio lock
+- the purchase statement decrements the lease row, not the product row, so
+  only sales of the same worker wait on each other
+- the lease row is decremented only while it still has the units - it is the
+  authority, whatever the worker believes it holds
+
+Leases that expired are returned to `amount_available` by any worker, so the
+units of a crashed worker come back too; a worker returns its own leases on
+shutdown. A sale from a lease that was returned or voided meanwhile finds no
+row and the purchase is retried without it. A seller setting
+`amount_available` voids the leases of the product - the new amount is the
+whole stock.
+
+Blocks are only leased while at least as many units stay behind for the
+other workers; low-stock and large purchases lock the product row as before.
+While leased, units do not show in `amount_available`.
+"""
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import ClauseElement, delete, func, select, update
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.session import async_session
+from app.db.sql.locks import execute_locked
+from app.db.sql.models import Product, StockLease
+from app.log import get_logger
+from app.products.cache import catalog_cache
+
+log = get_logger(__name__)
+
+# this process - leases of a worker are returned when it shuts down
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+LEASE_GRANTS = metrics.Counter(
+    "stock_lease_grants",
+    "Attempts to lease a block of units by outcome",
+    ("outcome",),
+)
+LEASE_UNITS_RETURNED = metrics.Counter(
+    "stock_lease_units_returned", "Unsold leased units returned to products"
+)
+
+
+@dataclass(eq=False)
+class Lease:
+    id: uuid.UUID
+    product_id: uuid.UUID
+    # not reserved by a purchase of this worker yet
+    units: int
+    # monotonic time after which this worker stops selling from it
+    usable_until: float
+
+
+class StockLeases:
+    """Leases of this worker, at most one in use per product"""
+
+    def __init__(self, size: int, duration: float, worker_id: str = WORKER_ID):
+        self.size = size
+        self.duration = duration
+        self.worker_id = worker_id
+        self._leases: dict[uuid.UUID, Lease] = {}
+        # products that had too little stock to lease, until when
+        self._denied: dict[uuid.UUID, float] = {}
+        self._locks: defaultdict[uuid.UUID, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def reserve(
+        self, machine_id: uuid.UUID, product_id: uuid.UUID, amount: int
+    ) -> Optional[Lease]:
+        """Take `amount` units from the lease of the product, leasing a block
+        when there is none - `None` when the purchase has to lock the product"""
+        if amount > self.size:
+            return None
+        async with self._locks[product_id]:
+            now = time.monotonic()
+            lease = self._leases.get(product_id)
+            if lease is None or lease.units == 0 or now >= lease.usable_until:
+                # an old lease with units left goes back when it expires
+                self._leases.pop(product_id, None)
+                if self._denied.get(product_id, 0) > now:
+                    return None
+                lease = await self._grant(machine_id, product_id)
+                if lease is None:
+                    self._denied[product_id] = now + self.duration
+                    return None
+                self._leases[product_id] = lease
+            if lease.units < amount:
+                return None
+            lease.units -= amount
+            return lease
+
+    def release(self, lease: Lease, amount: int):
+        """Give back units of a purchase that was rolled back"""
+        if self._leases.get(lease.product_id) is lease:
+            lease.units += amount
+
+    def forget(self, lease: Lease):
+        """Stop using a lease whose row is gone"""
+        if self._leases.get(lease.product_id) is lease:
+            del self._leases[lease.product_id]
+
+    async def _grant(
+        self, machine_id: uuid.UUID, product_id: uuid.UUID
+    ) -> Optional[Lease]:
+        # own transaction - the lease outlives the purchase that asked for it
+        now = datetime.utcnow()
+        lease_id = uuid.uuid4()
+        async with async_session() as session:
+            q = await execute_locked(
+                session,
+                update(Product)
+                .where(
+                    Product.id == product_id,
+                    Product.vending_id == machine_id,
+                    Product.amount_available >= 2 * self.size,
+                )
+                .values(
+                    amount_available=Product.amount_available - self.size,
+                    version=Product.version + 1,
+                    updated_at=now,
+                )
+                .returning(Product.id)
+                .execution_options(synchronize_session=False),
+                "products",
+                "leases.grant",
+            )
+            if q.scalar_one_or_none() is None:
+                await session.rollback()
+                LEASE_GRANTS.labels("denied").inc()
+                return None
+            session.add(
+                StockLease(
+                    id=lease_id,
+                    product_id=product_id,
+                    vending_id=machine_id,
+                    worker_id=self.worker_id,
+                    units=self.size,
+                    expires_at=now + timedelta(seconds=self.duration),
+                    created_at=now,
+                )
+            )
+            await session.commit()
+        catalog_cache.invalidate(machine_id)
+        LEASE_GRANTS.labels("granted").inc()
+        # stop selling a little before the lease can be returned
+        return Lease(
+            id=lease_id,
+            product_id=product_id,
+            units=self.size,
+            usable_until=time.monotonic() + 0.9 * self.duration,
+        )
+
+    async def close(self):
+        """Return the leases of this worker - called on shutdown"""
+        self._leases.clear()
+        await return_leases(StockLease.worker_id == self.worker_id)
+
+
+async def return_leases(where: ClauseElement) -> int:
+    """Delete the leases `where` selects and add their unsold units back"""
+    now = datetime.utcnow()
+    async with async_session() as session:
+        # products before their leases, as everywhere else
+        await execute_locked(
+            session,
+            select(Product.id)
+            .where(Product.id.in_(select(StockLease.product_id).where(where)))
+            .order_by(Product.id)
+            .with_for_update(),
+            "products",
+            "leases.return",
+        )
+        returned = (
+            delete(StockLease)
+            .where(where)
+            .returning(StockLease.product_id, StockLease.units)
+            .cte("returned")
+        )
+        totals = (
+            select(returned.c.product_id, func.sum(returned.c.units).label("units"))
+            .group_by(returned.c.product_id)
+            .subquery("totals")
+        )
+        q = await session.execute(
+            update(Product)
+            .where(Product.id == totals.c.product_id, totals.c.units > 0)
+            .values(
+                amount_available=Product.amount_available + totals.c.units,
+                version=Product.version + 1,
+                updated_at=now,
+            )
+            .returning(Product.vending_id, totals.c.units)
+            .execution_options(synchronize_session=False)
+        )
+        rows = q.all()
+        await session.commit()
+    for machine_id in {row.vending_id for row in rows}:
+        catalog_cache.invalidate(machine_id)
+    units = sum(row.units for row in rows)
+    LEASE_UNITS_RETURNED.inc(units)
+    return units
+
+
+async def return_expired_leases_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            units = await return_leases(StockLease.expires_at <= datetime.utcnow())
+            if units:
+                log.info("Returned %s units of expired stock leases", units)
+        except Exception:
+            log.exception("Returning expired stock leases failed")
+
+
+stock_leases = StockLeases(
+    size=settings.STOCK_LEASE_SIZE, duration=settings.STOCK_LEASE_SECONDS
+)
@@ -1,21 +1,34 @@
 from abc import ABC, abstractmethod
+import asyncio
+from typing import Callable, Optional
 import uuid
-from fastapi import Depends
-from jwt import InvalidTokenError
-from sqlalchemy import select, update
+from fastapi import Depends, HTTPException, Request
+from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import case, select, update
+from app.core import security
 from app.core.config import settings
-from app.db.sql.session import get_session
+from app.core.session import async_session
+from app.db.sql.session import get_read_session, get_session
 from app.users.models import AVAILABLE_COINS
-from app.errors import NotEnoughChangeError
+from app.errors import InvalidCoinError, NotEnoughChangeError
+from app.vending.change import ChangeIndex, get_solver
 from app.vending.models import Change
+from app.log import get_logger
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db.sql.models import VendingMachine as VendingMachineModel
+from app.db.sql.locks import execute_locked
+from app.db.sql.models import VendingMachineCoin
+
+log = get_logger(__name__)
 
 
 class VendingMachine(ABC):
     @abstractmethod
-    async def get_coins_for_update(self):
+    async def get_coins(self) -> Change:
+        pass
+
+    @abstractmethod
+    async def get_coins_for_update(self) -> Change:
         pass
 
     @abstractmethod
@@ -34,8 +47,30 @@ class VendingMachine(ABC):
     async def add_coin(self, coin: int) -> Change:
         pass
 
+    @abstractmethod
+    async def add_coins(self, coins: Change) -> Change:
+        pass
+
+    @abstractmethod
+    async def commit(self):
+        """Called once the unit of work the writes belong to committed"""
+        pass
+
+    @abstractmethod
+    async def rollback(self):
+        """Called when the unit of work the writes belong to failed"""
+        pass
+
 
 class SQLVendingMachine:
+    """Coin inventory stored as one `vending_machine_coins` row per denomination.
+
+    Writes are relative (`count = count + n`) and only touch the rows of the
+    coins involved, so a deposit of one coin does not block a purchase that
+    pays out with other coins. They join the caller's transaction - the caller
+    commits or rolls back.
+    """
+
     def __init__(
         self,
         session: AsyncSession,
@@ -44,84 +79,341 @@ class SQLVendingMachine:
         self.session = session
         self.machine_id = machine_id
 
-    async def get_coins_for_update(self):
-        # get the coins from the db
-        q = await self.session.execute(
-            select(VendingMachineModel)
-            .where(VendingMachineModel.id == self.machine_id)
-            .with_for_update()
+    def _select_coins(self):
+        return select(VendingMachineCoin.coin, VendingMachineCoin.count).where(
+            VendingMachineCoin.vending_id == self.machine_id
         )
-        coins = q.scalars().first()
-        return Change.model_validate(coins.status)
+
+    def _observed(self, coins: Change) -> Change:
+        get_change_index(self.machine_id).set(coins.counts)
+        return coins
+
+    async def get_coins(self) -> Change:
+        q = await self.session.execute(self._select_coins())
+        return self._observed(Change.from_items(q.tuples().all()))
+
+    async def get_coins_for_update(self) -> Change:
+        q = await execute_locked(
+            self.session,
+            self._select_coins().with_for_update(),
+            "vending_machine_coins",
+            "machine.get_coins_for_update",
+        )
+        return self._observed(Change.from_items(q.tuples().all()))
 
     async def set_coins(
         self,
         c: Change,
     ):
-        # use VendingMachineModel to deposit the coins
         await self.session.execute(
-            update(VendingMachineModel)
-            .where(VendingMachineModel.id == self.machine_id)
-            .values(status=c.root)
+            update(VendingMachineCoin)
+            .where(VendingMachineCoin.vending_id == self.machine_id)
+            .values(count=case(c.root, value=VendingMachineCoin.coin, else_=0))
         )
-        await self.session.commit()
 
     async def reset_vending_machine(self):
-        # use VendingMachineModel to reset the vending machine
         await self.session.execute(
-            update(VendingMachineModel)
-            .where(VendingMachineModel.id == self.machine_id)
-            .values(status={c: 0 for c in AVAILABLE_COINS})
+            update(VendingMachineCoin)
+            .where(VendingMachineCoin.vending_id == self.machine_id)
+            .values(count=0)
         )
-        await self.session.commit()
 
     async def remove_coins(self, to_remove: Change) -> Change:
-        current = await self.get_coins_for_update()
-        for k, v in to_remove.root.items():
-            current[k] -= v
-            if current[k] < 0:
-                await self.session.rollback()
+        removed = to_remove.nonzero()
+        if removed:
+            # conditional decrement of the touched rows only - all or nothing
+            amount = case(removed, value=VendingMachineCoin.coin)
+            q = await self.session.execute(
+                update(VendingMachineCoin)
+                .where(
+                    VendingMachineCoin.vending_id == self.machine_id,
+                    VendingMachineCoin.coin.in_(removed),
+                    VendingMachineCoin.count >= amount,
+                )
+                .values(count=VendingMachineCoin.count - amount)
+            )
+            if q.rowcount != len(removed):
                 raise NotEnoughChangeError()
-        c = Change(root=current)
-        await self.set_coins(c)
-
-        return c
+        return await self.get_coins()
 
     async def add_coin(self, coin: int) -> Change:
         if coin not in AVAILABLE_COINS:
-            raise InvalidTokenError()
-        current = await self.get_coins_for_update()
-        current.root[coin] += 1
+            raise InvalidCoinError()
+        await self.session.execute(
+            update(VendingMachineCoin)
+            .where(
+                VendingMachineCoin.vending_id == self.machine_id,
+                VendingMachineCoin.coin == coin,
+            )
+            .values(count=VendingMachineCoin.count + 1)
+        )
+        return await self.get_coins()
+
+    async def add_coins(self, coins: Change) -> Change:
+        added = coins.nonzero()
+        if added:
+            await self.session.execute(
+                update(VendingMachineCoin)
+                .where(
+                    VendingMachineCoin.vending_id == self.machine_id,
+                    VendingMachineCoin.coin.in_(added),
+                )
+                .values(
+                    count=VendingMachineCoin.count
+                    + case(added, value=VendingMachineCoin.coin)
+                )
+            )
+        return await self.get_coins()
+
+    async def commit(self):
+        # the writes are part of the caller's transaction
+        pass
+
+    async def rollback(self):
+        pass
+
+
+class CoinLedger:
+    """Process-wide coin inventory of one machine with write-behind persistence.
+
+    Coins are counted in memory under an asyncio lock and written to
+    `vending_machine_coins` by a background flusher every `flush_interval`
+    seconds. At most `max_pending` coin operations are kept unflushed - past
+    that the caller waits for a flush, which bounds what a crash can lose.
+    The state is recovered from the last flush on first use.
+
+    The ledger lives in one process - settings refuse the memory backend with
+    more than one worker. A flush still writes what changed since the last one
+    (`count = count + delta`) and never takes coins that are not in the
+    database, so a second writer makes the flush fail instead of being
+    overwritten.
+    """
+
+    def __init__(
+        self,
+        machine_id: uuid.UUID,
+        flush_interval: float = settings.COIN_FLUSH_INTERVAL_SECONDS,
+        max_pending: int = settings.COIN_FLUSH_MAX_PENDING,
+    ):
+        self.machine_id = machine_id
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.coins: Optional[Change] = None
+        # the coins of the database as of the last read or flush
+        self.flushed: Optional[Change] = None
+        # the ledger is the only writer - the index is always exact
+        self.index = get_change_index(machine_id)
+        self.pending = 0
+        self.lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def _read(self) -> Change:
+        async with async_session() as session:
+            return await SQLVendingMachine(session, self.machine_id).get_coins()
+
+    async def _write(self, delta: Change) -> Change:
+        """Add `delta` to the database and return the counts it has now"""
+        changed = delta.nonzero()
+        count = VendingMachineCoin.count + case(changed, value=VendingMachineCoin.coin)
+        async with async_session() as session:
+            q = await session.execute(
+                update(VendingMachineCoin)
+                .where(
+                    VendingMachineCoin.vending_id == self.machine_id,
+                    VendingMachineCoin.coin.in_(changed),
+                    count >= 0,
+                )
+                .values(count=count)
+            )
+            if q.rowcount != len(changed):
+                await session.rollback()
+                raise NotEnoughChangeError()
+            coins = await SQLVendingMachine(session, self.machine_id).get_coins()
+            await session.commit()
+            return coins
+
+    async def _load(self):
+        if self.coins is None:
+            self.coins = self.flushed = await self._read()
+            self.index.set(self.coins.counts)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_periodically())
 
-        await self.set_coins(current)
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception(
+                    "Flushing coins of vending machine %s failed", self.machine_id
+                )
+
+    async def flush(self):
+        # flushes are serialized so an older snapshot never overwrites a newer one
+        async with self._flush_lock:
+            async with self.lock:
+                if not self.pending:
+                    return
+                snapshot, flushed = self.coins, self.pending
+            stored = await self._write(snapshot - self.flushed)
+            async with self.lock:
+                self.pending -= flushed
+                # changes made during the write stay on top of the new base
+                self.coins = stored + self.coins - snapshot
+                self.flushed = stored
+                self.index.set(self.coins.counts)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    async def get_coins(self) -> Change:
+        async with self.lock:
+            await self._load()
+            return self.coins
+
+    async def update(self, apply: Callable[[Change], Change]) -> Change:
+        """Replace the coins with `apply(coins)` atomically - raise in it to keep them"""
+        async with self.lock:
+            await self._load()
+            # Change is immutable, readers keep the vector they were given
+            current = self.coins = apply(self.coins)
+            self.index.set(current.counts)
+            self.pending += 1
+        if self.pending >= self.max_pending:
+            await self.flush()
         return current
 
 
-def get_vending_machine_id():
-    return settings.VENDING_MACHINE_ID
+_ledgers: dict[uuid.UUID, CoinLedger] = {}
+_change_indexes: dict[uuid.UUID, ChangeIndex] = {}
+
+
+def get_change_index(machine_id: uuid.UUID) -> ChangeIndex:
+    """What the coins of a machine can pay out, as last seen by this worker"""
+    machine_id = uuid.UUID(str(machine_id))
+    if machine_id not in _change_indexes:
+        _change_indexes[machine_id] = ChangeIndex(settings.CHANGE_INDEX_MAX_AMOUNT)
+    return _change_indexes[machine_id]
+
+
+def get_ledger(machine_id: uuid.UUID) -> CoinLedger:
+    machine_id = uuid.UUID(str(machine_id))
+    if machine_id not in _ledgers:
+        _ledgers[machine_id] = CoinLedger(machine_id)
+    return _ledgers[machine_id]
+
+
+async def close_ledgers():
+    """Flush every in-memory ledger - called on shutdown"""
+    for ledger in _ledgers.values():
+        await ledger.close()
+
+
+class InMemoryVendingMachine:
+    """`VendingMachine` on top of a process-wide `CoinLedger` - no DB lock per coin
+
+    Coins follow the unit of work: added coins are only counted on `commit`,
+    so nothing can pay them out before the deposit is committed; removed
+    coins are taken right away and given back on `rollback`.
+    """
+
+    def __init__(self, ledger: CoinLedger):
+        self.ledger = ledger
+        self._added = Change()
+        self._removed = Change()
+
+    async def get_coins(self) -> Change:
+        return await self.ledger.get_coins()
+
+    async def get_coins_for_update(self) -> Change:
+        # every write goes through the ledger lock, there is nothing to lock here
+        return await self.ledger.get_coins()
+
+    async def set_coins(self, c: Change):
+        await self.ledger.update(lambda coins: c)
+
+    async def reset_vending_machine(self):
+        await self.ledger.update(lambda coins: Change())
+
+    async def remove_coins(self, to_remove: Change) -> Change:
+        def apply(coins: Change) -> Change:
+            if not to_remove <= coins:
+                raise NotEnoughChangeError()
+            return coins - to_remove
+
+        current = await self.ledger.update(apply)
+        self._removed += to_remove
+        return current + self._added
+
+    async def add_coin(self, coin: int) -> Change:
+        if coin not in AVAILABLE_COINS:
+            raise InvalidCoinError()
+        return await self.add_coins(Change.of(coin))
+
+    async def add_coins(self, coins: Change) -> Change:
+        self._added += coins
+        return await self.ledger.get_coins() + self._added
+
+    async def commit(self):
+        added, self._added, self._removed = self._added, Change(), Change()
+        if added.nonzero():
+            await self.ledger.update(lambda coins: coins + added)
+
+    async def rollback(self):
+        removed, self._added, self._removed = self._removed, Change(), Change()
+        if removed.nonzero():
+            await self.ledger.update(lambda coins: coins + removed)
+
+
+optional_oauth2 = OAuth2PasswordBearer(tokenUrl="auth/access-token", auto_error=False)
+
+
+def get_vending_machine_id(
+    request: Request, token: Optional[str] = Depends(optional_oauth2)
+) -> uuid.UUID:
+    """Machine of the fleet the request is for
+
+    Taken from the `/machines/{machine_id}/...` path, then from the token's
+    `vending_id` claim, then the configured default machine.
+    """
+    machine_id = request.path_params.get("machine_id")
+    if machine_id is None and token:
+        machine_id = security.read_vending_claim(token)
+    try:
+        return uuid.UUID(str(machine_id or settings.VENDING_MACHINE_ID))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Vending machine not found")
 
 
 def get_vending_machine(
     session: AsyncSession = Depends(get_session),
     machine_id: uuid.UUID = Depends(get_vending_machine_id),
 ):
+    if settings.VENDING_MACHINE_BACKEND == "memory":
+        return InMemoryVendingMachine(get_ledger(machine_id))
+    return SQLVendingMachine(session, machine_id)
+
+
+def get_vending_machine_reader(
+    session: AsyncSession = Depends(get_read_session),
+    machine_id: uuid.UUID = Depends(get_vending_machine_id),
+):
+    """Machine for reading coins only - possibly on the read replica"""
+    if settings.VENDING_MACHINE_BACKEND == "memory":
+        return InMemoryVendingMachine(get_ledger(machine_id))
     return SQLVendingMachine(session, machine_id)
 
 
 async def calculate_change(current_coins: Change, amount: int) -> Change:
     # Only calculate - do not update yet
-    # init empty change dict
-    change = Change(root={c: 0 for c in AVAILABLE_COINS})
-
-    # iterate and get the largest first
-    for coin in sorted(AVAILABLE_COINS, reverse=True):
-        # check if the coin value is not too big and if there's enough coins of this type
-        while amount >= coin and current_coins.root[coin] > 0:
-            change.root[coin] += 1
-            amount -= coin
-            current_coins.root[coin] -= 1
-    # should be 0 after the loop
-    if amount > 0:
-        print(amount)
+    # minimum-coin plan that respects how many coins of each type are in the machine
+    # Change is laid out in the order of COINS, as the solver expects
+    plan = get_solver(current_coins.counts).solve(amount)
+    if plan is None:
         raise NotEnoughChangeError()
-    return change
+    return Change.from_counts(plan)
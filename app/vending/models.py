@@ -1,8 +1,13 @@
-from typing import Dict
+import operator
+from typing import Iterable, Optional
 from uuid import UUID
 
-from pydantic import BaseModel, validator, RootModel
+from pydantic import BaseModel, validator
+from pydantic_core import core_schema
 from app.users.models import AVAILABLE_COINS
+from app.vending.change import COINS
+
+POSITIONS = {coin: i for i, coin in enumerate(COINS)}
 
 
 class Deposit(BaseModel):
@@ -18,23 +23,128 @@ class Deposit(BaseModel):
             raise ValueError("Invalid coin amount")
 
 
+class BatchDeposit(BaseModel):
+    coins: list[int]
+    user_id: UUID
+
+    @validator("coins", each_item=True)
+    def validate_coins(coin):
+        if coin in AVAILABLE_COINS:
+            return coin
+        else:
+            raise ValueError("Invalid coin amount")
+
+    def as_change(self) -> "Change":
+        counts = [0] * len(COINS)
+        for coin in self.coins:
+            counts[POSITIONS[coin]] += 1
+        return Change.from_counts(counts)
+
+
 class BuyProduct(BaseModel):
     product_id: UUID
     amount: int
     user_id: UUID
 
 
-class Change(RootModel):
-    root: dict[int, int] = {c: 0 for c in AVAILABLE_COINS}
+class Change:
+    """Number of coins per denomination, a fixed vector in the order of `COINS`
 
-    @validator("root",)
-    def validate(cls, v: dict[int, int]):
-        print(v)
-        if sorted(AVAILABLE_COINS) == sorted(v.keys()):
-            return v
-        else:
+    Built from a `{coin: count}` dict (validated) or from counts/vector
+    arithmetic (not validated). Pydantic fields accept an instance as is and
+    serialize it to the same `{coin: count}` JSON object as before.
+    """
+
+    __slots__ = ("counts",)
+
+    def __init__(self, root: Optional[dict[int, int]] = None):
+        if root is None:
+            self.counts: tuple[int, ...] = _EMPTY
+            return
+        if len(root) != len(COINS) or any(coin not in root for coin in COINS):
+            raise ValueError("Invalid change amount")
+        self.counts = tuple(root[coin] for coin in COINS)
+
+    @classmethod
+    def from_counts(cls, counts: Iterable[int]) -> "Change":
+        change = object.__new__(cls)
+        change.counts = tuple(counts)
+        return change
+
+    @classmethod
+    def from_items(cls, items: Iterable[tuple[int, int]]) -> "Change":
+        """From (coin, count) pairs, denominations not listed count as 0"""
+        counts = [0] * len(COINS)
+        for coin, count in items:
+            counts[POSITIONS[coin]] = count
+        return cls.from_counts(counts)
+
+    @classmethod
+    def of(cls, coin: int, count: int = 1) -> "Change":
+        counts = [0] * len(COINS)
+        counts[POSITIONS[coin]] = count
+        return cls.from_counts(counts)
+
+    @property
+    def root(self) -> dict[int, int]:
+        return dict(zip(COINS, self.counts))
+
+    def nonzero(self) -> dict[int, int]:
+        return {coin: count for coin, count in zip(COINS, self.counts) if count}
+
+    def total(self) -> int:
+        return sum(coin * count for coin, count in zip(COINS, self.counts))
+
+    def __getitem__(self, coin: int) -> int:
+        return self.counts[POSITIONS[coin]]
+
+    def __add__(self, other: "Change") -> "Change":
+        return Change.from_counts(map(operator.add, self.counts, other.counts))
+
+    def __sub__(self, other: "Change") -> "Change":
+        return Change.from_counts(map(operator.sub, self.counts, other.counts))
+
+    def __le__(self, other: "Change") -> bool:
+        """Every denomination is covered by `other`"""
+        return all(map(operator.le, self.counts, other.counts))
+
+    def __ge__(self, other: "Change") -> bool:
+        return all(map(operator.ge, self.counts, other.counts))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Change) and self.counts == other.counts
+
+    def __hash__(self) -> int:
+        return hash(self.counts)
+
+    def __repr__(self) -> str:
+        return f"Change({self.root})"
+
+    @classmethod
+    def _validate(cls, value) -> "Change":
+        if isinstance(value, Change):
+            return value
+        try:
+            return cls({int(coin): int(count) for coin, count in value.items()})
+        except (AttributeError, TypeError, ValueError):
             raise ValueError("Invalid change amount")
 
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler):
+        counts = core_schema.dict_schema(
+            core_schema.int_schema(), core_schema.int_schema()
+        )
+        return core_schema.json_or_python_schema(
+            json_schema=core_schema.no_info_after_validator_function(cls, counts),
+            python_schema=core_schema.no_info_plain_validator_function(cls._validate),
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda change: change.root, return_schema=counts
+            ),
+        )
+
+
+_EMPTY = (0,) * len(COINS)
+
 
 class BuyProductSummary(BaseModel):
     #  API should return total they’ve spent, the product they’ve purchased and their change if there’s any (in an array of 5, 10, 20, 50 and 100 cent coins)
@@ -46,3 +156,26 @@ class BuyProductSummary(BaseModel):
     total_spent: int
     product_name: str
     change: Change
+
+
+class PurchaseState(BaseModel):
+    # rows as seen (and locked) by the single purchase statement, `None` when missing
+    role: Optional[str] = None
+    deposit: Optional[int] = None
+    product_name: Optional[str] = None
+    cost: Optional[int] = None
+    amount_available: Optional[int] = None
+    coins: Optional[Change] = None
+    # whether the conditional decrements were applied
+    applied: bool = False
+
+
+class DepositState(BaseModel):
+    # buyer as seen by the deposit statement, `None` when missing
+    role: Optional[str] = None
+    # set when the buyer was credited
+    id: Optional[UUID] = None
+    username: Optional[str] = None
+    deposit: Optional[int] = None
+    # whether the statement also stocked the machine
+    coins_applied: bool = False
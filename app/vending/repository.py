@@ -0,0 +1,387 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Optional
+import uuid
+
+from fastapi import Depends
+from sqlalchemy import (
+    LargeBinary,
+    and_,
+    case,
+    func,
+    literal,
+    literal_column,
+    null,
+    select,
+    true,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.sql import ledger
+from app.db.sql.locks import execute_locked
+from app.db.sql.models import (
+    LedgerEntry,
+    Product,
+    StockLease,
+    User,
+    VendingMachineCoin,
+)
+from app.db.sql.session import get_session
+from app.products.cache import catalog_cache
+from app.vending.change import UNIT, ChangeIndex
+from app.vending.leases import Lease, StockLeases, stock_leases
+from app.vending.machine import get_change_index, get_vending_machine_id
+from app.vending.models import BuyProduct, Change, DepositState, PurchaseState
+
+
+class VendingRepository(ABC):
+    @abstractmethod
+    async def buy_product(self, request: BuyProduct) -> PurchaseState:
+        pass
+
+    @abstractmethod
+    async def deposit_coins(self, user_id: uuid.UUID, coins: Change) -> DepositState:
+        pass
+
+    @abstractmethod
+    async def commit(self):
+        pass
+
+    @abstractmethod
+    async def rollback(self):
+        pass
+
+
+class SQLVendingRepository:
+    """Multi-table vending operations, each as one statement.
+
+    A purchase locks the product, decrements stock and appends the sale to
+    the deposit ledger when every check passes and reads the coins in the
+    machine - all in a single CTE, so it costs one round trip plus the commit.
+    A deposit appends to the ledger and stocks the machine the same way. The
+    buyer row is only read, never locked or written.
+
+    With `optimistic` the product is read without a lock and only written
+    when its `version` is still the one read. A sale that lost its
+    `debit_seq` to another debit of the buyer is not applied either; the
+    caller retries in both modes.
+
+    With `leases` a purchase that fits in the worker's lease of the product
+    decrements the lease row instead of the product row, see
+    `app.vending.leases`.
+
+    With a known `change_index` the product is only locked (and the purchase
+    only applied) when the index says the change can be paid. A purchase it
+    rejects takes no lock; the caller checks the rejection against the coins
+    the statement read, as the index of this worker may be behind.
+    """
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        machine_id: uuid.UUID = uuid.UUID("00000000-0000-0000-0000-000000000000"),
+        with_coins: bool = True,
+        optimistic: bool = False,
+        leases: Optional[StockLeases] = None,
+        change_index: Optional[ChangeIndex] = None,
+    ):
+        self.session = session
+        self.machine_id = machine_id
+        self.optimistic = optimistic
+        # skip reading coins when they are not kept in the database
+        self.with_coins = with_coins
+        self.leases = leases
+        self.change_index = change_index
+        # a purchase changed stock - the catalog is stale once committed
+        self._stock_changed = False
+        # lease units reserved by the purchase in progress
+        self._reserved: list[tuple[Lease, int]] = []
+
+    def _buy_statement(self, request: BuyProduct, lease: Optional[Lease] = None):
+        buyer = (
+            select(
+                User.id,
+                User.deposit,
+                User.role,
+                ledger.next_debit_seq(User.id).label("debit_seq"),
+            )
+            .where(User.id == request.user_id, User.vending_id == self.machine_id)
+            .cte("buyer")
+        )
+        item = select(
+            Product.id,
+            Product.cost,
+            Product.amount_available,
+            Product.product_name,
+            Product.version,
+        ).where(
+            Product.id == request.product_id,
+            Product.vending_id == self.machine_id,
+        )
+        indexed = self.change_index is not None and self.change_index.known
+        if indexed:
+            # what is reported when the change check leaves `item` empty
+            product = item.cte("product")
+            item = item.where(self._change_payable(buyer, request))
+        if not self.optimistic and lease is None:
+            item = item.with_for_update()
+        item = item.cte("item")
+        total = item.c.cost * request.amount
+        # onupdate defaults are not applied inside a CTE, set them explicitly
+        now = datetime.utcnow()
+        if lease is None:
+            stock = item.c.amount_available
+            leased = null()
+        else:
+            held = (
+                select(StockLease.id, StockLease.units)
+                .where(StockLease.id == lease.id)
+                .with_for_update()
+                .cte("lease")
+            )
+            stock = held.c.units
+            leased = select(held.c.units).scalar_subquery()
+        allowed = and_(
+            buyer.c.role != "seller",
+            stock >= request.amount,
+            buyer.c.deposit >= total,
+        )
+        if lease is None:
+            sold = (
+                update(Product)
+                .where(
+                    Product.id == item.c.id, Product.version == item.c.version, allowed
+                )
+                .values(
+                    amount_available=Product.amount_available - request.amount,
+                    version=Product.version + 1,
+                    updated_at=now,
+                )
+            )
+        else:
+            # the product row is only read
+            sold = (
+                update(StockLease)
+                .where(StockLease.id == held.c.id, allowed)
+                .values(units=StockLease.units - request.amount)
+            )
+        sold = sold.returning(literal_column("1")).cte("sold")
+        charged = (
+            ledger.debit(
+                "sale",
+                buyer.c.id,
+                self.machine_id,
+                total,
+                balance=buyer.c.deposit,
+                debit_seq=buyer.c.debit_seq,
+                where=allowed,
+                product_id=item.c.id,
+                quantity=request.amount,
+            )
+            .returning(LedgerEntry.id)
+            .cte("charged")
+        )
+        coins = (
+            select(
+                func.json_object_agg(VendingMachineCoin.coin, VendingMachineCoin.count)
+            )
+            .where(VendingMachineCoin.vending_id == self.machine_id)
+            .scalar_subquery()
+            if self.with_coins
+            else null()
+        )
+        # one row even when the buyer or the product does not exist
+        base = select(literal_column("1").label("one")).subquery("base")
+        if not indexed:
+            reported = [item.c.product_name, item.c.cost, item.c.amount_available]
+            joined = base.outerjoin(buyer, true()).outerjoin(item, true())
+        else:
+            reported = [
+                func.coalesce(item.c[name], product.c[name]).label(name)
+                for name in ("product_name", "cost", "amount_available")
+            ]
+            joined = (
+                base.outerjoin(buyer, true())
+                .outerjoin(product, true())
+                .outerjoin(item, true())
+            )
+        return select(
+            buyer.c.role,
+            buyer.c.deposit,
+            *reported,
+            leased.label("leased"),
+            coins.label("coins"),
+            select(func.count()).select_from(sold).scalar_subquery().label("sold"),
+            select(func.count())
+            .select_from(charged)
+            .scalar_subquery()
+            .label("charged"),
+        ).select_from(joined)
+
+    def _change_payable(self, buyer, request: BuyProduct):
+        """Whether the index says the remainder of the purchase can be paid out"""
+        remainder = select(buyer.c.deposit).scalar_subquery() - (
+            Product.cost * request.amount
+        )
+        units = remainder // UNIT
+        payable = literal(self.change_index.payable_bytes(), LargeBinary)
+        return case(
+            # not enough money, or not indexed - left to the purchase checks
+            (remainder < 0, true()),
+            (units >= self.change_index.size, true()),
+            else_=func.get_bit(payable, units) == 1,
+        )
+
+    async def buy_product(self, request: BuyProduct) -> PurchaseState:
+        """Check and apply the purchase - the caller commits or rolls back"""
+        # left by an attempt that was rolled back and retried by the caller
+        self._release_reserved()
+        lease = None
+        if self.leases is not None:
+            lease = await self.leases.reserve(
+                self.machine_id, request.product_id, request.amount
+            )
+        if lease is None:
+            q = await execute_locked(
+                self.session, self._buy_statement(request), "products", "vending.buy"
+            )
+        else:
+            self._reserved.append((lease, request.amount))
+            q = await execute_locked(
+                self.session,
+                self._buy_statement(request, lease),
+                "stock_leases",
+                "vending.buy_leased",
+            )
+        row = q.one()
+        amount_available = row.amount_available
+        if lease is not None:
+            if row.leased is None:
+                # returned or voided since it was granted - retried without it
+                self.leases.forget(lease)
+            elif amount_available is not None:
+                amount_available += row.leased
+        self._stock_changed = self._stock_changed or bool(row.sold and lease is None)
+        coins = row.coins
+        if coins is not None:
+            # json_object_agg keys come back as strings
+            coins = Change.from_items((int(c), n) for c, n in coins.items())
+            if self.change_index is not None:
+                self.change_index.set(coins.counts)
+        return PurchaseState(
+            role=row.role,
+            deposit=row.deposit,
+            product_name=row.product_name,
+            cost=row.cost,
+            amount_available=amount_available,
+            coins=coins,
+            applied=bool(row.sold and row.charged),
+        )
+
+    def _deposit_statement(self, user_id: uuid.UUID, coins: Change):
+        added = coins.nonzero()
+        total = sum(k * v for k, v in added.items())
+        buyer = (
+            select(User.id, User.username, User.role, User.deposit)
+            .where(User.id == user_id, User.vending_id == self.machine_id)
+            .cte("buyer")
+        )
+        credited = (
+            ledger.credit(
+                buyer.c.id,
+                self.machine_id,
+                total,
+                where=buyer.c.role != "seller",
+                coins=coins,
+            )
+            .returning(LedgerEntry.user_id)
+            .cte("credited")
+        )
+        # the entry is not visible to this statement, add it to the balance
+        columns = [
+            buyer.c.role,
+            credited.c.user_id.label("id"),
+            buyer.c.username,
+            (buyer.c.deposit + total).label("deposit"),
+        ]
+        if self.with_coins:
+            # one row per distinct denomination, however many coins there are
+            stocked = (
+                update(VendingMachineCoin)
+                .where(
+                    VendingMachineCoin.vending_id == self.machine_id,
+                    VendingMachineCoin.coin.in_(added),
+                    select(credited.c.user_id).exists(),
+                )
+                .values(
+                    count=VendingMachineCoin.count
+                    + case(added, value=VendingMachineCoin.coin)
+                )
+                .returning(VendingMachineCoin.coin)
+                .cte("stocked")
+            )
+            columns.append(
+                select(func.count())
+                .select_from(stocked)
+                .scalar_subquery()
+                .label("stocked")
+            )
+        else:
+            columns.append(literal_column("0").label("stocked"))
+        base = select(literal_column("1").label("one")).subquery("base")
+        return select(*columns).select_from(
+            base.outerjoin(buyer, true()).outerjoin(credited, true())
+        )
+
+    async def deposit_coins(self, user_id: uuid.UUID, coins: Change) -> DepositState:
+        """Credit the buyer and stock the machine - the caller commits or rolls back"""
+        # the UPDATE locks the coin rows
+        q = await execute_locked(
+            self.session,
+            self._deposit_statement(user_id, coins),
+            "vending_machine_coins",
+            "vending.deposit",
+        )
+        row = q.one()
+        if row.stocked and self.change_index is not None:
+            self.change_index.add(coins.counts)
+        return DepositState(
+            role=row.role,
+            id=row.id,
+            username=row.username,
+            deposit=row.deposit,
+            coins_applied=bool(row.stocked),
+        )
+
+    def _release_reserved(self):
+        for lease, amount in self._reserved:
+            self.leases.release(lease, amount)
+        self._reserved = []
+
+    async def commit(self):
+        await self.session.commit()
+        self._reserved = []
+        if self._stock_changed:
+            catalog_cache.invalidate(self.machine_id)
+            self._stock_changed = False
+
+    async def rollback(self):
+        await self.session.rollback()
+        self._release_reserved()
+        self._stock_changed = False
+
+
+async def get_vending_repository(
+    session: AsyncSession = Depends(get_session),
+    machine_id: uuid.UUID = Depends(get_vending_machine_id),
+) -> VendingRepository:
+    return SQLVendingRepository(
+        session,
+        machine_id,
+        with_coins=settings.VENDING_MACHINE_BACKEND == "sql",
+        optimistic=settings.CONCURRENCY_MODE == "optimistic",
+        leases=stock_leases if settings.STOCK_LEASE_SIZE else None,
+        change_index=get_change_index(machine_id),
+    )
@@ -1,4 +1,5 @@
-import logging
+import functools
+from typing import Optional
 from uuid import UUID
 
 from fastapi import Depends
@@ -7,6 +8,7 @@ from app.users.models import BuyerRead
 from app.users.repository import UserRepository, get_user_repository
 from app.vending import machine
 from app.errors import (
+    ConcurrentUpdateError,
     InvalidRoleError,
     NotEnoughChangeError,
     NotEnoughMoneyError,
@@ -14,10 +16,100 @@ from app.errors import (
     ProductNotFoundError,
     UserNotFoundError,
 )
-from app.vending.models import BuyProduct, BuyProductSummary, Deposit
+from app.vending.models import (
+    BatchDeposit,
+    BuyProduct,
+    BuyProductSummary,
+    Deposit,
+    PurchaseState,
+)
+from app.vending.repository import VendingRepository, get_vending_repository
+
+
+from app.core import metrics
+from app.core.config import settings
+from app.db.sql.session import get_session
+from app.db.sql.transactions import TransactionRunner
+from app.log import get_logger
+
+log = get_logger(__name__)
+
+STAGE_SECONDS = metrics.Histogram(
+    "vending_stage_duration_seconds",
+    "Time spent in each stage of a vending operation",
+    ("operation", "stage"),
+)
+ERRORS = metrics.Counter(
+    "vending_errors",
+    "Errors raised by vending operations by exception class",
+    ("operation", "error"),
+)
+CONFLICT_RETRIES = metrics.Counter(
+    "vending_conflict_retries",
+    "Operations re-run after losing an optimistic write",
+    ("operation",),
+)
+
+
+def track_errors(operation: str):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                ERRORS.labels(operation, type(e).__name__).inc()
+                raise
+
+        return wrapper
+
+    return decorator
+
+
+def retry_on_conflict(operation: str):
+    """Re-run the operation when an optimistic write found a newer version"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            for _ in range(settings.OPTIMISTIC_MAX_RETRIES):
+                try:
+                    return await fn(*args, **kwargs)
+                except ConcurrentUpdateError:
+                    CONFLICT_RETRIES.labels(operation).inc()
+            return await fn(*args, **kwargs)
 
+        return wrapper
 
-from app.log import log
+    return decorator
+
+
+def in_transaction(operation: str):
+    """Run the operation as one unit of work of `self.transactions`, if any
+
+    Coins the machine keeps outside the database are settled after every
+    attempt - kept when it committed, given back when it failed.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            async def attempt():
+                try:
+                    result = await fn(self, *args, **kwargs)
+                except BaseException:
+                    await self.vending_machine.rollback()
+                    raise
+                await self.vending_machine.commit()
+                return result
+
+            if self.transactions is None:
+                return await attempt()
+            return await self.transactions.run(operation, attempt)
+
+        return wrapper
+
+    return decorator
 
 
 class VendingService:
@@ -26,113 +118,207 @@ class VendingService:
         user_repository: UserRepository,
         product_repository: ProductRepository,
         vending_machine: machine.VendingMachine,
+        vending_repository: VendingRepository,
+        transactions: Optional[TransactionRunner] = None,
     ):
         self.user_repository = user_repository
         self.product_repository = product_repository
         self.vending_machine = vending_machine
+        self.vending_repository = vending_repository
+        self.transactions = transactions
 
+    @track_errors("deposit")
+    @in_transaction("deposit")
     async def deposit_coins(self, request: Deposit) -> BuyerRead:
-        current_user = await self.user_repository.get_for_update(request.user_id)
+        with STAGE_SECONDS.time("deposit", "user_read"):
+            current_user = await self.user_repository.get_full(request.user_id)
         if current_user.role == "seller":
             raise InvalidRoleError()
-        resp = await self.user_repository.deposit_coins(request)
-
-        log.info(f"Deposited {request.coin} for user {request.user_id}")
-        current = await self.vending_machine.add_coin(request.coin)
+        # one transaction: the credit, then the coin
+        with STAGE_SECONDS.time("deposit", "deposit_update"):
+            resp = await self.user_repository.deposit_coins(request, commit=False)
+        with STAGE_SECONDS.time("deposit", "add_coin"):
+            current = await self.vending_machine.add_coin(request.coin)
+        with STAGE_SECONDS.time("deposit", "commit"):
+            await self.vending_repository.commit()
 
+        log.info(
+            "Deposited %s for user %s",
+            request.coin,
+            request.user_id,
+            extra={"user_id": request.user_id, "coin": request.coin},
+        )
 
-        log.info(f"Current coins in vending machine: {current}")
+        log.debug("Current coins in vending machine: %s", current)
 
         return resp
 
+    @track_errors("deposit_batch")
+    @in_transaction("deposit_batch")
+    async def deposit_coin_batch(self, request: BatchDeposit) -> BuyerRead:
+        # all coins are credited in one statement, whatever their number
+        coins = request.as_change()
+        with STAGE_SECONDS.time("deposit_batch", "statement"):
+            state = await self.vending_repository.deposit_coins(request.user_id, coins)
+        try:
+            if state.role is None:
+                raise UserNotFoundError()
+            if state.role == "seller":
+                raise InvalidRoleError()
+        except Exception:
+            await self.vending_repository.rollback()
+            raise
+        with STAGE_SECONDS.time("deposit_batch", "commit"):
+            await self.vending_repository.commit()
+        if not state.coins_applied:
+            # the machine keeps its coins outside the database
+            with STAGE_SECONDS.time("deposit_batch", "add_coins"):
+                await self.vending_machine.add_coins(coins)
+
+        log.info(
+            "Deposited %s coins for user %s",
+            len(request.coins),
+            request.user_id,
+            extra={"user_id": request.user_id},
+        )
+        return BuyerRead(
+            id=state.id, username=state.username, role=state.role, deposit=state.deposit
+        )
+
+    @track_errors("buy")
+    @in_transaction("buy")
+    @retry_on_conflict("buy")
     async def buy_product(self, request: BuyProduct):
         # - check if there's enough money deposited
         # - check if there's enough product available
         # - check if there's enough change available
         # - update the product amount available
         # - update the user deposit
-        # - return the product
         # - return the total spent
         # - return the product name
         # - return the change
-        # check if there's enough money deposited
+        # checks and decrements run as a single statement, then one commit
+
+        log.debug(
+            "Buying product %s for user %s", request.product_id, request.user_id
+        )
+        with STAGE_SECONDS.time("buy", "statement"):
+            state = await self.vending_repository.buy_product(request)
+        try:
+            calculated_change = await self._check_purchase(request, state)
+        except Exception:
+            with STAGE_SECONDS.time("buy", "rollback"):
+                await self.vending_repository.rollback()
+            raise
+        with STAGE_SECONDS.time("buy", "commit"):
+            await self.vending_repository.commit()
+
+        total_price = state.cost * request.amount
+        log.info(
+            "Bought product %s for user %s, total price %s, change %s",
+            state.product_name,
+            request.user_id,
+            total_price,
+            calculated_change,
+            extra={
+                "user_id": request.user_id,
+                "product_id": request.product_id,
+                "total_spent": total_price,
+            },
+        )
+        return BuyProductSummary(
+            total_spent=total_price,
+            product_name=state.product_name,
+            change=calculated_change,
+        )
 
-        log.info(f"Buying product {request.product_id} for user {request.user_id}")
-        buyer = await self.user_repository.get_for_update(request.user_id)
-        if not buyer:
-            log.info(f"User {request.user_id} not found")
+    async def _check_purchase(self, request: BuyProduct, state: PurchaseState):
+        if state.role is None:
+            log.info("User %s not found", request.user_id)
             raise UserNotFoundError()
-        if buyer.role == "seller":
+        if state.role == "seller":
             raise InvalidRoleError()
         # check if there's enough product available
-        product = await self.product_repository.get_product_for_update(
-            request.product_id
-        )
-        if not product:
-            log.info(f"Product {request.product_id} not found")
+        if state.product_name is None:
+            log.info("Product %s not found", request.product_id)
             raise ProductNotFoundError()
-        if product.amount_available < request.amount:
+        if state.amount_available < request.amount:
             log.info(
-                f"Not enough product available. Requested: {request.amount} in stock: {product.amount_available}"
+                "Not enough product available. Requested: %s in stock: %s",
+                request.amount,
+                state.amount_available,
             )
             raise NotEnoughProductError()
 
-        total_price = product.cost * request.amount
-        if buyer.deposit < total_price:
+        total_price = state.cost * request.amount
+        if state.deposit < total_price:
             log.info(
-                f"Not enough money deposited. Requested: {total_price} in deposit: {buyer.deposit}"
+                "Not enough money deposited. Requested: %s in deposit: %s",
+                total_price,
+                state.deposit,
             )
             raise NotEnoughMoneyError()
         # check if there's enough change available
-        calculate_amount_after = buyer.deposit - total_price
-
-        current_coins_in_machine = await self.vending_machine.get_coins_for_update()
-        # calculate_amount_spent
-        log.info(f"Calculating change for {calculate_amount_after}")
+        calculate_amount_after = state.deposit - total_price
+        # coins come with the purchase statement unless the machine keeps them elsewhere
+        coins = state.coins
+        if coins is None:
+            with STAGE_SECONDS.time("buy", "coins_read"):
+                coins = await self.vending_machine.get_coins()
+        log.debug("Calculating change for %s", calculate_amount_after)
         try:
-            calculated_change = await machine.calculate_change(
-                current_coins=current_coins_in_machine, amount=calculate_amount_after
-            )
+            with STAGE_SECONDS.time("buy", "calculate_change"):
+                calculated_change = await machine.calculate_change(
+                    current_coins=coins, amount=calculate_amount_after
+                )
         except NotEnoughChangeError:
             log.info(
-                f"Not enough change in machine. Current coins in machine: {current_coins_in_machine}"
+                "Not enough change in machine. Current coins in machine: %s", coins
             )
             raise NotEnoughChangeError()
+        if not state.applied:
+            # every check passed on rows another purchase changed meanwhile, or
+            # on coins this worker's change index had not seen yet
+            raise ConcurrentUpdateError()
+        return calculated_change
 
-        log.info(
-            f"Calculating change for change:{calculate_amount_after} coins:{calculated_change}  "
-        )
-
-        # then update the product amount available
-        product = await self.product_repository.buy_product(
-            request.product_id, request.amount
-        )
-        res = await self.user_repository.decrease_deposit(request.user_id, total_price)
-
-        log.info(
-            f"succesfully bought product {product.product_name} for user {buyer} with total price {total_price} and change {calculated_change}"
-        )
-        return BuyProductSummary(
-            total_spent=total_price,
-            product_name=product.product_name,
-            change=calculated_change,
-        )
-
+    @track_errors("reset")
+    @in_transaction("reset")
+    @retry_on_conflict("reset")
     async def reset_user_deposit(self, user_id: UUID) -> None:
-        current_user = await self.user_repository.get_for_update(user_id)
+        with STAGE_SECONDS.time("reset", "user_read"):
+            current_user = await self.user_repository.get_full(user_id)
         current = current_user.deposit
         if current_user.role == "seller":
             raise InvalidRoleError()
         if current > 0:
-            coins_in_machine = await self.vending_machine.get_coins_for_update()
-            calculated_change = await machine.calculate_change(
-                current_coins=coins_in_machine, amount=current
-            )
-            await self.vending_machine.remove_coins(calculated_change)
-            await self.user_repository.reset_deposit(user_id)
+            # no lock needed - remove_coins only decrements when coins are still there
+            # and the refund is only appended when no other debit came first
+            with STAGE_SECONDS.time("reset", "coins_read"):
+                coins_in_machine = await self.vending_machine.get_coins()
+            with STAGE_SECONDS.time("reset", "calculate_change"):
+                calculated_change = await machine.calculate_change(
+                    current_coins=coins_in_machine, amount=current
+                )
+            # one transaction: the refund, then the coins
+            with STAGE_SECONDS.time("reset", "reset_deposit"):
+                await self.user_repository.reset_deposit(
+                    user_id, expected=current, commit=False, change=calculated_change
+                )
+            try:
+                with STAGE_SECONDS.time("reset", "remove_coins"):
+                    await self.vending_machine.remove_coins(calculated_change)
+            except Exception:
+                await self.vending_repository.rollback()
+                raise
+            with STAGE_SECONDS.time("reset", "commit"):
+                await self.vending_repository.commit()
 
             log.info(
-                f"Reset deposit for user {user_id} to 0 and removed {calculated_change} from vending machine"
+                "Reset deposit for user %s to 0 and removed %s from vending machine",
+                user_id,
+                calculated_change,
+                extra={"user_id": user_id, "refunded": current},
             )
 
             return
@@ -146,9 +332,18 @@ async def get_vending_service(
     user_repository: UserRepository = Depends(get_user_repository),
     product_repository: ProductRepository = Depends(get_product_repository),
     vending_machine: machine.VendingMachine = Depends(machine.get_vending_machine),
+    vending_repository: VendingRepository = Depends(get_vending_repository),
+    session=Depends(get_session),
 ):
     return VendingService(
         user_repository=user_repository,
         product_repository=product_repository,
         vending_machine=vending_machine,
+        vending_repository=vending_repository,
+        transactions=TransactionRunner(
+            session,
+            lock_timeout_ms=settings.DATABASE_LOCK_TIMEOUT_MS,
+            max_attempts=settings.TRANSACTION_MAX_ATTEMPTS,
+            backoff_seconds=settings.TRANSACTION_RETRY_BACKOFF_SECONDS,
+        ),
     )
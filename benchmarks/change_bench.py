@@ -0,0 +1,102 @@
+"""
+Benchmark: bounded DP change solver vs the old largest-coin-first greedy.
+
+Runs both over random coin inventories and owed amounts and reports how
+often each finds change and how long it takes.
+
+    PYTHONPATH=. python benchmarks/change_bench.py --inventories 2000
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from app.errors import NotEnoughChangeError
+from app.vending.change import COINS, get_solver
+from app.vending.machine import calculate_change
+from app.vending.models import Change
+
+
+def greedy_change(counts: tuple[int, ...], amount: int):
+    """The previous `calculate_change` implementation, kept as a reference"""
+    plan = [0] * len(COINS)
+    for i in reversed(range(len(COINS))):
+        coin = COINS[i]
+        while amount >= coin and counts[i] > plan[i]:
+            plan[i] += 1
+            amount -= coin
+    if amount > 0:
+        return None
+    return tuple(plan)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inventories", type=int, default=1000)
+    parser.add_argument("--amounts", type=int, default=20)
+    parser.add_argument("--max-coins", type=int, default=10)
+    parser.add_argument("--max-amount", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cases = []
+    for _ in range(args.inventories):
+        counts = tuple(rng.randint(0, args.max_coins) for _ in COINS)
+        amounts = [
+            rng.randrange(0, args.max_amount + 1, 5) for _ in range(args.amounts)
+        ]
+        cases.append((counts, amounts))
+
+    start = time.perf_counter()
+    greedy_ok = sum(
+        greedy_change(counts, a) is not None
+        for counts, amounts in cases
+        for a in amounts
+    )
+    greedy_time = time.perf_counter() - start
+
+    get_solver.cache_clear()
+    start = time.perf_counter()
+    dp_ok = sum(
+        get_solver(counts).solve(a) is not None
+        for counts, amounts in cases
+        for a in amounts
+    )
+    dp_time = time.perf_counter() - start
+
+    # the full `calculate_change` path, Change model included
+    async def run_calculate_change():
+        ok = 0
+        for counts, amounts in cases:
+            coins = Change(root=dict(zip(COINS, counts)))
+            for a in amounts:
+                try:
+                    await calculate_change(coins, a)
+                    ok += 1
+                except NotEnoughChangeError:
+                    pass
+        return ok
+
+    get_solver.cache_clear()
+    start = time.perf_counter()
+    asyncio.run(run_calculate_change())
+    calc_time = time.perf_counter() - start
+
+    total = args.inventories * args.amounts
+    print(f"calls: {total}")
+    print(
+        f"greedy: {greedy_ok} paid ({greedy_ok / total:.1%}), "
+        f"{greedy_time / total * 1e6:.1f} us/call"
+    )
+    print(
+        f"dp:     {dp_ok} paid ({dp_ok / total:.1%}), "
+        f"{dp_time / total * 1e6:.1f} us/call"
+    )
+    print(f"calculate_change: {calc_time / total * 1e6:.1f} us/call")
+    print(f"failures avoided by dp: {dp_ok - greedy_ok}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark: fixed-layout `Change` vs the previous pydantic RootModel.
+
+Replays the `Change` work of one purchase - coins read with the purchase
+statement, the change plan, the coins left after removing it and the
+response body - and reports time and allocated memory per purchase. Change
+plans are solved up front so only the representation is measured.
+
+    PYTHONPATH=. python benchmarks/change_model_bench.py --purchases 20000
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+from typing import Optional
+
+from pydantic import BaseModel, RootModel, validator
+
+from app.users.models import AVAILABLE_COINS
+from app.vending.change import COINS, ChangeSolver
+from app.vending.models import BuyProductSummary, Change, PurchaseState
+
+
+class LegacyChange(RootModel):
+    """The previous `Change`, kept as a reference"""
+
+    root: dict[int, int] = {c: 0 for c in AVAILABLE_COINS}
+
+    @validator("root")
+    def validate(cls, v: dict[int, int]):
+        if sorted(AVAILABLE_COINS) == sorted(v.keys()):
+            return v
+        raise ValueError("Invalid change amount")
+
+
+class LegacyPurchaseState(BaseModel):
+    deposit: Optional[int] = None
+    coins: Optional[LegacyChange] = None
+
+
+class LegacyBuyProductSummary(BaseModel):
+    total_spent: int
+    product_name: str
+    change: LegacyChange
+
+
+def legacy_purchase(row: dict, owed: int, plan: tuple[int, ...]) -> str:
+    state = LegacyPurchaseState(deposit=owed, coins=row)
+    change = LegacyChange(root=dict(zip(COINS, plan)))
+    left = {k: state.coins.root[k] - v for k, v in change.root.items()}
+    LegacyChange(root=left)
+    return LegacyBuyProductSummary(
+        total_spent=0, product_name="cola", change=change
+    ).model_dump_json()
+
+
+def purchase(row: dict, owed: int, plan: tuple[int, ...]) -> str:
+    coins = Change.from_items((int(c), n) for c, n in row.items())
+    state = PurchaseState(deposit=owed, coins=coins)
+    change = Change.from_counts(plan)
+    state.coins - change
+    return BuyProductSummary(
+        total_spent=0, product_name="cola", change=change
+    ).model_dump_json()
+
+
+def measure(fn, cases) -> tuple[float, float]:
+    start = time.perf_counter()
+    for case in cases:
+        fn(*case)
+    elapsed = time.perf_counter() - start
+
+    # peak memory allocated while serving one purchase, averaged
+    tracemalloc.start()
+    peak = 0
+    sample = cases[:1000]
+    for case in sample:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(*case)
+        peak += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return elapsed / len(cases), peak / len(sample)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--purchases", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cases = []
+    for _ in range(args.purchases):
+        # as decoded from json_object_agg - string keys
+        counts = [rng.randint(5, 20) for _ in COINS]
+        owed = rng.randrange(0, 200, 5)
+        plan = ChangeSolver(counts).solve(owed)
+        row = {str(c): n for c, n in zip(COINS, counts)}
+        cases.append((row, owed, plan))
+
+    for name, fn in (("RootModel", legacy_purchase), ("fixed", purchase)):
+        seconds, allocated = measure(fn, cases)
+        print(
+            f"{name:10} {seconds * 1e6:6.1f} us/purchase, "
+            f"{allocated:6.0f} B peak allocation/purchase"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Benchmark: pessimistic (SELECT ... FOR UPDATE) vs optimistic (version column)
+purchases under low and high contention.
+
+Seeds buyers with a large deposit, products and coins in the database from
+`.env` (migrations applied), then runs concurrent `VendingService.buy_product`
+calls for each mode. "low" spreads buyers over many products, "high" sends
+everyone to the same product.
+
+    PYTHONPATH=. python benchmarks/contention_bench.py --workers 32 --duration 10
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from collections import Counter
+
+from sqlalchemy import delete
+
+from app.core import security
+from app.core.config import settings
+from app.core.session import async_engine, async_session
+from app.db.sql import ledger
+from app.db.sql.models import Product, User
+from app.products.repository import SQLProductRepository
+from app.users.models import AVAILABLE_COINS
+from app.users.repository import SQLUserRepository
+from app.vending.machine import SQLVendingMachine
+from app.vending.models import BuyProduct, Change
+from app.vending.repository import SQLVendingRepository
+from app.vending.service import CONFLICT_RETRIES, VendingService
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def seed(buyers: int, products: int):
+    machine_id = uuid.UUID(settings.VENDING_MACHINE_ID)
+    password = security.get_password_hash("bench")
+    async with async_session() as session:
+        seller = User(
+            username=f"bench-{uuid.uuid4().hex[:24]}", password=password, role="seller"
+        )
+        session.add(seller)
+        await session.flush()
+        users = [
+            User(
+                username=f"bench-{uuid.uuid4().hex[:24]}",
+                password=password,
+                role="buyer",
+                vending_id=machine_id,
+            )
+            for _ in range(buyers)
+        ]
+        items = [
+            Product(
+                product_name=f"bench-{i}",
+                cost=5,
+                amount_available=10**9,
+                seller_id=seller.id,
+                vending_id=machine_id,
+            )
+            for i in range(products)
+        ]
+        session.add_all([*users, *items])
+        await session.flush()
+        await session.execute(
+            ledger.credit(
+                User.id,
+                User.vending_id,
+                10**9,
+                where=User.id.in_([u.id for u in users]),
+            )
+        )
+        await session.commit()
+        machine = SQLVendingMachine(session, machine_id)
+        previous_coins = await machine.get_coins()
+        await machine.set_coins(Change(root={c: 10**6 for c in AVAILABLE_COINS}))
+    return seller.id, [u.id for u in users], [p.id for p in items], previous_coins
+
+
+async def cleanup(seller_id, user_ids, product_ids, previous_coins):
+    async with async_session() as session:
+        await session.execute(delete(Product).where(Product.id.in_(product_ids)))
+        await session.execute(delete(User).where(User.id.in_([*user_ids, seller_id])))
+        await session.commit()
+        machine = SQLVendingMachine(session, uuid.UUID(settings.VENDING_MACHINE_ID))
+        await machine.set_coins(previous_coins)
+
+
+async def worker(user_id, product_ids, optimistic, deadline, latencies, errors):
+    machine_id = uuid.UUID(settings.VENDING_MACHINE_ID)
+    while time.perf_counter() < deadline:
+        request = BuyProduct(
+            product_id=random.choice(product_ids), user_id=user_id, amount=1
+        )
+        async with async_session() as session:
+            service = VendingService(
+                user_repository=SQLUserRepository(session),
+                product_repository=SQLProductRepository(
+                    session, machine_id, optimistic=optimistic
+                ),
+                vending_machine=SQLVendingMachine(session, machine_id),
+                vending_repository=SQLVendingRepository(
+                    session, machine_id, optimistic=optimistic
+                ),
+            )
+            start = time.perf_counter()
+            try:
+                await service.buy_product(request)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+
+async def run(mode, contention, user_ids, product_ids, workers, duration):
+    targets = product_ids[:1] if contention == "high" else product_ids
+    retries_before = CONFLICT_RETRIES.labels("buy").value
+    latencies: list[float] = []
+    errors: Counter = Counter()
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *(
+            worker(
+                user_ids[i % len(user_ids)],
+                targets,
+                mode == "optimistic",
+                deadline,
+                latencies,
+                errors,
+            )
+            for i in range(workers)
+        )
+    )
+    retries = CONFLICT_RETRIES.labels("buy").value - retries_before
+    print(
+        f"{mode:12} {contention:5} {len(latencies) / duration:8.1f} buys/s  "
+        f"p50 {percentile(latencies, 50) * 1e3:6.2f} ms  "
+        f"p99 {percentile(latencies, 99) * 1e3:7.2f} ms  "
+        f"retries {int(retries):6}  errors {dict(errors)}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--products", type=int, default=256)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    seller_id, user_ids, product_ids, previous_coins = await seed(
+        args.workers, args.products
+    )
+    try:
+        for contention in ("low", "high"):
+            for mode in ("pessimistic", "optimistic"):
+                await run(
+                    mode, contention, user_ids, product_ids, args.workers, args.duration
+                )
+    finally:
+        await cleanup(seller_id, user_ids, product_ids, previous_coins)
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
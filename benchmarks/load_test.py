@@ -0,0 +1,301 @@
+"""
+End-to-end load test for /vending/deposit, /vending/buy and /vending/reset.
+
+Seeds buyers, products and a coin inventory in the database from `.env`
+(migrations applied), then drives concurrent mixed traffic either through the
+ASGI app in process or against real uvicorn workers, and writes a JSON report
+that can be diffed between versions:
+
+    PYTHONPATH=. python benchmarks/load_test.py --target asgi --users 32 --duration 30
+    PYTHONPATH=. python benchmarks/load_test.py --target uvicorn --workers 2 \
+        --output load_after.json
+
+Round trips per request are counted with engine events in `asgi` mode and
+from `pg_stat_statements` (when the extension is installed) in `uvicorn` mode.
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import httpx
+from sqlalchemy import delete, event, text
+
+from app import errors
+from app.core import security
+from app.core.config import settings
+from app.core.session import async_engine, async_session
+from app.db.sql.models import Product, User
+from app.users.models import AVAILABLE_COINS
+from app.vending.machine import SQLVendingMachine
+from app.vending.models import Change
+
+# detail returned by the API -> exception class, to report errors by type
+ERROR_TYPES = {
+    str(cls()): name
+    for name, cls in inspect.getmembers(errors, inspect.isclass)
+    if issubclass(cls, Exception)
+}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, Counter] = defaultdict(Counter)
+        self.requests: Counter = Counter()
+
+    def record(self, op: str, seconds: float, error: str | None):
+        self.requests[op] += 1
+        self.latencies[op].append(seconds)
+        if error:
+            self.errors[op][error] += 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def classify(response: httpx.Response) -> str | None:
+    if response.status_code < 400:
+        return None
+    try:
+        detail = response.json().get("detail")
+    except ValueError:
+        detail = None
+    if isinstance(detail, str) and detail in ERROR_TYPES:
+        return ERROR_TYPES[detail]
+    if response.status_code >= 500:
+        # lock timeouts, deadlocks and other database errors end up here
+        return "InternalServerError"
+    return f"HTTP{response.status_code}"
+
+
+async def seed(buyers: int, products: int, coins: int):
+    machine_id = uuid.UUID(settings.VENDING_MACHINE_ID)
+    password = security.get_password_hash("load-test")
+    async with async_session() as session:
+        seller = User(
+            username=f"load-{uuid.uuid4().hex[:24]}", password=password, role="seller"
+        )
+        session.add(seller)
+        await session.flush()
+        users = [
+            User(
+                username=f"load-{uuid.uuid4().hex[:24]}",
+                password=password,
+                role="buyer",
+                vending_id=machine_id,
+            )
+            for _ in range(buyers)
+        ]
+        items = [
+            Product(
+                product_name=f"load-{i}",
+                cost=random.choice([5, 15, 25, 40, 65, 90]),
+                amount_available=10**6,
+                seller_id=seller.id,
+                vending_id=machine_id,
+            )
+            for i in range(products)
+        ]
+        session.add_all([*users, *items])
+        await session.commit()
+        machine = SQLVendingMachine(session, machine_id)
+        previous_coins = await machine.get_coins()
+        await machine.set_coins(Change(root={c: coins for c in AVAILABLE_COINS}))
+    return seller.id, [u.id for u in users], [p.id for p in items], previous_coins
+
+
+async def cleanup(seller_id, user_ids, product_ids, previous_coins):
+    async with async_session() as session:
+        await session.execute(delete(Product).where(Product.id.in_(product_ids)))
+        await session.execute(delete(User).where(User.id.in_([*user_ids, seller_id])))
+        await session.commit()
+        machine = SQLVendingMachine(session, uuid.UUID(settings.VENDING_MACHINE_ID))
+        await machine.set_coins(previous_coins)
+
+
+async def virtual_user(client, token, product_ids, weights, deadline, stats):
+    headers = {"Authorization": f"Bearer {token}"}
+    ops = list(weights)
+    while time.perf_counter() < deadline:
+        op = random.choices(ops, weights=[weights[o] for o in ops])[0]
+        if op == "deposit":
+            request = ("/vending/deposit", {"coin": random.choice(AVAILABLE_COINS)})
+        elif op == "buy":
+            request = (
+                "/vending/buy",
+                {"product_id": str(random.choice(product_ids)), "amount": 1},
+            )
+        else:
+            request = ("/vending/reset", None)
+        start = time.perf_counter()
+        try:
+            response = await client.post(request[0], json=request[1], headers=headers)
+            error = classify(response)
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        stats.record(op, time.perf_counter() - start, error)
+
+
+async def pg_statement_calls() -> int | None:
+    try:
+        async with async_engine.connect() as conn:
+            q = await conn.execute(text("SELECT sum(calls) FROM pg_stat_statements"))
+            return int(q.scalar() or 0)
+    except Exception:
+        return None
+
+
+def start_uvicorn(workers: int, port: int) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app.main:app",
+            "--workers",
+            str(workers),
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ]
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://localhost:{port}/openapi.json", timeout=1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("uvicorn did not start")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--buyers", type=int, default=64)
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--coins", type=int, default=1000, help="per denomination")
+    parser.add_argument("--users", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--mix", default="deposit=6,buy=3,reset=1")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    weights = {k: int(v) for k, v in (p.split("=") for p in args.mix.split(","))}
+
+    round_trips = 0
+
+    def count(*_):
+        nonlocal round_trips
+        round_trips += 1
+
+    seller_id, user_ids, product_ids, previous_coins = await seed(
+        args.buyers, args.products, args.coins
+    )
+    tokens = [
+        security.generate_access_token_response(
+            str(u), settings.VENDING_MACHINE_ID
+        ).access_token
+        for u in user_ids
+    ]
+    server = None
+    try:
+        if args.target == "asgi":
+            from app.main import app
+
+            event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+            event.listen(async_engine.sync_engine, "commit", count)
+            transport = httpx.ASGITransport(app=app)
+            base_url = "http://localhost"
+        else:
+            server = start_uvicorn(args.workers, args.port)
+            transport = None
+            base_url = f"http://localhost:{args.port}"
+        calls_before = await pg_statement_calls() if server else None
+
+        stats = Stats()
+        async with httpx.AsyncClient(
+            transport=transport, base_url=base_url, timeout=30
+        ) as client:
+            started = time.perf_counter()
+            deadline = started + args.duration
+            await asyncio.gather(
+                *(
+                    virtual_user(
+                        client,
+                        tokens[i % len(tokens)],
+                        product_ids,
+                        weights,
+                        deadline,
+                        stats,
+                    )
+                    for i in range(args.users)
+                )
+            )
+            elapsed = time.perf_counter() - started
+
+        if server:
+            calls_after = await pg_statement_calls()
+            if calls_before is not None and calls_after is not None:
+                round_trips = calls_after - calls_before
+            else:
+                round_trips = None
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        await cleanup(seller_id, user_ids, product_ids, previous_coins)
+        await async_engine.dispose()
+
+    total = sum(stats.requests.values())
+    report = {
+        "version": settings.VERSION,
+        "target": args.target,
+        "workers": args.workers if args.target == "uvicorn" else 1,
+        "users": args.users,
+        "duration_s": round(elapsed, 2),
+        "requests": total,
+        "rps": round(total / elapsed, 1),
+        "db_round_trips_per_request": (
+            round(round_trips / total, 2) if total and round_trips is not None else None
+        ),
+        "endpoints": {},
+    }
+    for op, latencies in stats.latencies.items():
+        count_op = stats.requests[op]
+        report["endpoints"][op] = {
+            "requests": count_op,
+            "rps": round(count_op / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1e3, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1e3, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1e3, 2),
+            "error_rate": round(sum(stats.errors[op].values()) / count_op, 4),
+            "errors": dict(stats.errors[op]),
+        }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
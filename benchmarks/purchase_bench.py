@@ -0,0 +1,174 @@
+"""
+Benchmark: round trips and lock hold time of one purchase.
+
+Compares the old step-by-step purchase (user, product and coins locked one
+by one, two commits) with `SQLVendingRepository` (one statement, one
+commit). Needs the database from `.env` with migrations applied; it seeds
+its own buyer, seller and product and deletes them afterwards.
+
+    PYTHONPATH=. python benchmarks/purchase_bench.py --purchases 500 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import time
+import uuid
+from statistics import mean, median
+
+from sqlalchemy import delete, event, select
+
+from app.core.config import settings
+from app.core.security import get_password_hash
+from app.core.session import async_engine, async_session
+from app.db.sql import ledger
+from app.db.sql.models import Product, User
+from app.products.repository import SQLProductRepository
+from app.vending import machine
+from app.vending.models import BuyProduct
+from app.vending.repository import SQLVendingRepository
+from app.vending.service import VendingService
+
+round_trips = 0
+
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def count_statement(*args):
+    global round_trips
+    round_trips += 1
+
+
+@event.listens_for(async_engine.sync_engine, "commit")
+def count_commit(*args):
+    global round_trips
+    round_trips += 1
+
+
+async def legacy_buy(session, request: BuyProduct):
+    """The purchase path before the single-statement rewrite"""
+    product_repository = SQLProductRepository(session)
+    vending_machine = machine.SQLVendingMachine(
+        session, uuid.UUID(settings.VENDING_MACHINE_ID)
+    )
+    q = await session.execute(
+        select(User).where(User.id == request.user_id).with_for_update()
+    )
+    buyer = q.scalar_one()
+    product = await product_repository.get_product_for_update(request.product_id)
+    total_price = product.cost * request.amount
+    coins = await vending_machine.get_coins_for_update()
+    await machine.calculate_change(coins, buyer.deposit - total_price)
+    await product_repository.buy_product(request.product_id, request.amount)
+    await session.execute(
+        ledger.debit(
+            "sale",
+            User.id,
+            User.vending_id,
+            total_price,
+            balance=User.deposit,
+            debit_seq=ledger.next_debit_seq(User.id),
+            where=User.id == request.user_id,
+        )
+    )
+    await session.commit()
+
+
+async def new_buy(session, request: BuyProduct):
+    service = VendingService(
+        user_repository=None,
+        product_repository=None,
+        vending_machine=None,
+        vending_repository=SQLVendingRepository(
+            session, uuid.UUID(settings.VENDING_MACHINE_ID)
+        ),
+    )
+    await service.buy_product(request)
+
+
+async def seed(buyers: int):
+    async with async_session() as session:
+        seller = User(
+            username=f"bench-{uuid.uuid4().hex[:20]}",
+            password=get_password_hash("bench"),
+            role="seller",
+        )
+        session.add(seller)
+        await session.flush()
+        product = Product(
+            product_name="bench", cost=5, amount_available=10**9, seller_id=seller.id
+        )
+        users = [
+            User(
+                username=f"bench-{uuid.uuid4().hex[:20]}",
+                password=seller.password,
+                role="buyer",
+            )
+            for _ in range(buyers)
+        ]
+        session.add_all([product, *users])
+        await session.flush()
+        await session.execute(
+            ledger.credit(
+                User.id,
+                User.vending_id,
+                10**9,
+                where=User.id.in_([u.id for u in users]),
+            )
+        )
+        await session.commit()
+        return seller.id, product.id, [u.id for u in users]
+
+
+async def cleanup(seller_id, product_id, user_ids):
+    async with async_session() as session:
+        await session.execute(delete(Product).where(Product.id == product_id))
+        await session.execute(delete(User).where(User.id.in_([*user_ids, seller_id])))
+        await session.commit()
+
+
+async def run(name, buy, product_id, user_ids, purchases, concurrency):
+    global round_trips
+    hold_times = []
+    queue = asyncio.Queue()
+    for i in range(purchases):
+        queue.put_nowait(user_ids[i % len(user_ids)])
+
+    async def worker():
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            async with async_session() as session:
+                start = time.perf_counter()
+                await buy(
+                    session,
+                    BuyProduct(product_id=product_id, amount=1, user_id=user_id),
+                )
+                hold_times.append(time.perf_counter() - start)
+
+    round_trips = 0
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<8} round trips/purchase: {round_trips / purchases:.1f}  "
+        f"lock hold ms mean/median: {mean(hold_times) * 1e3:.2f}/{median(hold_times) * 1e3:.2f}  "
+        f"purchases/s: {purchases / elapsed:.0f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--purchases", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--buyers", type=int, default=8)
+    args = parser.parse_args()
+
+    seller_id, product_id, user_ids = await seed(args.buyers)
+    try:
+        for name, buy in (("legacy", legacy_buy), ("single", new_buy)):
+            await run(name, buy, product_id, user_ids, args.purchases, args.concurrency)
+    finally:
+        await cleanup(seller_id, product_id, user_ids)
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())